@@ -0,0 +1,174 @@
+class _CountingWriter:
+    """Text adapter over a binary file that counts the bytes written through it"""
+
+    def __init__(self, outfile):
+        self.outfile = outfile
+        self.written = 0
+
+    def write(self, text):
+        data = text.encode('utf-8')
+        self.outfile.write(data)
+        self.written += len(data)
+
+
+class BulkProfileWriter:
+    """Collect the profiles of a whole run into NDJSON files or FHIR transaction Bundles
+
+    Profiles are streamed into buffered files instead of one indented file each. A new file is started once the
+    current one reaches max_bytes or holds max_resources profiles; a profile is never split across files. On close,
+    an index of resource id -> (file, byte offset, byte length) is written next to the data so single profiles can be
+    read back without parsing whole files.
+
+    Use as a context manager, or call close() when done:
+
+        with BulkProfileWriter('copd_resources', prefix='copd') as sink:
+            writeLabProfile(..., sink=sink)
+    """
+
+    def __init__(self, output_dir, prefix='profiles', format='ndjson', max_bytes=None, max_resources=None,
+                 buffer_size=1 << 20):
+        """Keyword arguments:
+        output_dir -- directory the files and index are written to
+        prefix -- file name prefix, files are named '<prefix>-00000.ndjson' etc. (default 'profiles')
+        format -- 'ndjson' for one resource per line or 'bundle' for one transaction Bundle per file (default 'ndjson')
+        max_bytes -- start a new file once the current one reaches this size (default None, meaning no limit)
+        max_resources -- start a new file after this many profiles, e.g. to keep transactions small (default None)
+        buffer_size -- write buffer size in bytes (default 1 MiB)
+        """
+        import os
+
+        if format not in ('ndjson', 'bundle'):
+            raise ValueError("format must be 'ndjson' or 'bundle'")
+        os.makedirs(output_dir, exist_ok=True)
+
+        self.output_dir = output_dir
+        self.prefix = prefix
+        self.format = format
+        self.max_bytes = max_bytes
+        self.max_resources = max_resources
+        self.buffer_size = buffer_size
+
+        self.files = list()
+        self.index = dict()
+        self._outfile = None
+        self._writer = None
+        self._resources = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _open(self):
+        import os
+
+        extension = '.ndjson' if self.format == 'ndjson' else '.json'
+        filename = os.path.join(self.output_dir, '{}-{:05d}{}'.format(self.prefix, len(self.files), extension))
+        self.files.append(filename)
+        self._outfile = open(filename, 'wb', buffering=self.buffer_size)
+        self._writer = _CountingWriter(self._outfile)
+        self._resources = 0
+        if self.format == 'bundle':
+            self._writer.write('{"resourceType":"Bundle","type":"transaction","entry":[')
+
+    def _finish(self):
+        if self._outfile is None:
+            return
+        if self.format == 'bundle':
+            self._writer.write(']}')
+        self._outfile.close()
+        self._outfile = None
+
+    def writeProfile(self, resource, attribute, entries):
+        """Append one ClinicalProfile, streaming its entries
+
+        If building the entries fails part way, the file is cut back to where the profile started, so the profiles
+        already written stay readable. Raises ValueError if a profile with the same id was already written.
+
+        Keyword arguments:
+        resource -- ClinicalProfile JSON without its entries, including its id
+        attribute -- name of the entry list, e.g. 'lab'
+        entries -- iterable of entry JSON dicts
+
+        Returns the name of the file the profile was written to
+        """
+        import json
+        from profileJSON import dumpProfile
+
+        if resource['id'] in self.index:
+            raise ValueError('Profile {} was already written'.format(resource['id']))
+
+        full = (self._outfile is not None and
+                ((self.max_bytes is not None and self._writer.written >= self.max_bytes) or
+                 (self.max_resources is not None and self._resources >= self.max_resources)))
+        if full:
+            self._finish()
+        if self._outfile is None:
+            self._open()
+
+        start = self._writer.written
+        try:
+            if self.format == 'bundle':
+                if self._resources:
+                    self._writer.write(',')
+                self._writer.write('{"fullUrl":' + json.dumps('ClinicalProfile/' + resource['id']) + ',"resource":')
+
+            offset = self._writer.written
+            dumpProfile(resource, attribute, entries, self._writer, compact=True)
+        except BaseException:
+            # truncate() flushes the buffer first, so the half-written profile is removed from disk as well
+            self._outfile.truncate(start)
+            self._outfile.seek(start)
+            self._writer.written = start
+            raise
+        self.index[resource['id']] = (self.files[-1], offset, self._writer.written - offset)
+
+        if self.format == 'bundle':
+            self._writer.write(',"request":{"method":"PUT","url":' +
+                               json.dumps('ClinicalProfile/' + resource['id']) + '}}')
+        else:
+            self._writer.write('\n')
+        self._resources += 1
+
+        return self.files[-1]
+
+    def close(self):
+        """Finish the open file and write the index to '<prefix>.index.json'
+
+        Returns the name of the index file
+        """
+        import os
+        import json
+
+        self._finish()
+        indexFile = os.path.join(self.output_dir, self.prefix + '.index.json')
+        with open(indexFile + '.tmp', 'w') as outfile:
+            json.dump({'format': self.format,
+                       'files': [os.path.basename(filename) for filename in self.files],
+                       'resources': {resourceId: [os.path.basename(filename), offset, length]
+                                     for resourceId, (filename, offset, length) in self.index.items()}},
+                      outfile)
+        os.replace(indexFile + '.tmp', indexFile)
+        return indexFile
+
+
+def readBulkProfile(index_file, resource_id):
+    """Read one profile back from the output of BulkProfileWriter using its index
+
+    Keyword arguments:
+    index_file -- '<prefix>.index.json' written by BulkProfileWriter.close()
+    resource_id -- id of the profile, e.g. 'jh-labs-copd-Female-All-40-50'
+
+    Returns the ClinicalProfile JSON dict
+    """
+    import os
+    import json
+
+    with open(index_file) as infile:
+        index = json.load(infile)
+    filename, offset, length = index['resources'][resource_id]
+
+    with open(os.path.join(os.path.dirname(index_file), filename), 'rb') as infile:
+        infile.seek(offset)
+        return json.loads(infile.read(length))
@@ -1,4 +1,4 @@
-def calculateAnyProfile(profileType, df_labs, df_meds, df_procedures, df_diagnoses, df_phenotypes):
+def calculateAnyProfile(profileType, df_labs, df_meds, df_procedures, df_diagnoses, df_phenotypes, window=None, mode='time'):
     """Calculate a single profile based on the type provided and data cleaned from getSubdemographicsTables
     
     Arguments:
@@ -10,7 +10,14 @@ def calculateAnyProfile(profileType, df_labs, df_meds, df_procedures, df_diagnos
     df_medications -- medications dataframe returned from getSubdemographicsTables
     df_procedures -- procedures dataframe returned from getSubdemographicsTables
     df_diagnoses -- diagnoses dataframe returned from getSubdemographicsTables
-    df_phenotypes -- phenotypes dataframe returned from getSubdemographicsTables
+    df_phenotypes -- phenotypes dataframe returned from getSubdemographicsTables, or None; it is no longer read, as
+    phenotypes are derived from df_diagnoses through the ICD10 -> HPO index
+    window -- how close in time events of two domains must be to count as co-occurring: None for the same calendar
+    year, a number of days d for within d days either side, or a (start, end) pair of day offsets from the profile's
+    own event, e.g. (0, 30) for a medication started within 30 days after an abnormal lab (default None)
+    mode -- 'time' to link domains by patient and calendar year or window, 'encounter' to link labs, procedures,
+    diagnoses and phenotypes recorded in the same encounter (ENCOUNTERID); medications have no encounter and stay
+    linked by time (default 'time')
     
     Returns Pythonic structures needed to generate profile in JSON format using the corresponding write profile function
     """
@@ -24,9 +31,24 @@ def calculateAnyProfile(profileType, df_labs, df_meds, df_procedures, df_diagnos
     from dataclasses import dataclass
     from SciServer import Authentication
     from datetime import datetime
+    from hpoIndex import loadHPOIndex, phenotypePatientYearCounts
+    from coOccurrence import (EVENT_COLUMNS, checkOptions, encounterIndex, coOccurrenceEvents, phenotypeEvents,
+                              coOccurrence)
     import pymssql
+
+    # Checked up front, as the ValueError handler below only reports a bad profileType
+    checkOptions(window, mode)
     
     try:
+        if profileType in EVENT_COLUMNS:
+            # Each table is encoded once, with encounters mapped to shared integer ids, for all the pairs it is in
+            tables = {'labs': df_labs, 'medications': df_meds, 'procedures': df_procedures, 'diagnoses': df_diagnoses}
+            encounters = encounterIndex(*tables.values()) if mode == 'encounter' else None
+            events = {name: coOccurrenceEvents(df, name, encounters) for name, df in tables.items()}
+            # Phenotype events are expanded from the diagnoses through the sparse index, never as whole rows
+            icd10ToHPO = loadHPOIndex()
+            events['phenotypes'] = phenotypeEvents(df_diagnoses, icd10ToHPO, encounters)
+
         # Make Labs Profile
         if profileType == 'labs':
             # High Level Info, Scalar Distribution
@@ -68,151 +90,15 @@ def calculateAnyProfile(profileType, df_labs, df_meds, df_procedures, df_diagnos
 
             labs_abscorrelation = 0
 
-            ## LABS TO MEDICATIONS
-            def patientsAboveBelowNormalLabsMeds(x):
-                # Get patients above and below normal
-                patientsAboveNorm = x.PATID[x.RESULT_NUM > x.range_high].tolist()
-                patientsBelowNorm = x.PATID[x.RESULT_NUM < x.range_low].tolist()
-
-                # Get unique patient IDs for above & below normal
-                patientsAboveBelowNorm = list(set(patientsAboveNorm + patientsBelowNorm))
-
-                # Link to meds table
-                abnormalPatientsMeds = df_meds[df_meds.PATID.isin(patientsAboveBelowNorm) &
-                                             (df_meds.startYear == pd.to_datetime(x.RESULT_DATE).dt.year.unique()[0])]
-
-                return pd.Series({'medsAboveBelowNorm': abnormalPatientsMeds.JH_INGREDIENT_RXNORM_CODE.value_counts().index,
-                                 'counts': abnormalPatientsMeds.JH_INGREDIENT_RXNORM_CODE.value_counts().values})
-
-            # Need to grab the indices of those with abnormal lab, grab their medications, count and rank them 
-            labs_correlatedMedsCoefficients = (grouped_labs.apply(patientsAboveBelowNormalLabsMeds))
-
-            # Currently a little hacky, but seems fast
-            mytups = list()
-            multiIndex = list()
-
-            for lab in labs_correlatedMedsCoefficients.index:
-                thisLabYear = labs_correlatedMedsCoefficients.loc[lab]
-                thisLab = lab[0]
-                thisYear = lab[1]
-                totalCrossTab = np.sum(thisLabYear.counts)
-                for medInd in range(len(labs_correlatedMedsCoefficients.loc[lab].medsAboveBelowNorm.values)):
-                    mytups.append((thisLabYear.medsAboveBelowNorm.values[medInd], thisLabYear.counts[medInd]/totalCrossTab))
-                    multiIndex.append((thisLab, thisYear))
-
-            index = pd.MultiIndex.from_tuples(multiIndex)
-            labs_correlatedMedsCoefficients = (pd.DataFrame.from_records(mytups, columns=['JH_INGREDIENT_RXNORM_CODE','Relative_Counts'],
-                                                           index=index))
-
-            ## LABS TO PROCEDURES
-            def patientsAboveBelowNormalLabsProcs(x):
-                # Get patients above and below normal
-                patientsAboveNorm = x.PATID[x.RESULT_NUM > x.range_high].tolist()
-                patientsBelowNorm = x.PATID[x.RESULT_NUM < x.range_low].tolist()
-
-                # Get unique patient IDs for above & below normal
-                patientsAboveBelowNorm = list(set(patientsAboveNorm + patientsBelowNorm))
-
-                # Link to procs table
-                abnormalPatientsProcs = df_procedures[df_procedures.PATID.isin(patientsAboveBelowNorm) &
-                                             (df_procedures.encounterYear == pd.to_datetime(x.RESULT_DATE).dt.year.unique()[0])]
-
-                return pd.Series({'procsAboveBelowNorm': abnormalPatientsProcs.RAW_PX.value_counts().index,
-                                 'counts': abnormalPatientsProcs.RAW_PX.value_counts().values})
-
-            # Need to grab the indices of those with abnormal lab, grab their medications, count and rank them 
-            labs_correlatedProceduresCoefficients = (grouped_labs.apply(patientsAboveBelowNormalLabsProcs))
-
-            # Currently a little hacky, but seems fast
-            mytups = list()
-            multiIndex = list()
-
-            for lab in labs_correlatedProceduresCoefficients.index:
-                thisLabYear = labs_correlatedProceduresCoefficients.loc[lab]
-                thisLab = lab[0]
-                thisYear = lab[1]
-                totalCrossTab = np.sum(thisLabYear.counts)
-                for procInd in range(len(labs_correlatedProceduresCoefficients.loc[lab].procsAboveBelowNorm.values)):
-                    mytups.append((thisLabYear.procsAboveBelowNorm.values[procInd], thisLabYear.counts[procInd]/totalCrossTab))
-                    multiIndex.append((thisLab, thisYear))
-
-            index = pd.MultiIndex.from_tuples(multiIndex)    
-            labs_correlatedProceduresCoefficients = (pd.DataFrame.from_records(mytups, columns=['RAW_PX','Relative_Counts'],
-                                                                              index=index))
-
-            ## LABS TO DIAGNOSES
-            def patientsAboveBelowNormalLabsDiags(x):
-                # Get patients above and below normal
-                patientsAboveNorm = x.PATID[x.RESULT_NUM > x.range_high].tolist()
-                patientsBelowNorm = x.PATID[x.RESULT_NUM < x.range_low].tolist()
-
-                # Get unique patient IDs for above & below normal
-                patientsAboveBelowNorm = list(set(patientsAboveNorm + patientsBelowNorm))
-
-                # Link to procs table
-                abnormalPatientsDiags = df_diagnoses[df_diagnoses.PATID.isin(patientsAboveBelowNorm) &
-                                             (df_diagnoses.admitYear == pd.to_datetime(x.RESULT_DATE).dt.year.unique()[0])]
-
-                return pd.Series({'diagsAboveBelowNorm': abnormalPatientsDiags.DX.value_counts().index,
-                                 'counts': abnormalPatientsDiags.DX.value_counts().values})
-
-            # Need to grab the indices of those with abnormal lab, grab their medications, count and rank them 
-            labs_correlatedDiagnosisCoefficients = (grouped_labs.apply(patientsAboveBelowNormalLabsDiags))
-
-            # Currently a little hacky, but seems fast
-            mytups = list()
-            multiIndex = list()
-
-            for lab in labs_correlatedDiagnosisCoefficients.index:
-                thisLabYear = labs_correlatedDiagnosisCoefficients.loc[lab]
-                thisLab = lab[0]
-                thisYear = lab[1]
-                totalCrossTab = np.sum(thisLabYear.counts)
-                for diagInd in range(len(labs_correlatedDiagnosisCoefficients.loc[lab].diagsAboveBelowNorm.values)):
-                    mytups.append((thisLabYear.diagsAboveBelowNorm.values[diagInd], thisLabYear.counts[diagInd]/totalCrossTab))
-                    multiIndex.append((thisLab, thisYear))
-
-            index = pd.MultiIndex.from_tuples(multiIndex)
-
-            labs_correlatedDiagnosisCoefficients = (pd.DataFrame.from_records(mytups, columns=['DX','Relative_Counts'],
-                                                                             index=index))
-
-            ## LABS TO PHENOTYPES
-            def patientsAboveBelowNormalLabsHPOs(x):
-                # Get patients above and below normal
-                patientsAboveNorm = x.PATID[x.RESULT_NUM > x.range_high].tolist()
-                patientsBelowNorm = x.PATID[x.RESULT_NUM < x.range_low].tolist()
-
-                # Get unique patient IDs for above & below normal
-                patientsAboveBelowNorm = list(set(patientsAboveNorm + patientsBelowNorm))
-
-                # Link to procs table
-                abnormalPatientsHPOs = df_phenotypes[df_phenotypes.PATID.isin(patientsAboveBelowNorm) &
-                                             (df_phenotypes.admitYear == pd.to_datetime(x.RESULT_DATE).dt.year.unique()[0])]
-
-                return pd.Series({'hposAboveBelowNorm': abnormalPatientsHPOs.HPO.value_counts().index,
-                                 'counts': abnormalPatientsHPOs.HPO.value_counts().values})
-
-            # Need to grab the indices of those with abnormal lab, grab their medications, count and rank them 
-            labs_correlatedPhenotypesCoefficients = (grouped_labs.apply(patientsAboveBelowNormalLabsHPOs))
-
-            # Currently a little hacky, but seems fast
-            mytups = list()
-            multiIndex = list()
-
-            for lab in labs_correlatedPhenotypesCoefficients.index:
-                thisLabYear = labs_correlatedPhenotypesCoefficients.loc[lab]
-                thisLab = lab[0]
-                thisYear = lab[1]
-                totalCrossTab = np.sum(thisLabYear.counts)
-                for hpoInd in range(len(labs_correlatedPhenotypesCoefficients.loc[lab].hposAboveBelowNorm.values)):
-                    mytups.append((thisLabYear.hposAboveBelowNorm.values[hpoInd], thisLabYear.counts[hpoInd]/totalCrossTab))
-                    multiIndex.append((thisLab, thisYear))
-
-            index = pd.MultiIndex.from_tuples(multiIndex)
-
-            labs_correlatedPhenotypesCoefficients = (pd.DataFrame.from_records(mytups, columns=['HPO','Relative_Counts'],
-                                                                             index=index))
+            ## Labs outside the normal range, linked to the other domains
+            labs_correlatedMedsCoefficients = coOccurrence('labs', events['labs'], 'medications', events['medications'],
+                                                           window, mode)
+            labs_correlatedProceduresCoefficients = coOccurrence('labs', events['labs'], 'procedures', events['procedures'],
+                                                                 window, mode)
+            labs_correlatedDiagnosisCoefficients = coOccurrence('labs', events['labs'], 'diagnoses', events['diagnoses'],
+                                                                window, mode)
+            labs_correlatedPhenotypesCoefficients = coOccurrence('labs', events['labs'], 'phenotypes', events['phenotypes'],
+                                                                 window, mode)
 
             return (labs_counts, labs_frequencyPerYear, labs_fractionOfSubjects, labs_units, labs_names,
                    labs_stats, labs_aboveBelowNorm, labs_correlatedLabsCoefficients, labs_abscorrelation,
@@ -231,171 +117,17 @@ def calculateAnyProfile(profileType, df_labs, df_meds, df_procedures, df_diagnos
             meds_fractionOfSubjects = (np.divide(df_meds.groupby(['JH_INGREDIENT_RXNORM_CODE']).PATID.nunique(),
                                             df_meds.PATID.nunique()))
 
-            grouped_meds = df_meds.groupby(['JH_INGREDIENT_RXNORM_CODE', 'startYear'])
-
-            #meds_correlatedLabsCoefficients
-            def patientsAboveBelowNormalMedsLabs(x):
-
-                patientsWithThisRX = list(set(x.PATID.tolist()))
-
-                # Link to labs table
-                abnormalPatientsLabs = df_labs[(df_labs.PATID.isin(patientsWithThisRX)) & 
-                                               ((df_labs.RESULT_NUM > df_labs.range_high) | 
-                                                (df_labs.RESULT_NUM < df_labs.range_low)) &
-                                              (df_labs.resultYear == pd.to_datetime(x.RX_START_DATE).dt.year.unique()[0])]
-
-                return pd.Series({'labsAboveBelowNorm': abnormalPatientsLabs.LAB_LOINC.value_counts().index,
-                                 'counts': abnormalPatientsLabs.LAB_LOINC.value_counts().values})
-
-            meds_correlatedLabsCoefficients = (grouped_meds.apply(patientsAboveBelowNormalMedsLabs))
-
-            # Currently a little hacky, but seems fast
-            mytups = list()
-            multiIndex = list()
-
-            for med in meds_correlatedLabsCoefficients.index:
-                thisMedYear = meds_correlatedLabsCoefficients.loc[med]
-                thisMed = med[0]
-                thisYear = med[1]
-                totalCrossTab = np.sum(thisMedYear.counts)
-                for labInd in range(len(meds_correlatedLabsCoefficients.loc[med].labsAboveBelowNorm.values)):
-                    mytups.append((thisMedYear.labsAboveBelowNorm.values[labInd], thisMedYear.counts[labInd]/totalCrossTab))
-                    multiIndex.append((thisMed, thisYear))
-
-            index = pd.MultiIndex.from_tuples(multiIndex)
-
-            meds_correlatedLabsCoefficients = (pd.DataFrame.from_records(mytups, columns=['LAB_LOINC','Relative_Counts'],
-                                                                             index=index))
-
-            #meds_correlatedDiagsCoefficients
-            def patientsCrossFreqMedsDiags(x):
-
-                patientsWithThisRX = list(set(x.PATID.tolist()))
-
-                # Link to diagnoses table
-                commonPatientsDXs = df_diagnoses[(df_diagnoses.PATID.isin(patientsWithThisRX)) &
-                                              (df_diagnoses.admitYear == pd.to_datetime(x.RX_START_DATE).dt.year.unique()[0])]
-
-                return pd.Series({'diagsCrossFreq': commonPatientsDXs.DX.value_counts().index,
-                                 'counts': commonPatientsDXs.DX.value_counts().values})
-
-
-            meds_correlatedDiagsCoefficients = (grouped_meds.apply(patientsCrossFreqMedsDiags))
-
-            # Currently a little hacky, but seems fast
-            mytups = list()
-            multiIndex = list()
-
-            for med in meds_correlatedDiagsCoefficients.index:
-                thisMedYear = meds_correlatedDiagsCoefficients.loc[med]
-                thisMed = med[0]
-                thisYear = med[1]
-                totalCrossTab = np.sum(thisMedYear.counts)
-                for diagInd in range(len(meds_correlatedDiagsCoefficients.loc[med].diagsCrossFreq.values)):
-                    mytups.append((thisMedYear.diagsCrossFreq.values[diagInd], thisMedYear.counts[diagInd]/totalCrossTab))
-                    multiIndex.append((thisMed, thisYear))
-
-            index = pd.MultiIndex.from_tuples(multiIndex)
-
-            meds_correlatedDiagsCoefficients = (pd.DataFrame.from_records(mytups, columns=['DX','Relative_Counts'],
-                                                                             index=index))
-
-            #meds_correlatedMedsCoefficients
-            def patientsCrossFreqMedsMeds(x):
-
-                patientsWithThisRX = list(set(x.PATID.tolist()))
-
-                # Link to labs table
-                commonPatientsMeds = df_meds[(df_meds.PATID.isin(patientsWithThisRX)) &
-                                              (pd.to_datetime(df_meds.RX_START_DATE).dt.year == 
-                                               pd.to_datetime(x.RX_START_DATE).dt.year.unique()[0])]
-
-                return pd.Series({'medsCrossFreq': commonPatientsMeds.JH_INGREDIENT_RXNORM_CODE.value_counts().index,
-                                 'counts': commonPatientsMeds.JH_INGREDIENT_RXNORM_CODE.value_counts().values})
-
-
-            meds_correlatedMedsCoefficients = (grouped_meds.apply(patientsCrossFreqMedsMeds))
-
-            # Currently a little hacky, but seems fast
-
-            mytups = list()
-            multiIndex = list()
-
-            for med in meds_correlatedMedsCoefficients.index:
-                thisMedYear = meds_correlatedMedsCoefficients.loc[med]
-                thisMed = med[0]
-                thisYear = med[1]
-                totalCrossTab = np.sum(thisMedYear.counts)
-                for medInd in range(len(meds_correlatedMedsCoefficients.loc[med].medsCrossFreq.values)):
-                    mytups.append((thisMedYear.medsCrossFreq.values[medInd], thisMedYear.counts[medInd]/totalCrossTab))
-                    multiIndex.append((thisMed, thisYear))
-
-            index = pd.MultiIndex.from_tuples(multiIndex)
-
-            meds_correlatedMedsCoefficients = (pd.DataFrame.from_records(mytups, columns=['JH_INGREDIENT_RXNORM_CODE','Relative_Counts'],
-                                                                             index=index))
-
-            ## MEDS TO PROCEDURES
-            def patientsCrossFreqMedsProcs(x):
-
-                patientsWithThisRX = list(set(x.PATID.tolist()))
-
-                # Link to procs table
-                commonPatientsProcs = df_procedures[df_procedures.PATID.isin(patientsWithThisRX) &
-                                             (df_procedures.encounterYear == pd.to_datetime(x.RX_START_DATE).dt.year.unique()[0])]
-
-                return pd.Series({'procsCrossFreq': commonPatientsProcs.RAW_PX.value_counts().index,
-                                 'counts': commonPatientsProcs.RAW_PX.value_counts().values})
-
-            meds_correlatedProceduresCoefficients = (grouped_meds.apply(patientsCrossFreqMedsProcs))
-
-            # Currently a little hacky, but seems fast
-            mytups = list()
-            multiIndex = list()
-
-            for med in meds_correlatedProceduresCoefficients.index:
-                thisMedYear = meds_correlatedProceduresCoefficients.loc[med]
-                thisMed = med[0]
-                thisYear = med[1]
-                totalCrossTab = np.sum(thisMedYear.counts)
-                for procInd in range(len(meds_correlatedProceduresCoefficients.loc[med].procsCrossFreq.values)):
-                    mytups.append((thisMedYear.procsCrossFreq.values[procInd], thisMedYear.counts[procInd]/totalCrossTab))
-                    multiIndex.append((thisMed, thisYear))
-
-            index = pd.MultiIndex.from_tuples(multiIndex)    
-            meds_correlatedProceduresCoefficients = (pd.DataFrame.from_records(mytups, columns=['RAW_PX','Relative_Counts'],
-                                                                              index=index))
-
-            ## MEDS TO HPO
-            def patientsCrossFreqMedsHPOs(x):
-
-                patientsWithThisRX = list(set(x.PATID.tolist()))
-
-                # Link to hpo table
-                commonPatientsHPOs = df_phenotypes[(df_phenotypes.PATID.isin(patientsWithThisRX)) &
-                                              (df_phenotypes.admitYear == pd.to_datetime(x.RX_START_DATE).dt.year.unique()[0])]
-
-                return pd.Series({'hposCrossFreq': commonPatientsHPOs.HPO.value_counts().index,
-                                 'counts': commonPatientsHPOs.HPO.value_counts().values})
-
-            meds_correlatedPhenotypesCoefficients = (grouped_meds.apply(patientsCrossFreqMedsHPOs))
-
-            # Currently a little hacky, but seems fast
-            mytups = list()
-            multiIndex = list()
-
-            for med in meds_correlatedPhenotypesCoefficients.index:
-                thisMedYear = meds_correlatedPhenotypesCoefficients.loc[med]
-                thisMed = med[0]
-                thisYear = med[1]
-                totalCrossTab = np.sum(thisMedYear.counts)
-                for phenoInd in range(len(meds_correlatedPhenotypesCoefficients.loc[med].hposCrossFreq.values)):
-                    mytups.append((thisMedYear.hposCrossFreq.values[phenoInd], thisMedYear.counts[phenoInd]/totalCrossTab))
-                    multiIndex.append((thisMed, thisYear))
-
-            index = pd.MultiIndex.from_tuples(multiIndex)    
-            meds_correlatedPhenotypesCoefficients = (pd.DataFrame.from_records(mytups, columns=['HPO','Relative_Counts'],
-                                                                              index=index))
+            # Other domains co-occurring with each medication and year
+            meds_correlatedLabsCoefficients = coOccurrence('medications', events['medications'], 'labs', events['labs'],
+                                                           window, mode)
+            meds_correlatedDiagsCoefficients = coOccurrence('medications', events['medications'], 'diagnoses', events['diagnoses'],
+                                                            window, mode)
+            meds_correlatedMedsCoefficients = coOccurrence('medications', events['medications'], 'medications', events['medications'],
+                                                           window, mode)
+            meds_correlatedProceduresCoefficients = coOccurrence('medications', events['medications'], 'procedures', events['procedures'],
+                                                                 window, mode)
+            meds_correlatedPhenotypesCoefficients = coOccurrence('medications', events['medications'], 'phenotypes', events['phenotypes'],
+                                                                 window, mode)
 
             return (meds_medication, meds_dosageInfo, meds_frequencyPerYear, meds_fractionOfSubjects,
                     meds_correlatedLabsCoefficients, meds_correlatedDiagsCoefficients, meds_correlatedMedsCoefficients,
@@ -412,174 +144,17 @@ def calculateAnyProfile(profileType, df_labs, df_meds, df_procedures, df_diagnos
             procedures_fractionOfSubjects = (np.divide(df_procedures.groupby(['RAW_PX']).PATID.nunique(),
                                             df_procedures.PATID.nunique()))
 
-            grouped_procs = df_procedures.groupby(['RAW_PX', 'encounterYear'])
-
-            #procs_correlatedLabsCoefficients
-            def patientsAboveBelowNormalProcsLabs(x):
-
-                patientsWithThisProc = list(set(x.PATID.tolist()))
-
-                # Link to labs table
-                abnormalPatientsLabs = df_labs[(df_labs.PATID.isin(patientsWithThisProc)) & 
-                                               ((df_labs.RESULT_NUM > df_labs.range_high) | 
-                                                (df_labs.RESULT_NUM < df_labs.range_low)) &
-                                              (df_labs.resultYear == pd.to_datetime(x.PX_DATE).dt.year.unique()[0])]
-
-                return pd.Series({'labsAboveBelowNorm': abnormalPatientsLabs.LAB_LOINC.value_counts().index,
-                                 'counts': abnormalPatientsLabs.LAB_LOINC.value_counts().values})
-
-            procs_correlatedLabsCoefficients = (grouped_procs.apply(patientsAboveBelowNormalProcsLabs))
-
-            # Currently a little hacky, but seems fast
-            mytups = list()
-            multiIndex = list()
-
-            for proc in procs_correlatedLabsCoefficients.index:
-                thisProcYear = procs_correlatedLabsCoefficients.loc[proc]
-                thisProc = proc[0]
-                thisYear = proc[1]
-                totalCrossTab = np.sum(thisProcYear.counts)
-                for labInd in range(len(procs_correlatedLabsCoefficients.loc[proc].labsAboveBelowNorm.values)):
-                    mytups.append((thisProcYear.labsAboveBelowNorm.values[labInd], thisProcYear.counts[labInd]/totalCrossTab))
-                    multiIndex.append((thisProc, thisYear))
-
-            index = pd.MultiIndex.from_tuples(multiIndex)
-
-            procs_correlatedLabsCoefficients = (pd.DataFrame.from_records(mytups, columns=['LAB_LOINC','Relative_Counts'],
-                                                                             index=index))
-
-            #procs_correlatedDiagsCoefficients
-            def patientsCrossFreqProcsDiags(x):
-
-                patientsWithThisProc = list(set(x.PATID.tolist()))
-
-                # Link to diagnoses table
-                commonPatientsDXs = df_diagnoses[(df_diagnoses.PATID.isin(patientsWithThisProc)) &
-                                              (df_diagnoses.admitYear == pd.to_datetime(x.PX_DATE).dt.year.unique()[0])]
-
-                return pd.Series({'diagsCrossFreq': commonPatientsDXs.DX.value_counts().index,
-                                 'counts': commonPatientsDXs.DX.value_counts().values})
-
-
-            procs_correlatedDiagsCoefficients = (grouped_procs.apply(patientsCrossFreqProcsDiags))
-
-            # Currently a little hacky, but seems fast
-            mytups = list()
-            multiIndex = list()
-
-            for proc in procs_correlatedDiagsCoefficients.index:
-                thisProcYear = procs_correlatedDiagsCoefficients.loc[proc]
-                thisProc = proc[0]
-                thisYear = proc[1]
-                totalCrossTab = np.sum(thisProcYear.counts)
-                for diagInd in range(len(procs_correlatedDiagsCoefficients.loc[proc].diagsCrossFreq.values)):
-                    mytups.append((thisProcYear.diagsCrossFreq.values[diagInd], thisProcYear.counts[diagInd]/totalCrossTab))
-                    multiIndex.append((thisProc, thisYear))
-
-            index = pd.MultiIndex.from_tuples(multiIndex)
-
-            procs_correlatedDiagsCoefficients = (pd.DataFrame.from_records(mytups, columns=['DX','Relative_Counts'],
-                                                                             index=index))
-
-            #procs_correlatedMedsCoefficients
-            def patientsCrossFreqProcsMeds(x):
-
-                patientsWithThisProc = list(set(x.PATID.tolist()))
-
-                # Link to labs table
-                commonPatientsMeds = df_meds[(df_meds.PATID.isin(patientsWithThisProc)) &
-                                              (df_meds.startYear == pd.to_datetime(x.PX_DATE).dt.year.unique()[0])]
-
-                return pd.Series({'medsCrossFreq': commonPatientsMeds.JH_INGREDIENT_RXNORM_CODE.value_counts().index,
-                                 'counts': commonPatientsMeds.JH_INGREDIENT_RXNORM_CODE.value_counts().values})
-
-
-            procs_correlatedMedsCoefficients = (grouped_procs.apply(patientsCrossFreqProcsMeds))
-
-            # Currently a little hacky, but seems fast
-
-            mytups = list()
-            multiIndex = list()
-
-            for proc in procs_correlatedMedsCoefficients.index:
-                thisProcYear = procs_correlatedMedsCoefficients.loc[proc]
-                thisProc = proc[0]
-                thisYear = proc[1]
-                totalCrossTab = np.sum(thisProcYear.counts)
-                for medInd in range(len(procs_correlatedMedsCoefficients.loc[proc].medsCrossFreq.values)):
-                    mytups.append((thisProcYear.medsCrossFreq.values[medInd], thisProcYear.counts[medInd]/totalCrossTab))
-                    multiIndex.append((thisProc, thisYear))
-
-            index = pd.MultiIndex.from_tuples(multiIndex)
-
-            procs_correlatedMedsCoefficients = (pd.DataFrame.from_records(mytups, columns=['JH_INGREDIENT_RXNORM_CODE','Relative_Counts'],
-                                                                             index=index))
-
-
-            ## PROCEDURES TO PROCEDURES
-            def patientsCrossFreqProcsProcs(x):
-
-                patientsWithThisProc = list(set(x.PATID.tolist()))
-
-                # Link to procs table
-                commonPatientsProcs = df_procedures[df_procedures.PATID.isin(patientsWithThisProc) &
-                                             (df_procedures.encounterYear == pd.to_datetime(x.PX_DATE).dt.year.unique()[0])]
-
-                return pd.Series({'procsCrossFreq': commonPatientsProcs.RAW_PX.value_counts().index,
-                                 'counts': commonPatientsProcs.RAW_PX.value_counts().values})
-
-            procs_correlatedProceduresCoefficients = (grouped_procs.apply(patientsCrossFreqProcsProcs))
-
-            # Currently a little hacky, but seems fast
-            mytups = list()
-            multiIndex = list()
-
-            for proc in procs_correlatedProceduresCoefficients.index:
-                thisProcYear = procs_correlatedProceduresCoefficients.loc[proc]
-                thisProc = proc[0]
-                thisYear = proc[1]
-                totalCrossTab = np.sum(thisProcYear.counts)
-                for procInd in range(len(procs_correlatedProceduresCoefficients.loc[proc].procsCrossFreq.values)):
-                    mytups.append((thisProcYear.procsCrossFreq.values[procInd], thisProcYear.counts[procInd]/totalCrossTab))
-                    multiIndex.append((thisProc, thisYear))
-
-            index = pd.MultiIndex.from_tuples(multiIndex)    
-            procs_correlatedProceduresCoefficients = (pd.DataFrame.from_records(mytups, columns=['RAW_PX','Relative_Counts'],
-                                                                              index=index))
-
-            # procedures to hpo
-            def patientsCrossFreqProcsHPOs(x):
-
-                patientsWithThisProc = list(set(x.PATID.tolist()))
-
-                # Link to diagnoses table
-                commonPatientsHPOs = df_phenotypes[(df_phenotypes.PATID.isin(patientsWithThisProc)) &
-                                              (df_phenotypes.admitYear == pd.to_datetime(x.PX_DATE).dt.year.unique()[0])]
-
-                return pd.Series({'hposCrossFreq': commonPatientsHPOs.HPO.value_counts().index,
-                                 'counts': commonPatientsHPOs.HPO.value_counts().values})
-
-
-            procs_correlatedPhenotypesCoefficients = (grouped_procs.apply(patientsCrossFreqProcsHPOs))
-
-            # Currently a little hacky, but seems fast
-            mytups = list()
-            multiIndex = list()
-
-            for proc in procs_correlatedPhenotypesCoefficients.index:
-                thisProcYear = procs_correlatedPhenotypesCoefficients.loc[proc]
-                thisProc = proc[0]
-                thisYear = proc[1]
-                totalCrossTab = np.sum(thisProcYear.counts)
-                for phenoInd in range(len(procs_correlatedPhenotypesCoefficients.loc[proc].hposCrossFreq.values)):
-                    mytups.append((thisProcYear.hposCrossFreq.values[phenoInd], thisProcYear.counts[phenoInd]/totalCrossTab))
-                    multiIndex.append((thisProc, thisYear))
-
-            index = pd.MultiIndex.from_tuples(multiIndex)
-
-            procs_correlatedPhenotypesCoefficients = (pd.DataFrame.from_records(mytups, columns=['HPO','Relative_Counts'],
-                                                                             index=index))
-
+            # Other domains co-occurring with each procedure and year
+            procs_correlatedLabsCoefficients = coOccurrence('procedures', events['procedures'], 'labs', events['labs'],
+                                                            window, mode)
+            procs_correlatedDiagsCoefficients = coOccurrence('procedures', events['procedures'], 'diagnoses', events['diagnoses'],
+                                                             window, mode)
+            procs_correlatedMedsCoefficients = coOccurrence('procedures', events['procedures'], 'medications', events['medications'],
+                                                            window, mode)
+            procs_correlatedProceduresCoefficients = coOccurrence('procedures', events['procedures'], 'procedures', events['procedures'],
+                                                                  window, mode)
+            procs_correlatedPhenotypesCoefficients = coOccurrence('procedures', events['procedures'], 'phenotypes', events['phenotypes'],
+                                                                  window, mode)
 
             return (procedures_code, procedures_count, procedures_frequencyPerYear, procedures_fractionOfSubjects,
                     procs_correlatedLabsCoefficients, procs_correlatedDiagsCoefficients, procs_correlatedMedsCoefficients,
@@ -597,173 +172,17 @@ def calculateAnyProfile(profileType, df_labs, df_meds, df_procedures, df_diagnos
             diagnoses_fractionOfSubjects = (np.divide(df_diagnoses.groupby(['DX']).PATID.nunique(),
                                             df_diagnoses.PATID.nunique()))
 
-            grouped_diags = df_diagnoses.groupby(['DX','admitYear'])
-
-            #diags_correlatedLabsCoefficients
-            def patientsAboveBelowNormalDiagsLabs(x):
-
-                patientsWithThisDiag = list(set(x.PATID.tolist()))
-
-                # Link to labs table
-                abnormalPatientsLabs = df_labs[(df_labs.PATID.isin(patientsWithThisDiag)) & 
-                                               ((df_labs.RESULT_NUM > df_labs.range_high) | 
-                                                (df_labs.RESULT_NUM < df_labs.range_low)) &
-                                              (df_labs.resultYear == pd.to_datetime(x.ADMIT_DATE).dt.year.unique()[0])]
-
-                return pd.Series({'labsAboveBelowNorm': abnormalPatientsLabs.LAB_LOINC.value_counts().index,
-                                 'counts': abnormalPatientsLabs.LAB_LOINC.value_counts().values})
-
-            diags_correlatedLabsCoefficients = (grouped_diags.apply(patientsAboveBelowNormalDiagsLabs))
-
-            # Currently a little hacky, but seems fast
-            mytups = list()
-            multiIndex = list()
-
-            for diag in diags_correlatedLabsCoefficients.index:
-                thisDiagYear = diags_correlatedLabsCoefficients.loc[diag]
-                thisDiag = diag[0]
-                thisYear = diag[1]
-                totalCrossTab = np.sum(thisDiagYear.counts)
-                for labInd in range(len(diags_correlatedLabsCoefficients.loc[diag].labsAboveBelowNorm.values)):
-                    mytups.append((thisDiagYear.labsAboveBelowNorm.values[labInd], thisDiagYear.counts[labInd]/totalCrossTab))
-                    multiIndex.append((thisDiag, thisYear))
-
-            index = pd.MultiIndex.from_tuples(multiIndex)
-
-            diags_correlatedLabsCoefficients = (pd.DataFrame.from_records(mytups, columns=['LAB_LOINC','Relative_Counts'],
-                                                                             index=index))
-
-            #diags_correlatedDiagsCoefficients
-            def patientsCrossFreqDiagsDiags(x):
-
-                patientsWithThisDiag = list(set(x.PATID.tolist()))
-
-                # Link to diagnoses table
-                commonPatientsDXs = df_diagnoses[(df_diagnoses.PATID.isin(patientsWithThisDiag)) &
-                                              (df_diagnoses.admitYear == pd.to_datetime(x.ADMIT_DATE).dt.year.unique()[0])]
-
-                return pd.Series({'diagsCrossFreq': commonPatientsDXs.DX.value_counts().index,
-                                 'counts': commonPatientsDXs.DX.value_counts().values})
-
-
-            diags_correlatedDiagsCoefficients = (grouped_diags.apply(patientsCrossFreqDiagsDiags))
-
-            # Currently a little hacky, but seems fast
-            mytups = list()
-            multiIndex = list()
-
-            for diag in diags_correlatedDiagsCoefficients.index:
-                thisDiagYear = diags_correlatedDiagsCoefficients.loc[diag]
-                thisDiag = diag[0]
-                thisYear = diag[1]
-                totalCrossTab = np.sum(thisDiagYear.counts)
-                for diagInd in range(len(diags_correlatedDiagsCoefficients.loc[diag].diagsCrossFreq.values)):
-                    mytups.append((thisDiagYear.diagsCrossFreq.values[diagInd], thisDiagYear.counts[diagInd]/totalCrossTab))
-                    multiIndex.append((thisDiag, thisYear))
-
-            index = pd.MultiIndex.from_tuples(multiIndex)
-
-            diags_correlatedDiagsCoefficients = (pd.DataFrame.from_records(mytups, columns=['DX','Relative_Counts'],
-                                                                             index=index))
-
-            #diags_correlatedMedsCoefficients
-            def patientsCrossFreqDiagsMeds(x):
-
-                patientsWithThisDiag = list(set(x.PATID.tolist()))
-
-                # Link to labs table
-                commonPatientsMeds = df_meds[(df_meds.PATID.isin(patientsWithThisDiag)) &
-                                              (df_meds.startYear == pd.to_datetime(x.ADMIT_DATE).dt.year.unique()[0])]
-
-                return pd.Series({'medsCrossFreq': commonPatientsMeds.JH_INGREDIENT_RXNORM_CODE.value_counts().index,
-                                 'counts': commonPatientsMeds.JH_INGREDIENT_RXNORM_CODE.value_counts().values})
-
-
-            diags_correlatedMedsCoefficients = (grouped_diags.apply(patientsCrossFreqDiagsMeds))
-
-            # Currently a little hacky, but seems fast
-
-            mytups = list()
-            multiIndex = list()
-
-            for diag in diags_correlatedMedsCoefficients.index:
-                thisDiagYear = diags_correlatedMedsCoefficients.loc[diag]
-                thisDiag = diag[0]
-                thisYear = diag[1]
-                totalCrossTab = np.sum(thisDiagYear.counts)
-                for medInd in range(len(diags_correlatedMedsCoefficients.loc[diag].medsCrossFreq.values)):
-                    mytups.append((thisDiagYear.medsCrossFreq.values[medInd], thisDiagYear.counts[medInd]/totalCrossTab))
-                    multiIndex.append((thisDiag, thisYear))
-
-            index = pd.MultiIndex.from_tuples(multiIndex)
-
-            diags_correlatedMedsCoefficients = (pd.DataFrame.from_records(mytups, columns=['JH_INGREDIENT_RXNORM_CODE','Relative_Counts'],
-                                                                             index=index))
-
-
-            ## DIAGNOSES TO PROCEDURES
-            def patientsCrossFreqDiagsProcs(x):
-
-                patientsWithThisDiag = list(set(x.PATID.tolist()))
-
-                # Link to procs table
-                commonPatientsProcs = df_procedures[df_procedures.PATID.isin(patientsWithThisDiag) &
-                                             (df_procedures.encounterYear == pd.to_datetime(x.ADMIT_DATE).dt.year.unique()[0])]
-
-                return pd.Series({'procsCrossFreq': commonPatientsProcs.RAW_PX.value_counts().index,
-                                 'counts': commonPatientsProcs.RAW_PX.value_counts().values})
-
-            diags_correlatedProceduresCoefficients = (grouped_diags.apply(patientsCrossFreqDiagsProcs))
-
-            # Currently a little hacky, but seems fast
-            mytups = list()
-            multiIndex = list()
-
-            for diag in diags_correlatedProceduresCoefficients.index:
-                thisDiagYear = diags_correlatedProceduresCoefficients.loc[diag]
-                thisDiag = diag[0]
-                thisYear = diag[1]
-                totalCrossTab = np.sum(thisDiagYear.counts)
-                for procInd in range(len(diags_correlatedProceduresCoefficients.loc[diag].procsCrossFreq.values)):
-                    mytups.append((thisDiagYear.procsCrossFreq.values[procInd], thisDiagYear.counts[procInd]/totalCrossTab))
-                    multiIndex.append((thisDiag, thisYear))
-
-            index = pd.MultiIndex.from_tuples(multiIndex)    
-            diags_correlatedProceduresCoefficients = (pd.DataFrame.from_records(mytups, columns=['RAW_PX','Relative_Counts'],
-                                                                              index=index))
-
-            #diags_correlatedPhenotypesCoefficients
-            def patientsCrossFreqDiagsHPOs(x):
-
-                patientsWithThisDiag = list(set(x.PATID.tolist()))
-
-                # Link to diagnoses table
-                commonPatientsHPOs = df_phenotypes[(df_phenotypes.PATID.isin(patientsWithThisDiag)) &
-                                              (df_phenotypes.admitYear == pd.to_datetime(x.ADMIT_DATE).dt.year.unique()[0])]
-
-                return pd.Series({'hposCrossFreq': commonPatientsHPOs.HPO.value_counts().index,
-                                 'counts': commonPatientsHPOs.HPO.value_counts().values})
-
-
-            diags_correlatedPhenotypesCoefficients = (grouped_diags.apply(patientsCrossFreqDiagsHPOs))
-
-            # Currently a little hacky, but seems fast
-            mytups = list()
-            multiIndex = list()
-
-            for diag in diags_correlatedPhenotypesCoefficients.index:
-                thisDiagYear = diags_correlatedPhenotypesCoefficients.loc[diag]
-                thisDiag = diag[0]
-                thisYear = diag[1]
-                totalCrossTab = np.sum(thisDiagYear.counts)
-                for phenoInd in range(len(diags_correlatedPhenotypesCoefficients.loc[diag].hposCrossFreq.values)):
-                    mytups.append((thisDiagYear.hposCrossFreq.values[phenoInd], thisDiagYear.counts[phenoInd]/totalCrossTab))
-                    multiIndex.append((thisDiag, thisYear))
-
-            index = pd.MultiIndex.from_tuples(multiIndex)
-
-            diags_correlatedPhenotypesCoefficients = (pd.DataFrame.from_records(mytups, columns=['HPO','Relative_Counts'],
-                                                                             index=index))
+            # Other domains co-occurring with each diagnosis and year
+            diags_correlatedLabsCoefficients = coOccurrence('diagnoses', events['diagnoses'], 'labs', events['labs'],
+                                                            window, mode)
+            diags_correlatedDiagsCoefficients = coOccurrence('diagnoses', events['diagnoses'], 'diagnoses', events['diagnoses'],
+                                                             window, mode)
+            diags_correlatedMedsCoefficients = coOccurrence('diagnoses', events['diagnoses'], 'medications', events['medications'],
+                                                            window, mode)
+            diags_correlatedProceduresCoefficients = coOccurrence('diagnoses', events['diagnoses'], 'procedures', events['procedures'],
+                                                                  window, mode)
+            diags_correlatedPhenotypesCoefficients = coOccurrence('diagnoses', events['diagnoses'], 'phenotypes', events['phenotypes'],
+                                                                  window, mode)
 
             return (diagnoses_code, diagnoses_count, diagnoses_frequencyPerYear, diagnoses_fractionOfSubjects,
                     diags_correlatedLabsCoefficients, diags_correlatedDiagsCoefficients, diags_correlatedMedsCoefficients,
@@ -771,183 +190,29 @@ def calculateAnyProfile(profileType, df_labs, df_meds, df_procedures, df_diagnos
         
         # Make Phenotypes Profile
         elif profileType == 'phenotypes':
-            phenotypes_code = df_phenotypes.HPO.unique()
-
-            phenotypes_count = df_phenotypes.HPO.value_counts()
-
-            phenotypes_frequencyPerYear = (df_phenotypes.groupby(['HPO','admitYear','PATID']).PATID
-                                .count().groupby(['HPO','admitYear']).mean())
-
-            phenotypes_fractionOfSubjects = (np.divide(df_phenotypes.groupby(['HPO']).PATID.nunique(),
-                                            df_phenotypes.PATID.nunique()))
-
-            grouped_phenotypes = df_phenotypes.groupby(['HPO','admitYear'])
-
-            #diags_correlatedLabsCoefficients
-            def patientsAboveBelowNormalDiagsLabs(x):
-
-                patientsWithThisDiag = list(set(x.PATID.tolist()))
-
-                # Link to labs table
-                abnormalPatientsLabs = df_labs[(df_labs.PATID.isin(patientsWithThisDiag)) & 
-                                               ((df_labs.RESULT_NUM > df_labs.range_high) | 
-                                                (df_labs.RESULT_NUM < df_labs.range_low)) &
-                                              (df_labs.resultYear == pd.to_datetime(x.ADMIT_DATE).dt.year.unique()[0])]
-
-                return pd.Series({'labsAboveBelowNorm': abnormalPatientsLabs.LAB_LOINC.value_counts().index,
-                                 'counts': abnormalPatientsLabs.LAB_LOINC.value_counts().values})
-
-            phenos_correlatedLabsCoefficients = (grouped_phenotypes.apply(patientsAboveBelowNormalDiagsLabs))
-
-            # Currently a little hacky, but seems fast
-            mytups = list()
-            multiIndex = list()
-
-            for diag in phenos_correlatedLabsCoefficients.index:
-                thisDiagYear = phenos_correlatedLabsCoefficients.loc[diag]
-                thisDiag = diag[0]
-                thisYear = diag[1]
-                totalCrossTab = np.sum(thisDiagYear.counts)
-                for labInd in range(len(phenos_correlatedLabsCoefficients.loc[diag].labsAboveBelowNorm.values)):
-                    mytups.append((thisDiagYear.labsAboveBelowNorm.values[labInd], thisDiagYear.counts[labInd]/totalCrossTab))
-                    multiIndex.append((thisDiag, thisYear))
-
-            index = pd.MultiIndex.from_tuples(multiIndex)
-
-            phenos_correlatedLabsCoefficients = (pd.DataFrame.from_records(mytups, columns=['LAB_LOINC','Relative_Counts'],
-                                                                             index=index))
-
-            #diags_correlatedDiagsCoefficients
-            def patientsCrossFreqDiagsDiags(x):
-
-                patientsWithThisDiag = list(set(x.PATID.tolist()))
-
-                # Link to diagnoses table
-                commonPatientsDXs = df_diagnoses[(df_diagnoses.PATID.isin(patientsWithThisDiag)) &
-                                              (df_diagnoses.admitYear == pd.to_datetime(x.ADMIT_DATE).dt.year.unique()[0])]
-
-                return pd.Series({'diagsCrossFreq': commonPatientsDXs.DX.value_counts().index,
-                                 'counts': commonPatientsDXs.DX.value_counts().values})
-
-
-            phenos_correlatedDiagsCoefficients = (grouped_phenotypes.apply(patientsCrossFreqDiagsDiags))
-
-            # Currently a little hacky, but seems fast
-            mytups = list()
-            multiIndex = list()
-
-            for diag in phenos_correlatedDiagsCoefficients.index:
-                thisDiagYear = phenos_correlatedDiagsCoefficients.loc[diag]
-                thisDiag = diag[0]
-                thisYear = diag[1]
-                totalCrossTab = np.sum(thisDiagYear.counts)
-                for diagInd in range(len(phenos_correlatedDiagsCoefficients.loc[diag].diagsCrossFreq.values)):
-                    mytups.append((thisDiagYear.diagsCrossFreq.values[diagInd], thisDiagYear.counts[diagInd]/totalCrossTab))
-                    multiIndex.append((thisDiag, thisYear))
-
-            index = pd.MultiIndex.from_tuples(multiIndex)
-
-            phenos_correlatedDiagsCoefficients = (pd.DataFrame.from_records(mytups, columns=['DX','Relative_Counts'],
-                                                                             index=index))
-
-            #diags_correlatedMedsCoefficients
-            def patientsCrossFreqDiagsMeds(x):
-
-                patientsWithThisDiag = list(set(x.PATID.tolist()))
-
-                # Link to labs table
-                commonPatientsMeds = df_meds[(df_meds.PATID.isin(patientsWithThisDiag)) &
-                                              (df_meds.startYear == pd.to_datetime(x.ADMIT_DATE).dt.year.unique()[0])]
-
-                return pd.Series({'medsCrossFreq': commonPatientsMeds.JH_INGREDIENT_RXNORM_CODE.value_counts().index,
-                                 'counts': commonPatientsMeds.JH_INGREDIENT_RXNORM_CODE.value_counts().values})
-
-
-            phenos_correlatedMedsCoefficients = (grouped_phenotypes.apply(patientsCrossFreqDiagsMeds))
-
-            # Currently a little hacky, but seems fast
-
-            mytups = list()
-            multiIndex = list()
-
-            for diag in phenos_correlatedMedsCoefficients.index:
-                thisDiagYear = phenos_correlatedMedsCoefficients.loc[diag]
-                thisDiag = diag[0]
-                thisYear = diag[1]
-                totalCrossTab = np.sum(thisDiagYear.counts)
-                for medInd in range(len(phenos_correlatedMedsCoefficients.loc[diag].medsCrossFreq.values)):
-                    mytups.append((thisDiagYear.medsCrossFreq.values[medInd], thisDiagYear.counts[medInd]/totalCrossTab))
-                    multiIndex.append((thisDiag, thisYear))
-
-            index = pd.MultiIndex.from_tuples(multiIndex)
-
-            phenos_correlatedMedsCoefficients = (pd.DataFrame.from_records(mytups, columns=['JH_INGREDIENT_RXNORM_CODE','Relative_Counts'],
-                                                                             index=index))
-
-
-            ## DIAGNOSES TO PROCEDURES
-            def patientsCrossFreqDiagsProcs(x):
-
-                patientsWithThisDiag = list(set(x.PATID.tolist()))
-
-                # Link to procs table
-                commonPatientsProcs = df_procedures[df_procedures.PATID.isin(patientsWithThisDiag) &
-                                             (df_procedures.encounterYear == pd.to_datetime(x.ADMIT_DATE).dt.year.unique()[0])]
-
-                return pd.Series({'procsCrossFreq': commonPatientsProcs.RAW_PX.value_counts().index,
-                                 'counts': commonPatientsProcs.RAW_PX.value_counts().values})
-
-            phenos_correlatedProceduresCoefficients = (grouped_phenotypes.apply(patientsCrossFreqDiagsProcs))
-
-            # Currently a little hacky, but seems fast
-            mytups = list()
-            multiIndex = list()
-
-            for diag in phenos_correlatedProceduresCoefficients.index:
-                thisDiagYear = phenos_correlatedProceduresCoefficients.loc[diag]
-                thisDiag = diag[0]
-                thisYear = diag[1]
-                totalCrossTab = np.sum(thisDiagYear.counts)
-                for procInd in range(len(phenos_correlatedProceduresCoefficients.loc[diag].procsCrossFreq.values)):
-                    mytups.append((thisDiagYear.procsCrossFreq.values[procInd], thisDiagYear.counts[procInd]/totalCrossTab))
-                    multiIndex.append((thisDiag, thisYear))
-
-            index = pd.MultiIndex.from_tuples(multiIndex)    
-            phenos_correlatedProceduresCoefficients = (pd.DataFrame.from_records(mytups, columns=['RAW_PX','Relative_Counts'],
-                                                                              index=index))
-
-            #diags_correlatedPhenotypesCoefficients
-            def patientsCrossFreqDiagsHPOs(x):
-
-                patientsWithThisDiag = list(set(x.PATID.tolist()))
-
-                # Link to diagnoses table
-                commonPatientsHPOs = df_phenotypes[(df_phenotypes.PATID.isin(patientsWithThisDiag)) &
-                                              (df_phenotypes.admitYear == pd.to_datetime(x.ADMIT_DATE).dt.year.unique()[0])]
-
-                return pd.Series({'hposCrossFreq': commonPatientsHPOs.HPO.value_counts().index,
-                                 'counts': commonPatientsHPOs.HPO.value_counts().values})
-
+            # Patient-year HPO counts come from the sparse ICD10 -> HPO product instead of the expanded phenotype rows
+            df_phenotypeCounts = phenotypePatientYearCounts(df_diagnoses, icd10ToHPO)
 
-            phenos_correlatedPhenotypesCoefficients = (grouped_phenotypes.apply(patientsCrossFreqDiagsHPOs))
+            phenotypes_code = df_phenotypeCounts.HPO.unique()
 
-            # Currently a little hacky, but seems fast
-            mytups = list()
-            multiIndex = list()
+            phenotypes_count = df_phenotypeCounts.groupby('HPO')['count'].sum().sort_values(ascending=False)
 
-            for diag in phenos_correlatedPhenotypesCoefficients.index:
-                thisDiagYear = phenos_correlatedPhenotypesCoefficients.loc[diag]
-                thisDiag = diag[0]
-                thisYear = diag[1]
-                totalCrossTab = np.sum(thisDiagYear.counts)
-                for phenoInd in range(len(phenos_correlatedPhenotypesCoefficients.loc[diag].hposCrossFreq.values)):
-                    mytups.append((thisDiagYear.hposCrossFreq.values[phenoInd], thisDiagYear.counts[phenoInd]/totalCrossTab))
-                    multiIndex.append((thisDiag, thisYear))
+            phenotypes_frequencyPerYear = df_phenotypeCounts.groupby(['HPO','admitYear'])['count'].mean()
 
-            index = pd.MultiIndex.from_tuples(multiIndex)
+            phenotypes_fractionOfSubjects = (np.divide(df_phenotypeCounts.groupby(['HPO']).PATID.nunique(),
+                                            df_phenotypeCounts.PATID.nunique()))
 
-            phenos_correlatedPhenotypesCoefficients = (pd.DataFrame.from_records(mytups, columns=['HPO','Relative_Counts'],
-                                                                             index=index))
+            # Other domains co-occurring with each phenotype and year
+            phenos_correlatedLabsCoefficients = coOccurrence('phenotypes', events['phenotypes'], 'labs', events['labs'],
+                                                             window, mode)
+            phenos_correlatedDiagsCoefficients = coOccurrence('phenotypes', events['phenotypes'], 'diagnoses', events['diagnoses'],
+                                                              window, mode)
+            phenos_correlatedMedsCoefficients = coOccurrence('phenotypes', events['phenotypes'], 'medications', events['medications'],
+                                                             window, mode)
+            phenos_correlatedProceduresCoefficients = coOccurrence('phenotypes', events['phenotypes'], 'procedures', events['procedures'],
+                                                                   window, mode)
+            phenos_correlatedPhenotypesCoefficients = coOccurrence('phenotypes', events['phenotypes'], 'phenotypes', events['phenotypes'],
+                                                                   window, mode)
 
             return (phenotypes_code, phenotypes_count, phenotypes_frequencyPerYear, phenotypes_fractionOfSubjects,
                     phenos_correlatedLabsCoefficients, phenos_correlatedDiagsCoefficients, phenos_correlatedMedsCoefficients,
@@ -0,0 +1,218 @@
+# Per profile type: code column, event date column and the year column derived from it by getSubdemographicsTables
+EVENT_COLUMNS = {'labs': ('LAB_LOINC', 'RESULT_DATE', 'resultYear'),
+                 'medications': ('JH_INGREDIENT_RXNORM_CODE', 'RX_START_DATE', 'startYear'),
+                 'procedures': ('RAW_PX', 'PX_DATE', 'encounterYear'),
+                 'diagnoses': ('DX', 'ADMIT_DATE', 'admitYear'),
+                 'phenotypes': ('HPO', 'ADMIT_DATE', 'admitYear')}
+# Day number events without a date get (NaT as int64); they never fall in a day window
+MISSING_DAY = -2 ** 63
+
+
+def encounterIndex(*tables):
+    """Shared index of the ENCOUNTERIDs of several tables, so encounters become the same integer in every table
+
+    Keyword arguments:
+    tables -- dataframes from getSubdemographicsTables; tables without ENCOUNTERID (medications) are skipped
+
+    Returns pandas Index of encounter ids
+    """
+    import pandas as pd
+
+    ids = [df.ENCOUNTERID.dropna() for df in tables if 'ENCOUNTERID' in df.columns]
+    if not ids:
+        return pd.Index([])
+    return pd.Index(pd.unique(pd.concat(ids, ignore_index=True)))
+
+
+def coOccurrenceEvents(df, profileType, encounters=None):
+    """Reduce a table from getSubdemographicsTables to the integer-coded events co-occurrence works on
+
+    Labs only take part through their results outside the normal range, as in the profile correlations.
+
+    Keyword arguments:
+    df -- labs, medications, procedures, diagnoses or phenotypes dataframe
+    profileType -- 'labs', 'medications', 'procedures', 'diagnoses' or 'phenotypes'
+    encounters -- index from encounterIndex; when given, tables with ENCOUNTERID get an integer encounter column
+    (-1 for events without an encounter) (default None)
+
+    Returns (events, codes): dataframe of integer PATID, code, year and day (days since the epoch, MISSING_DAY without
+    a date) columns, and the array of codes the code column indexes into
+    """
+    import numpy as np
+    import pandas as pd
+
+    codeColumn, dateColumn, yearColumn = EVENT_COLUMNS[profileType]
+    if profileType == 'labs':
+        df = df[(df.RESULT_NUM > df.range_high) | (df.RESULT_NUM < df.range_low)]
+    df = df[df[codeColumn].notna()]
+
+    code, codes = pd.factorize(df[codeColumn], sort=True)
+    days = pd.to_datetime(df[dateColumn]).to_numpy(dtype='datetime64[D]').astype('int64')
+    events = pd.DataFrame({'PATID': df.PATID.to_numpy(), 'code': code.astype('int32'),
+                           'year': df[yearColumn].to_numpy(), 'day': days})
+    if encounters is not None and 'ENCOUNTERID' in df.columns:
+        events['encounter'] = encounters.get_indexer(df.ENCOUNTERID)
+    return events, np.asarray(codes)
+
+
+def phenotypeEvents(df_diagnoses, index, encounters=None):
+    """Build the phenotype events straight from the diagnoses and the ICD10 -> HPO index
+
+    Gives the events coOccurrenceEvents builds from the expanded phenotype table without building that table: only
+    the integer event columns are repeated for each HPO term of a diagnosis.
+
+    Keyword arguments:
+    df_diagnoses -- diagnoses dataframe from getSubdemographicsTables
+    index -- ICD10 -> HPO index from hpoIndex.loadHPOIndex
+    encounters -- index from encounterIndex (default None)
+
+    Returns (events, codes) as coOccurrenceEvents
+    """
+    import numpy as np
+    import pandas as pd
+    from hpoIndex import expandICD10
+
+    positions, terms = expandICD10(df_diagnoses.DX, index)
+    # HPO codes are sorted in the index, so sorted columns give the codes in the order factorize(sort=True) would
+    columns, code = np.unique(terms, return_inverse=True)
+
+    # Event columns are taken per diagnosis and then repeated, never whole diagnosis rows
+    days = pd.to_datetime(df_diagnoses.ADMIT_DATE).to_numpy(dtype='datetime64[D]').astype('int64')
+    events = pd.DataFrame({'PATID': df_diagnoses.PATID.to_numpy()[positions], 'code': code.astype('int32'),
+                           'year': df_diagnoses.admitYear.to_numpy()[positions], 'day': days[positions]})
+    if encounters is not None and 'ENCOUNTERID' in df_diagnoses.columns:
+        events['encounter'] = encounters.get_indexer(df_diagnoses.ENCOUNTERID)[positions]
+    return events, np.asarray(index['hpo'])[columns]
+
+
+def _windowPairs(source, target, window):
+    """Pair each source event with every target event of the same patient inside the day window
+
+    Both sides are sorted by (patient, day) and packed into a single int64 key, so each source event finds its run of
+    target events with two binary searches; the work is linear in the number of events plus pairs found.
+
+    Returns (source positions, target positions) arrays
+    """
+    import numpy as np
+
+    start, end = window
+    patients, patientIndex = np.unique(np.concatenate([source.PATID.to_numpy(), target.PATID.to_numpy()]),
+                                       return_inverse=True)
+    sourcePatient, targetPatient = patientIndex[:len(source)], patientIndex[len(source):]
+
+    # Days are shifted to start at 0 and patients spaced far enough apart that no window reaches the next patient
+    first = min(source.day.min(), target.day.min())
+    span = max(source.day.max(), target.day.max()) - first + abs(start) + abs(end) + 1
+    sourceDay = source.day.to_numpy() - first
+    targetKey = targetPatient.astype('int64') * span + (target.day.to_numpy() - first)
+
+    order = np.argsort(targetKey, kind='stable')
+    targetKey = targetKey[order]
+    sourceBase = sourcePatient.astype('int64') * span
+    low = np.searchsorted(targetKey, sourceBase + np.maximum(sourceDay + start, 0), side='left')
+    high = np.searchsorted(targetKey, sourceBase + np.minimum(sourceDay + end, span - 1), side='right')
+
+    # Expand every [low, high) run into explicit pairs
+    lengths = np.maximum(high - low, 0)
+    sourcePositions = np.repeat(np.arange(len(source)), lengths)
+    offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    targetPositions = order[np.repeat(low, lengths) + offsets]
+    return sourcePositions, targetPositions
+
+
+def checkOptions(window=None, mode='time'):
+    """Raise ValueError unless window and mode are ones coOccurrence accepts
+
+    Keyword arguments:
+    window -- None, a number of days, or a (start, end) pair of day offsets with start <= end (default None)
+    mode -- 'time' or 'encounter' (default 'time')
+    """
+    import numbers
+
+    if mode not in ('time', 'encounter'):
+        raise ValueError("mode must be 'time' or 'encounter'")
+    if window is None:
+        return
+    if isinstance(window, numbers.Real) and not isinstance(window, bool):
+        if window < 0:
+            raise ValueError('window must not be negative')
+        return
+    if (not isinstance(window, (tuple, list)) or len(window) != 2 or
+            not all(isinstance(end, numbers.Real) and not isinstance(end, bool) for end in window)):
+        raise ValueError('window must be None, a number of days or a (start, end) pair of day offsets')
+    if window[0] > window[1]:
+        raise ValueError('window start must not be after its end')
+
+
+def coOccurrence(sourceType, df_source, targetType, df_target, window=None, mode='time'):
+    """Relative counts of the target codes that co-occur with each source code and year
+
+    A target event co-occurs with the (code, year) group of a source code when it belongs to a patient with that
+    source code in that year and, with window=None, falls in the same calendar year (the original profile
+    definition), or otherwise falls within the day window around one of that patient's source events. In encounter
+    mode it must instead belong to an encounter in which the source code was recorded that year; medications have no
+    ENCOUNTERID, so pairs involving them fall back to the time-based definition. Each target event is counted once
+    per group however many source events it matches.
+
+    Keyword arguments:
+    sourceType, targetType -- 'labs', 'medications', 'procedures', 'diagnoses' or 'phenotypes'
+    df_source, df_target -- the corresponding dataframes from getSubdemographicsTables, or (events, codes) tuples
+    already built with coOccurrenceEvents, so tables used in several pairs are only encoded once
+    window -- None for the same calendar year, a number of days d for events within d days either side, or a
+    (start, end) pair of day offsets from the source event, e.g. (0, 30) for the 30 days after it (default None)
+    mode -- 'time' for the calendar year or window, 'encounter' for the same encounter (default 'time')
+
+    Returns dataframe indexed by (source code, year) with the target code column and Relative_Counts, the fraction
+    of the group's co-occurring target events with that code, largest first
+    """
+    import numpy as np
+    import pandas as pd
+
+    checkOptions(window, mode)
+    targetColumn = EVENT_COLUMNS[targetType][0]
+    if isinstance(df_source, tuple):
+        (source, sourceCodes), (target, targetCodes) = df_source, df_target
+    else:
+        encounters = encounterIndex(df_source, df_target) if mode == 'encounter' else None
+        source, sourceCodes = coOccurrenceEvents(df_source, sourceType, encounters)
+        target, targetCodes = coOccurrenceEvents(df_target, targetType, encounters)
+
+    if mode == 'encounter' and 'encounter' in source.columns and 'encounter' in target.columns:
+        # Hash join on integer encounter ids; an encounter belongs to one patient, whose id is joined on as well
+        groups = source.loc[source.encounter >= 0, ['code', 'year', 'PATID', 'encounter']].drop_duplicates()
+        pairs = groups.merge(target.loc[target.encounter >= 0, ['PATID', 'encounter', 'code']],
+                             on=['PATID', 'encounter'], suffixes=('', '_target'))
+        pairs = pairs[['code', 'year', 'code_target']]
+    elif window is None:
+        # Hash join of distinct (patient, year) source groups against the target events of the same patient-year
+        groups = source[['code', 'year', 'PATID']].drop_duplicates()
+        pairs = groups.merge(target[['PATID', 'year', 'code']], on=['PATID', 'year'], suffixes=('', '_target'))
+        pairs = pairs[['code', 'year', 'code_target']]
+    else:
+        if np.isscalar(window):
+            window = (-window, window)
+        # Events without a date are in no window, and would overflow the packed keys
+        source = source[source.day != MISSING_DAY]
+        target = target[target.day != MISSING_DAY]
+        # One source event per patient and day is enough to find every target event in its window
+        source = source.drop_duplicates(['code', 'year', 'PATID', 'day']).reset_index(drop=True)
+        if len(source) and len(target):
+            sourcePositions, targetPositions = _windowPairs(source, target.reset_index(drop=True), window)
+        else:
+            sourcePositions = targetPositions = np.zeros(0, dtype='int64')
+        pairs = pd.DataFrame({'code': source.code.to_numpy()[sourcePositions],
+                              'year': source.year.to_numpy()[sourcePositions],
+                              'event': targetPositions})
+        # A target event in the windows of several source events of the same group is counted once
+        pairs = pairs.drop_duplicates()
+        pairs['code_target'] = target.code.to_numpy()[pairs.event.to_numpy()]
+        pairs = pairs[['code', 'year', 'code_target']]
+
+    counts = pairs.groupby(['code', 'year', 'code_target']).size().rename('count').reset_index()
+    counts['Relative_Counts'] = counts['count'] / counts.groupby(['code', 'year'])['count'].transform('sum')
+    counts = counts.sort_values(['code', 'year', 'count', 'code_target'], ascending=[True, True, False, True],
+                                kind='mergesort')
+
+    index = pd.MultiIndex.from_arrays([sourceCodes[counts.code.to_numpy()], counts.year.to_numpy()])
+    return pd.DataFrame({targetColumn: targetCodes[counts.code_target.to_numpy()],
+                         'Relative_Counts': counts.Relative_Counts.to_numpy()}, index=index)
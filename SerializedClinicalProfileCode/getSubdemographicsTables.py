@@ -1,5 +1,44 @@
+import threading
+
+# Engines are keyed by connection string and shared across calls and strata so the connection pool is reused
+_ENGINES = dict()
+_ENGINES_LOCK = threading.Lock()
+
+
+def getEngine(user, passwd, pool_size=6):
+    """Return a pooled SQLAlchemy engine for the PCORnet database, creating it on first use
+
+    Keyword arguments:
+    user, psswd -- for access to PCORnet data
+    pool_size -- number of connections kept open in the pool, should be at least the number of concurrent
+    queries (default 6)
+
+    Returns the same engine for repeated calls with the same credentials
+    """
+    import sqlalchemy
+    import urllib.parse
+
+    driver='FreeTDS'
+    tds_ver='8.0'
+
+    host_ip='esmpmdbdev6.database.windows.net'
+    db_port=1433
+    db='ClinicalProfile'
+
+    conn_str=('DRIVER={};SERVER={};PORT={};DATABASE={};UID={};PWD={};TDS_VERSION={}'.format(
+    driver, host_ip, db_port, db, user, passwd, tds_ver))
+
+    with _ENGINES_LOCK:
+        if conn_str not in _ENGINES:
+            _ENGINES[conn_str] = sqlalchemy.create_engine('mssql+pyodbc:///?odbc_connect='+urllib.parse.quote(conn_str),
+                                                          pool_size=pool_size, max_overflow=pool_size,
+                                                          pool_pre_ping=True)
+        return _ENGINES[conn_str]
+
+
 def getSubdemographicsTables(user, passwd, cohort='All', schema='dbo', medianEncounterYear=2019, sex='All', race='All', age_low='All', 
-                             age_high=None ):
+                             age_high=None, n_workers=6, cache_dir=None, refresh=False, return_demographics=False,
+                             push_filters=True, expand_phenotypes=False):
     """Extract data from PCORnet database and clean to prepare for Clinical Profile calculation
     
     Keyword arguments:
@@ -14,125 +53,303 @@ def getSubdemographicsTables(user, passwd, cohort='All', schema='dbo', medianEnc
     meaning specify no age restriction)
     age_high -- high end of the age range to extract as part of the demographic profile (default None, meaning specify no
     age restriction)
+    n_workers -- number of extraction queries (and the HPO index load) run concurrently (default 6, 1 runs them in turn)
+    cache_dir -- directory for local snapshots of the extracted tables (default None, meaning no caching). Event tables
+    are snapshotted per (schema, cohort, table) with the latest date they contain, and later runs only fetch rows from
+    that date on, and rows without a date; rows backdated to before the watermark are only picked up by a full refresh
+    refresh -- evict this cohort's snapshots and extract everything again (default False)
+    return_demographics -- also return the demographics dimension table (default False)
+    push_filters -- apply the sex, race and age filters in the extraction queries rather than only locally, so only the
+    stratum's events are downloaded (default True). Set to False to extract the whole cohort once and cut strata
+    locally
+    expand_phenotypes -- also build the phenotypes table, one row per diagnosis and mapped HPO term (default False,
+    meaning None is returned in its place). calculateAnyProfile derives phenotypes from the diagnoses through the
+    ICD10 -> HPO index, so the expanded table is only needed to inspect phenotypes row by row
+
+    The event tables are narrow fact tables: PATID is an integer patient key into the demographics dimension, which
+    holds the PCORnet identifier in SOURCE_PATID, and demographic columns are not copied onto event rows. Further
+    strata can be cut from one extraction with stratumPatients and selectPatients.
     
     Returns dataframes for use in calculateAnyProfile function
     """
-    import os
-    import sys
-    import sqlalchemy
-    import urllib.parse
     import pandas as pd
-    import numpy as np
-    import getpass
-    from dataclasses import dataclass
-    from SciServer import Authentication
-    from datetime import datetime
-    import pymssql
-    
-    driver='FreeTDS'
-    tds_ver='8.0'
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    from snapshotCache import readSnapshot, unseenRows, appendSnapshot, evictSnapshots
+    from parseLabRanges import parseReferenceRanges
+    from hpoIndex import loadHPOIndex, expandPhenotypes
 
-    host_ip='esmpmdbdev6.database.windows.net'
-    db_port=1433
-    db='ClinicalProfile'
+    engine = getEngine(user, passwd, pool_size=max(n_workers, 1))
 
-    conn_str=('DRIVER={};SERVER={};PORT={};DATABASE={};UID={};PWD={};TDS_VERSION={}'.format(
-    driver, host_ip, db_port, db, user, passwd, tds_ver))
+    # Stratum predicates are applied in the database so each stratum only downloads its own patients' events
+    predicate = stratumPredicate(sex=sex, race=race, age_low=age_low, age_high=age_high,
+                                 medianEncounterYear=medianEncounterYear) if push_filters else ''
 
-    engine = sqlalchemy.create_engine('mssql+pyodbc:///?odbc_connect='+urllib.parse.quote(conn_str))
-    
+    def where(query, condition):
+        if not condition:
+            return query
+        return query + (' and ' if ' where ' in ' '.join(query.split()) else ' where ') + condition
+
+    # Demographics
     if (cohort == 'All'):
-        df_sub_demographics = pd.read_sql_table('DEMOGRAPHIC',str(engine.url), index_col='PATID', schema=schema)
+        cohortTable = 'DEMOGRAPHIC'
     else:
-        query = "select * from [{0}].[{1}]".format(schema, cohort)
-        df_sub_demographics = pd.read_sql_query(query, engine)
-    
-    df_sub_demographics['race_code'] = df_sub_demographics.RACE.map({'01':'Other','02':'Other',
-                                                                     '03':'Black or African American',
-                                                            '04':'Other','05':'White or Caucasian','06':'Other',
-                                                            '07':'Other','NI':'Other','UN':'Other','OT':'Other'})
-    if (sex != 'All'):
-        # grab gender
-        df_sub_demographics = df_sub_demographics[df_sub_demographics.SEX == sex]
-        
-    if (race != 'All'):
-        # grab race
-        df_sub_demographics = df_sub_demographics[df_sub_demographics.race_code == race]
-        
-    if (age_low != 'All'):
-        # grab age
-        dob_ub = medianEncounterYear - float(age_low)
-        dob_lb = medianEncounterYear - float(age_high)
-        df_sub_demographics = (df_sub_demographics[
-            (pd.to_datetime(df_sub_demographics.BIRTH_DATE).dt.year >= dob_lb) & 
-            (pd.to_datetime(df_sub_demographics.BIRTH_DATE).dt.year <= dob_ub)]) 
-        
+        cohortTable = cohort
+    queries = {'demographics': where("select * from [{0}].[{1}] as demo".format(schema, cohortTable), predicate)}
+
     # Labs
-    query = """select demo.PATID, ENCOUNTERID, LAB_LOINC, RESULT_DATE, RESULT_NUM, LOINC_SHORTNAME, LOINC_UNIT,
+    queries['labs'] = where("""select demo.PATID, ENCOUNTERID, LAB_LOINC, RESULT_DATE, RESULT_NUM, LOINC_SHORTNAME, LOINC_UNIT,
                     RANGE_LOW, RANGE_HIGH from [{0}].[{1}] as lab
                     inner join [{2}].[{3}] as demo
-                    on lab.PATID = demo.PATID""".format('dbo', 'vw_pc_labs', schema, cohort)
-    df_labs = pd.read_sql_query(query, engine)
-
-    query = ("""select * from [dbo].[jh_loinc] """)
-    df_loincinfo = pd.read_sql_query(query, engine)
+                    on lab.PATID = demo.PATID""".format('dbo', 'vw_pc_labs', schema, cohortTable), predicate)
 
-    df_labs = df_sub_demographics.merge(df_labs, how='left', left_on='PATID', right_on='PATID')
-    df_labs_full = df_labs.merge(df_loincinfo, how='left', left_on='LAB_LOINC', right_on='Loinc_Code')
+    queries['loinc'] = ("""select * from [dbo].[jh_loinc] """)
 
-    df_labs_full['resultYear'] = pd.to_datetime(df_labs_full.RESULT_DATE).dt.year
-
-    df_labs_full['range_high'] = (df_labs_full.RANGE_HIGH.mask(df_labs_full.RANGE_HIGH.eq('None')).dropna()
-                                 .astype('str').str.replace(',','').replace('', np.nan).replace(' ', np.nan).astype('float'))
-    df_labs_full['range_low'] = (df_labs_full.RANGE_LOW.mask(df_labs_full.RANGE_LOW.eq('None')).dropna()
-                                 .astype('str').str.replace(',','').replace('', np.nan).replace(' ', np.nan).astype('float'))
-    df_labs_full = df_labs_full.drop(['RANGE_HIGH','RANGE_LOW'],axis=1)
-#     labInfo = df_labs_full[['RESULT_NUM','LAB_LOINC','range_high','range_low','resultYear','PATID', 'LOINC_SHORTNAME']]
-
-    
     # Meds
-    query = """select demo.PATID, RX_START_DATE, JH_INGREDIENT_RXNORM_CODE, RX_DOSE_ORDERED, RX_QUANTITY, RX_ROUTE
+    queries['meds'] = where("""select demo.PATID, RX_START_DATE, JH_INGREDIENT_RXNORM_CODE, RX_DOSE_ORDERED, RX_QUANTITY, RX_ROUTE
                     from [{0}].[{1}] as med
                     inner join [{2}].[{3}] as demo
-                    on med.PATID = demo.PATID""".format('dbo', 'PRESCRIBING', schema, cohort)
-    df_meds = pd.read_sql_query(query, engine)
-    
-    df_meds_full = df_sub_demographics.merge(df_meds, how='left', left_on='PATID', right_on='PATID')
-    
-    df_meds_full['startYear'] = pd.to_datetime(df_meds_full.RX_START_DATE).dt.year
-#     rxInfo = df_meds_full[['JH_INGREDIENT_RXNORM_CODE', 'PATID', 'startYear']]
-    
+                    on med.PATID = demo.PATID""".format('dbo', 'PRESCRIBING', schema, cohortTable), predicate)
+
     # Procedures
-    query = """select demo.PATID, ENCOUNTERID, RAW_PX, PX_DATE
+    queries['procedures'] = where("""select demo.PATID, ENCOUNTERID, RAW_PX, PX_DATE
                     from [{0}].[{1}] as p
                     inner join [{2}].[{3}] as demo
-                    on p.PATID = demo.PATID""".format('dbo', 'PROCEDURES', schema, cohort)
-    df_procedures = pd.read_sql_query(query, engine)
-    
-    df_procedures_full = df_sub_demographics.merge(df_procedures, how='left', left_on='PATID', right_on='PATID')
-    
-    df_procedures_full['encounterYear'] = pd.to_datetime(df_procedures_full.PX_DATE).dt.year
-#     procInfo = df_procedures_full[['RAW_PX','PATID', 'encounterYear']]
-    
+                    on p.PATID = demo.PATID""".format('dbo', 'PROCEDURES', schema, cohortTable), predicate)
+
     # Diagnoses
-    query = """select demo.PATID, ENCOUNTERID, DX, ADMIT_DATE
+    queries['diagnoses'] = where("""select demo.PATID, ENCOUNTERID, DX, ADMIT_DATE
                     from [{0}].[{1}] as diag
                     inner join [{2}].[{3}] as demo
                     on diag.PATID = demo.PATID
-                    where diag.DX_TYPE = '10'""".format('dbo', 'DIAGNOSIS', schema, cohort)
-    df_diagnoses = pd.read_sql_query(query, engine)
-    df_diagnoses_full = df_sub_demographics.merge(df_diagnoses, how='left', left_on='PATID', right_on='PATID')
-    
-    df_diagnoses_full['admitYear'] = pd.to_datetime(df_diagnoses_full.ADMIT_DATE).dt.year
-#     diagInfo = df_diagnoses_full[['DX','PATID','admitYear']]
-    
-    # HPO
-    hpoMapping = pd.read_csv('HPO_ICD10_nostring.txt', sep=' ', header=None)
-    hpoMapping.drop(2,axis=1,inplace=True)
-    hpoMapping.columns = ['ICD10','HPO']
-    
-    df_phenotypes_full = df_diagnoses_full.merge(hpoMapping, left_on='DX', right_on='ICD10', how='inner')
-    df_phenotypes_full['admitYear'] = pd.to_datetime(df_phenotypes_full.ADMIT_DATE).dt.year
-#     phenoInfo = df_phenotypes_full[['HPO','PATID', 'admitYear']]
-        
-    return (df_labs_full, df_meds_full, df_procedures_full, df_diagnoses_full, df_phenotypes_full)
\ No newline at end of file
+                    where diag.DX_TYPE = '10'""".format('dbo', 'DIAGNOSIS', schema, cohortTable), predicate)
+
+    # Date column each cached table is watermarked on, as (column in the query, column in the result)
+    snapshotDates = {'labs': ('lab.RESULT_DATE', 'RESULT_DATE'),
+                     'loinc': (None, None),
+                     'meds': ('med.RX_START_DATE', 'RX_START_DATE'),
+                     'procedures': ('p.PX_DATE', 'PX_DATE'),
+                     'diagnoses': ('diag.ADMIT_DATE', 'ADMIT_DATE')}
+
+    if cache_dir is not None and refresh:
+        evictSnapshots(cache_dir, schema=schema, cohort=cohort)
+
+    def extract(name, query):
+        if cache_dir is None or name not in snapshotDates:
+            return pd.read_sql_query(query, engine)
+
+        queryColumn, dateColumn = snapshotDates[name]
+        # Filtered extractions only hold one stratum, so they are snapshotted separately from the whole cohort
+        table = name
+        if predicate and dateColumn is not None:
+            table = '{0}-{1}-{2}-{3}-{4}'.format(name, sex, race, age_low, age_high).replace(' ', '_')
+        df_snapshot, watermark = readSnapshot(cache_dir, schema, cohort, table)
+        if df_snapshot is not None and dateColumn is None:
+            return df_snapshot
+        if watermark is not None:
+            # Rows can still arrive for the watermark date, so it is fetched again and the stored rows dropped
+            query = where(query, "({0} >= '{1}' or {0} is null)".format(queryColumn, watermark))
+
+        df_new = unseenRows(df_snapshot, pd.read_sql_query(query, engine), dateColumn, watermark)
+        appendSnapshot(cache_dir, schema, cohort, table, df_new, date_column=dateColumn)
+        if df_snapshot is None:
+            return df_new
+        return pd.concat([df_snapshot, df_new], ignore_index=True)
+
+    def prepareDemographics(tables):
+        df_demographics = buildDemographicsDimension(tables['demographics'])
+        # Positions in this index are the integer patient keys used by every fact table
+        tables['patient_index'] = pd.Index(tables['demographics'].PATID.drop_duplicates().values)
+        return df_demographics
+
+    def keyEvents(tables, name):
+        df_events = tables[name]
+        keys = tables['patient_index'].get_indexer(df_events.PATID)
+        df_events = df_events[keys >= 0].copy()
+        df_events['PATID'] = keys[keys >= 0].astype('int32')
+        return df_events
+
+    def prepareLabs(tables):
+        df_labs_full = keyEvents(tables, 'labs').merge(tables['loinc'], how='left', left_on='LAB_LOINC',
+                                                        right_on='Loinc_Code')
+
+        df_labs_full['resultYear'] = pd.to_datetime(df_labs_full.RESULT_DATE).dt.year
+
+        df_labs_full['range_low'], df_labs_full['range_high'] = parseReferenceRanges(df_labs_full.RANGE_LOW,
+                                                                                     df_labs_full.RANGE_HIGH)
+        df_labs_full = df_labs_full.drop(['RANGE_HIGH','RANGE_LOW'],axis=1)
+        return df_labs_full
+
+    def prepareMeds(tables):
+        df_meds_full = keyEvents(tables, 'meds')
+        df_meds_full['startYear'] = pd.to_datetime(df_meds_full.RX_START_DATE).dt.year
+        return df_meds_full
+
+    def prepareProcedures(tables):
+        df_procedures_full = keyEvents(tables, 'procedures')
+        df_procedures_full['encounterYear'] = pd.to_datetime(df_procedures_full.PX_DATE).dt.year
+        return df_procedures_full
+
+    def prepareDiagnoses(tables):
+        df_diagnoses_full = keyEvents(tables, 'diagnoses')
+        df_diagnoses_full['admitYear'] = pd.to_datetime(df_diagnoses_full.ADMIT_DATE).dt.year
+        return df_diagnoses_full
+
+    def preparePhenotypes(tables):
+        df_phenotypes_full = expandPhenotypes(tables['diagnoses_full'], tables['hpo'])
+        return df_phenotypes_full
+
+    # Post-processing steps and the tables each one waits on; a step runs as soon as its inputs have arrived
+    steps = {'demographics_dim': (('demographics',), prepareDemographics),
+             'labs_full': (('demographics_dim', 'labs', 'loinc'), prepareLabs),
+             'meds_full': (('demographics_dim', 'meds'), prepareMeds),
+             'procedures_full': (('demographics_dim', 'procedures'), prepareProcedures),
+             'diagnoses_full': (('demographics_dim', 'diagnoses'), prepareDiagnoses)}
+    if expand_phenotypes:
+        steps['phenotypes_full'] = (('diagnoses_full', 'hpo'), preparePhenotypes)
+
+    tables = dict()
+    with ThreadPoolExecutor(max_workers=max(n_workers, 1)) as executor:
+        futures = {executor.submit(extract, name, query): name for name, query in queries.items()}
+        futures[executor.submit(loadHPOIndex)] = 'hpo'
+
+        for future in as_completed(futures):
+            tables[futures[future]] = future.result()
+
+            ready = [name for name, (deps, step) in steps.items() if all(dep in tables for dep in deps)]
+            while ready:
+                for name in ready:
+                    deps, step = steps.pop(name)
+                    tables[name] = step(tables)
+                    # Raw query results are dropped once no remaining step needs them
+                    for dep in deps:
+                        if dep in futures.values() and not any(dep in remaining for remaining, _ in steps.values()):
+                            del tables[dep]
+                ready = [name for name, (deps, step) in steps.items() if all(dep in tables for dep in deps)]
+
+    df_demographics = tables['demographics_dim']
+    patients = stratumPatients(df_demographics, sex=sex, race=race, age_low=age_low, age_high=age_high,
+                               medianEncounterYear=medianEncounterYear)
+    df_demographics = df_demographics[df_demographics.PATID.isin(patients)]
+
+    df_labs_full = selectPatients(tables['labs_full'], patients)
+    df_meds_full = selectPatients(tables['meds_full'], patients)
+    df_procedures_full = selectPatients(tables['procedures_full'], patients)
+    df_diagnoses_full = selectPatients(tables['diagnoses_full'], patients)
+    df_phenotypes_full = selectPatients(tables['phenotypes_full'], patients, pad=False) if expand_phenotypes else None
+
+    if return_demographics:
+        return (df_labs_full, df_meds_full, df_procedures_full, df_diagnoses_full, df_phenotypes_full,
+                df_demographics)
+    return (df_labs_full, df_meds_full, df_procedures_full, df_diagnoses_full, df_phenotypes_full)
+
+
+def stratumPredicate(sex='All', race='All', age_low='All', age_high=None, medianEncounterYear=2019, alias='demo'):
+    """Translate a demographic stratum into a SQL predicate on the cohort table
+
+    Keyword arguments:
+    sex, race, age_low, age_high, medianEncounterYear -- stratum, as for getSubdemographicsTables
+    alias -- alias of the cohort / DEMOGRAPHIC table in the query (default 'demo')
+
+    Returns SQL condition string, empty when the stratum is 'All' on every axis
+    """
+    # PCORnet RACE codes behind each race_code label used for the profiles
+    raceCodes = {'Black or African American': ['03'],
+                 'White or Caucasian': ['05'],
+                 'Other': ['01', '02', '04', '06', '07', 'NI', 'UN', 'OT']}
+
+    def literal(value):
+        return "'" + str(value).replace("'", "''") + "'"
+
+    conditions = list()
+    if (sex != 'All'):
+        conditions.append('{0}.SEX = {1}'.format(alias, literal(sex)))
+
+    if (race != 'All'):
+        conditions.append('{0}.RACE in ({1})'.format(alias, ', '.join(literal(code) for code in raceCodes.get(race, [race]))))
+
+    if (age_low != 'All'):
+        dob_ub = medianEncounterYear - float(age_low)
+        dob_lb = medianEncounterYear - float(age_high)
+        conditions.append('year({0}.BIRTH_DATE) >= {1:g} and year({0}.BIRTH_DATE) <= {2:g}'.format(alias, dob_lb, dob_ub))
+
+    return ' and '.join(conditions)
+
+
+def buildDemographicsDimension(df_demographics):
+    """Build the demographics dimension table that the event fact tables join to by integer patient key
+
+    Keyword arguments:
+    df_demographics -- demographics rows for the cohort, one per PATID
+
+    Returns dataframe indexed by (SEX, race_code, birthYear) with the integer key in PATID and the PCORnet identifier
+    in SOURCE_PATID
+    """
+    import pandas as pd
+
+    df_dimension = df_demographics.drop_duplicates('PATID').rename(columns={'PATID': 'SOURCE_PATID'})
+    df_dimension.insert(0, 'PATID', range(len(df_dimension)))
+    df_dimension['PATID'] = df_dimension.PATID.astype('int32')
+    df_dimension['race_code'] = df_dimension.RACE.map({'01':'Other','02':'Other',
+                                                       '03':'Black or African American',
+                                                       '04':'Other','05':'White or Caucasian','06':'Other',
+                                                       '07':'Other','NI':'Other','UN':'Other','OT':'Other'})
+    # Unknown sexes, unmapped races and missing birth dates only match 'All' strata
+    df_dimension['SEX'] = df_dimension.SEX.fillna('Unknown')
+    df_dimension['race_code'] = df_dimension.race_code.fillna('Unknown')
+    df_dimension['birthYear'] = pd.to_datetime(df_dimension.BIRTH_DATE).dt.year.fillna(-1).astype('int32')
+    return df_dimension.set_index(['SEX', 'race_code', 'birthYear'], drop=False).sort_index()
+
+
+def stratumPatients(df_demographics, sex='All', race='All', age_low='All', age_high=None, medianEncounterYear=2019):
+    """Look up the integer patient keys of one demographic stratum in the demographics dimension
+
+    Keyword arguments:
+    df_demographics -- dimension table from getSubdemographicsTables(return_demographics=True)
+    sex, race, age_low, age_high, medianEncounterYear -- stratum, as for getSubdemographicsTables
+
+    Returns sorted numpy array of patient keys
+    """
+    import numpy as np
+    import pandas as pd
+
+    sexes = slice(None) if sex == 'All' else sex
+    races = slice(None) if race == 'All' else race
+    if (age_low != 'All'):
+        births = slice(medianEncounterYear - float(age_high), medianEncounterYear - float(age_low))
+    else:
+        births = slice(None)
+
+    try:
+        patients = df_demographics.loc[pd.IndexSlice[sexes, races, births], 'PATID'].values
+    except KeyError:
+        patients = np.array([], dtype='int32')
+    return np.sort(patients)
+
+
+def selectPatients(df_fact, patients, pad=True):
+    """Restrict a fact table to the given patient keys
+
+    Keyword arguments:
+    df_fact -- labs, meds, procedures, diagnoses or phenotypes table keyed by integer PATID
+    patients -- patient keys to keep, e.g. from stratumPatients
+    pad -- add one empty row for each selected patient without events, so per-table patient counts still cover the
+    whole stratum as calculateAnyProfile expects (default True)
+
+    Returns the selected fact table
+    """
+    import numpy as np
+    import pandas as pd
+
+    keys = df_fact.PATID.values
+    size = int(max(keys.max() if len(keys) else -1, patients.max() if len(patients) else -1)) + 1
+    selected = np.zeros(size, dtype=bool)
+    selected[patients] = True
+    df_fact = df_fact[selected[keys]]
+
+    if pad:
+        present = np.zeros(size, dtype=bool)
+        present[df_fact.PATID.values] = True
+        missing = patients[~present[patients]]
+        if len(missing):
+            df_fact = pd.concat([df_fact, pd.DataFrame({'PATID': missing.astype('int32')})], ignore_index=True)
+    return df_fact
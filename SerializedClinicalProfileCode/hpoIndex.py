@@ -0,0 +1,172 @@
+import threading
+
+# Loaded indexes are memory-mapped once per process and shared across calls
+_INDEXES = dict()
+_INDEXES_LOCK = threading.Lock()
+
+
+def buildHPOIndex(mapping_file='HPO_ICD10_nostring.txt', index_dir='HPO_ICD10_index'):
+    """Build the compact ICD10 -> HPO sparse index from the mapping file
+
+    The index is a CSR matrix with one row per ICD10 code and one column per HPO term, saved as plain .npy arrays so
+    it can be memory-mapped: icd10.npy and hpo.npy hold the sorted codes, indptr.npy / indices.npy / data.npy the
+    matrix. Repeated mapping lines are kept as counts so results match an inner merge against the file.
+
+    Keyword arguments:
+    mapping_file -- space separated ICD10 / HPO / label file (default 'HPO_ICD10_nostring.txt')
+    index_dir -- directory the index is written to (default 'HPO_ICD10_index')
+
+    Returns index_dir
+    """
+    import os
+    import numpy as np
+    import pandas as pd
+
+    hpoMapping = pd.read_csv(mapping_file, sep=' ', header=None, usecols=[0, 1], dtype=str)
+    hpoMapping.columns = ['ICD10','HPO']
+    hpoMapping = hpoMapping.dropna()
+
+    # Fixed-width unicode arrays, unlike object arrays, can be memory-mapped
+    icd10Codes = np.asarray(hpoMapping.ICD10, dtype=str)
+    hpoCodes = np.asarray(hpoMapping.HPO, dtype=str)
+    icd10 = np.unique(icd10Codes)
+    hpo = np.unique(hpoCodes)
+    rows = np.searchsorted(icd10, icd10Codes)
+    cols = np.searchsorted(hpo, hpoCodes)
+
+    # Sort by (row, col) and collapse repeated pairs into counts
+    order = np.lexsort((cols, rows))
+    rows, cols = rows[order], cols[order]
+    first = np.ones(len(rows), dtype=bool)
+    first[1:] = (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1])
+    starts = np.flatnonzero(first)
+    data = np.diff(np.append(starts, len(rows))).astype('int32')
+    rows, cols = rows[starts], cols[starts]
+    indptr = np.searchsorted(rows, np.arange(len(icd10) + 1)).astype('int64')
+
+    os.makedirs(index_dir, exist_ok=True)
+    for name, array in [('icd10', icd10), ('hpo', hpo), ('indptr', indptr),
+                        ('indices', cols.astype('int32')), ('data', data)]:
+        np.save(os.path.join(index_dir, name + '.npy'), array)
+    return index_dir
+
+
+def loadHPOIndex(mapping_file='HPO_ICD10_nostring.txt', index_dir='HPO_ICD10_index'):
+    """Memory-map the ICD10 -> HPO index, building it first if it is missing or older than the mapping file
+
+    Keyword arguments:
+    mapping_file -- space separated ICD10 / HPO / label file (default 'HPO_ICD10_nostring.txt')
+    index_dir -- directory of the prebuilt index (default 'HPO_ICD10_index')
+
+    Returns dict of read-only arrays 'icd10', 'hpo', 'indptr', 'indices' and 'data'
+    """
+    import os
+    import numpy as np
+
+    with _INDEXES_LOCK:
+        marker = os.path.join(index_dir, 'data.npy')
+        stale = (not os.path.exists(marker) or
+                 (os.path.exists(mapping_file) and os.path.getmtime(mapping_file) > os.path.getmtime(marker)))
+        if stale:
+            buildHPOIndex(mapping_file, index_dir)
+            _INDEXES.pop(index_dir, None)
+
+        if index_dir not in _INDEXES:
+            _INDEXES[index_dir] = {name: np.load(os.path.join(index_dir, name + '.npy'), mmap_mode='r')
+                                   for name in ['icd10', 'hpo', 'indptr', 'indices', 'data']}
+        return _INDEXES[index_dir]
+
+
+def lookupICD10(codes, index):
+    """Return the index row of each ICD10 code, -1 for codes (or missing values) without an HPO mapping
+
+    Keyword arguments:
+    codes -- series of ICD10 codes, e.g. the DX column of the diagnoses table
+    index -- ICD10 -> HPO index from loadHPOIndex
+    """
+    import numpy as np
+    import pandas as pd
+
+    # Only the distinct codes are searched, then mapped back onto the rows
+    codes, uniques = pd.factorize(codes)
+    uniques = np.asarray(uniques, dtype=str)
+    positions = np.searchsorted(index['icd10'], uniques)
+    positions = np.minimum(positions, len(index['icd10']) - 1)
+    positions = np.where(index['icd10'][positions] == uniques, positions, -1)
+    return np.where(codes >= 0, np.append(positions, -1)[codes], -1)
+
+
+def expandICD10(codes, index):
+    """Pair ICD10 codes with their HPO terms, as an inner merge against the mapping file would
+
+    Keyword arguments:
+    codes -- series of ICD10 codes, e.g. the DX column of the diagnoses table
+    index -- ICD10 -> HPO index from loadHPOIndex
+
+    Returns (positions, terms): for each (code, HPO term) pair, repeated by its count in the mapping file, the
+    position of the code in codes and the column of the term in index['hpo']
+    """
+    import numpy as np
+
+    rows = lookupICD10(codes, index)
+    mapped = np.flatnonzero(rows >= 0)
+    rows = rows[mapped]
+
+    indptr, indices, data = index['indptr'], index['indices'], index['data']
+    lengths = indptr[rows + 1] - indptr[rows]
+    # Each (ICD10, HPO) pair is repeated by its count in the mapping file
+    spans = np.repeat(np.arange(len(rows)), lengths)
+    offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    entries = indptr[rows][spans] + offsets
+    repeats = np.asarray(data[entries])
+    return np.repeat(mapped[spans], repeats), np.repeat(np.asarray(indices[entries]), repeats)
+
+
+def expandPhenotypes(df_diagnoses, index):
+    """Expand diagnosis rows into one row per mapped HPO term, as an inner merge against the mapping file would
+
+    Keyword arguments:
+    df_diagnoses -- diagnoses table with a DX column
+    index -- ICD10 -> HPO index from loadHPOIndex
+
+    Returns the diagnoses columns plus HPO, for diagnoses with at least one HPO term
+    """
+    import numpy as np
+
+    positions, terms = expandICD10(df_diagnoses.DX, index)
+    df_phenotypes = df_diagnoses.iloc[positions].reset_index(drop=True)
+    df_phenotypes['HPO'] = np.asarray(index['hpo'])[terms]
+    return df_phenotypes
+
+
+def phenotypePatientYearCounts(df_diagnoses, index):
+    """Count HPO terms per patient and admit year as a sparse product of diagnosis incidence and the ICD10 -> HPO index
+
+    The expanded phenotype frame is never built: a (patient-year x ICD10) count matrix is multiplied by the
+    (ICD10 x HPO) index, so the cost follows the number of non-zero patient-year / HPO cells.
+
+    Keyword arguments:
+    df_diagnoses -- diagnoses table with PATID, admitYear and DX columns
+    index -- ICD10 -> HPO index from loadHPOIndex
+
+    Returns dataframe with columns PATID, admitYear, HPO and count, one row per non-zero cell
+    """
+    import numpy as np
+    import pandas as pd
+    from scipy import sparse
+
+    rows = lookupICD10(df_diagnoses.DX, index)
+    mapped = rows >= 0
+    patientYears = df_diagnoses.loc[mapped, ['PATID', 'admitYear']]
+    patientYearCodes, patientYearUniques = pd.MultiIndex.from_frame(patientYears).factorize()
+
+    incidence = sparse.csr_matrix((np.ones(mapped.sum(), dtype='int64'), (patientYearCodes, rows[mapped])),
+                                  shape=(len(patientYearUniques), len(index['icd10'])))
+    mapping = sparse.csr_matrix((np.asarray(index['data']), np.asarray(index['indices']), np.asarray(index['indptr'])),
+                                shape=(len(index['icd10']), len(index['hpo'])))
+    counts = (incidence @ mapping).tocoo()
+
+    df_counts = patientYearUniques[counts.row].to_frame(index=False, name=['PATID', 'admitYear'])
+    df_counts['HPO'] = np.asarray(index['hpo'])[counts.col]
+    df_counts['count'] = counts.data
+    return df_counts
@@ -0,0 +1,67 @@
+import re
+
+_NUMBER = r'([-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)'
+_INTERVAL = re.compile(r'^' + _NUMBER + r'\s*(?:-|–|to)\s*' + _NUMBER)
+_UPPER = re.compile(r'^(?:<=|=<|<|≤)\s*' + _NUMBER)
+_LOWER = re.compile(r'^(?:>=|=>|>|≥)\s*' + _NUMBER)
+_VALUE = re.compile(r'^' + _NUMBER)
+
+
+def parseReferenceRange(text, bound):
+    """Parse one PCORnet reference range string into its low and high limits
+
+    Keyword arguments:
+    text -- raw RANGE_LOW or RANGE_HIGH value, e.g. '3.5', '1,000', '1.5E3', '<5', '>= 60' or '3.5-5.0'
+    bound -- which column the value came from, 'low' or 'high'; a bare number is taken as that limit
+
+    Returns (low, high) as floats, NaN where the string does not give that limit
+    """
+    nan = float('nan')
+    if text is None or text != text:
+        return nan, nan
+
+    text = str(text).replace(',', '').strip()
+    match = _INTERVAL.match(text)
+    if match:
+        return float(match.group(1)), float(match.group(2))
+    match = _UPPER.match(text)
+    if match:
+        return nan, float(match.group(1))
+    match = _LOWER.match(text)
+    if match:
+        return float(match.group(1)), nan
+    match = _VALUE.match(text)
+    if match:
+        value = float(match.group(1))
+        return (value, nan) if bound == 'low' else (nan, value)
+    return nan, nan
+
+
+def parseReferenceRanges(range_low, range_high):
+    """Normalize the RANGE_LOW and RANGE_HIGH columns of the labs table into numeric limits
+
+    Each distinct string is parsed once and the results are mapped back onto the rows through the factorized codes,
+    so the cost depends on the number of distinct strings rather than the number of lab results. A limit missing from
+    its own column is taken from the other column when that holds an interval (e.g. RANGE_HIGH of '3.5-5.0').
+
+    Keyword arguments:
+    range_low -- RANGE_LOW series from the labs query
+    range_high -- RANGE_HIGH series from the labs query
+
+    Returns (range_low, range_high) float series aligned with the inputs
+    """
+    import numpy as np
+    import pandas as pd
+
+    def parseColumn(series, bound):
+        codes, uniques = pd.factorize(series)
+        parsed = np.array([parseReferenceRange(value, bound) for value in uniques] + [(np.nan, np.nan)],
+                          dtype='float64').reshape(-1, 2)
+        # Code -1 marks missing values and picks up the trailing (NaN, NaN) row
+        return parsed[codes]
+
+    low = parseColumn(range_low, 'low')
+    high = parseColumn(range_high, 'high')
+
+    return (pd.Series(np.where(np.isnan(low[:, 0]), high[:, 0], low[:, 0]), index=range_low.index),
+            pd.Series(np.where(np.isnan(high[:, 1]), low[:, 1], high[:, 1]), index=range_high.index))
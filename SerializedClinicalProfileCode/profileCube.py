@@ -0,0 +1,241 @@
+STRATUM_COLUMNS = ['cohort', 'sex', 'race', 'age_low', 'age_high']
+CUBE_COLUMNS = STRATUM_COLUMNS + ['code', 'rank', 'statistic', 'related', 'position', 'value', 'text']
+SCALAR_STATISTICS = ['min', 'max', 'mean', 'median', 'stdDev', 'fractionAboveNormal', 'fractionBelowNormal']
+CATEGORY_COLUMNS = STRATUM_COLUMNS + ['code', 'statistic', 'related']
+
+
+def cubeSchema():
+    """Return the parquet schema every cube file is written with
+
+    Dictionary indices are always int32 and text always a string, whatever the number of distinct codes or missing
+    names in one profile, so the files of a domain can be read together as one dataset.
+    """
+    import pyarrow as pa
+
+    category = pa.dictionary(pa.int32(), pa.string())
+    types = dict(rank=pa.int32(), position=pa.int16(), value=pa.float64(), text=pa.string())
+    return pa.schema([(column, category if column in CATEGORY_COLUMNS else types[column]) for column in CUBE_COLUMNS])
+
+
+def cubeStratum(cohort='All', sex='All', race='All', age_low='All', age_high=None):
+    """Return the stratum columns of a profile as the strings stored in the cube
+
+    Sex is spelled out as in the profile ids and ages are written as whole years, '' for a missing upper bound.
+    """
+    if sex == 'M':
+        sex = 'Male'
+    elif sex == 'F':
+        sex = 'Female'
+    if age_low != 'All':
+        return dict(cohort=cohort, sex=sex, race=race, age_low=str(int(age_low)), age_high=str(int(age_high)))
+    return dict(cohort=cohort, sex=sex, race=race, age_low='All', age_high='')
+
+
+def entryRows(profileType, entry, rank):
+    """Flatten one profile entry into long cube rows
+
+    Keyword arguments:
+    profileType -- 'labs', 'medications', 'procedures', 'diagnoses' or 'phenotypes'
+    entry -- entry JSON as built by writeProfile.profileEntry
+    rank -- position of the entry in its profile
+
+    Returns list of (code, rank, statistic, related, position, value, text) tuples
+    """
+    from writeProfile import DOMAINS
+
+    if profileType == 'medications':
+        concept = entry['medicationCodeableConcept']
+    else:
+        concept = entry['code'][0]
+    code = concept['coding'][0]['code']
+
+    rows = [(code, rank, 'frequencyPerYear', '', 0, entry['frequencyPerYear'], concept.get('text')),
+            (code, rank, 'fractionOfSubjects', '', 0, entry['fractionOfSubjects'], None)]
+    if 'count' in entry:
+        rows.append((code, rank, 'count', '', 0, entry['count'], None))
+
+    target = entry
+    if 'scalarDistribution' in entry:
+        target = entry['scalarDistribution']
+        rows.append((code, rank, 'units', '', 0, float('nan'), target['units']['unit']))
+        rows.extend((code, rank, statistic, '', 0, target[statistic], None) for statistic in SCALAR_STATISTICS)
+        rows.extend((code, rank, 'decile', str(decile['nth']), position, decile['value'], None)
+                    for position, decile in enumerate(target['decile']))
+
+    for domain, spec in DOMAINS.items():
+        if spec['correlated'] not in target:
+            continue
+        for position, related in enumerate(target[spec['correlated']]['entry']):
+            if domain == 'labs':
+                concept = related['labcode'][0]
+            elif domain == 'medications':
+                concept = related['meds'][0]['medicationCodeableConcept']
+            elif domain == 'procedures':
+                concept = related['code'][0]
+            else:
+                concept = related['code']
+            rows.append((code, rank, domain, concept['coding'][0]['code'], position, related['coefficient'],
+                         concept.get('text')))
+    return rows
+
+
+def collectCubeRows(profileType, entries, rows):
+    """Pass entries through unchanged while flattening each into rows, so a profile can be streamed to JSON and
+    the cube in one pass
+
+    Keyword arguments:
+    profileType -- 'labs', 'medications', 'procedures', 'diagnoses' or 'phenotypes'
+    entries -- iterable of entry JSON dicts
+    rows -- list the cube rows are appended to
+    """
+    for rank, entry in enumerate(entries):
+        rows.extend(entryRows(profileType, entry, rank))
+        yield entry
+
+
+def profileCubeRows(profileType, entries, topN=10, cohort='All', sex='All', race='All', age_low='All',
+                    age_high=None):
+    """Flatten the entries of one profile into a dictionary-encoded cube frame
+
+    Keyword arguments:
+    profileType -- 'labs', 'medications', 'procedures', 'diagnoses' or 'phenotypes'
+    entries -- iterable of entry JSON dicts, or list of rows already collected with collectCubeRows
+    topN -- topN the profile was written with, kept so the JSON can be rebuilt (default 10)
+    cohort, sex, race, age_low, age_high -- stratum of the profile
+
+    Returns dataframe with the CUBE_COLUMNS, string columns other than text as categoricals
+    """
+    import pandas as pd
+
+    rows = [('', -1, 'topN', '', 0, topN, None)]
+    for rank, entry in enumerate(entries):
+        if isinstance(entry, tuple):
+            rows.append(entry)
+        else:
+            rows.extend(entryRows(profileType, entry, rank))
+
+    df = pd.DataFrame.from_records(rows, columns=CUBE_COLUMNS[len(STRATUM_COLUMNS):])
+    for column, value in cubeStratum(cohort, sex, race, age_low, age_high).items():
+        df[column] = value
+    df = df[CUBE_COLUMNS]
+    df['rank'] = df['rank'].astype('int32')
+    df['position'] = df['position'].astype('int16')
+    df['value'] = df['value'].astype('float64')
+    df['text'] = df['text'].astype(object).where(df['text'].notna(), None)
+    for column in CATEGORY_COLUMNS:
+        df[column] = df[column].astype('category')
+    return df
+
+
+def writeCubeRows(cube_dir, profileType, profile_id, df):
+    """Save the cube rows of one profile, replacing any earlier rows of the same profile
+
+    Each profile is its own parquet file under cube_dir/profileType, so rewriting a stratum only touches that file
+    and the domain directory can be read as one dataset.
+
+    Returns the file written
+    """
+    import os
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    directory = os.path.join(cube_dir, profileType)
+    os.makedirs(directory, exist_ok=True)
+    filename = os.path.join(directory, profile_id + '.parquet')
+    # Dot files are skipped when the directory is read as a dataset, so a half-written profile is never seen
+    temporary = os.path.join(directory, '.' + profile_id + '.parquet.tmp')
+    pq.write_table(pa.Table.from_pandas(df, schema=cubeSchema(), preserve_index=False), temporary)
+    os.replace(temporary, filename)
+    return filename
+
+
+def readCube(cube_dir, profileType, columns=None, **predicates):
+    """Slice the cube of one domain, pushing the predicates down into the parquet scan
+
+    Keyword arguments:
+    cube_dir -- root directory of the cube
+    profileType -- 'labs', 'medications', 'procedures', 'diagnoses' or 'phenotypes'
+    columns -- columns to read (default None, meaning all)
+    predicates -- column=value or column=[values], e.g. sex='Female', statistic='fractionOfSubjects',
+    code=['4548-4', '2345-7']; ages may be given as numbers
+
+    Returns dataframe of matching rows
+    """
+    import os
+    import pandas as pd
+
+    filters = list()
+    for column, value in predicates.items():
+        values = list(value) if isinstance(value, (list, tuple, set)) else [value]
+        if column in STRATUM_COLUMNS or column in ('code', 'statistic', 'related'):
+            values = [str(int(v)) if column in ('age_low', 'age_high') and isinstance(v, (int, float)) else str(v)
+                      for v in values]
+        filters.append((column, 'in', values))
+
+    return pd.read_parquet(os.path.join(cube_dir, profileType), columns=columns, filters=filters or None)
+
+
+def cubeEntries(profileType, df):
+    """Rebuild the entry JSON of one profile from its cube rows
+
+    Keyword arguments:
+    profileType -- 'labs', 'medications', 'procedures', 'diagnoses' or 'phenotypes'
+    df -- cube rows of a single profile
+
+    Yields entry JSON dicts in their original order
+    """
+    import numpy as np
+    from writeProfile import profileEntry
+
+    topN = df.loc[df.statistic == 'topN', 'value']
+    topN = int(topN.iloc[0]) if len(topN) else 10
+    df = df[df['rank'] >= 0].sort_values(['rank', 'statistic', 'position'], kind='mergesort')
+
+    for rank, rows in df.groupby('rank', sort=True, observed=True):
+        values = dict()
+        texts = dict()
+        correlations = dict()
+        deciles = list()
+        for statistic, related, value, text in zip(rows.statistic.astype(str), rows.related.astype(str),
+                                                   rows.value.values, rows.text.astype(object).values):
+            if statistic == 'decile':
+                deciles.append((int(related), value))
+            elif statistic in ('labs', 'medications', 'procedures', 'diagnoses', 'phenotypes'):
+                correlations.setdefault(statistic, list()).append(
+                    (related, float(value), None if text is None or text != text else text))
+            else:
+                values[statistic] = value
+                texts[statistic] = text
+
+        scalarDistribution = None
+        if 'units' in texts:
+            scalarDistribution = dict(values, units=texts['units'], decile=deciles)
+        name = texts.get('frequencyPerYear')
+        yield profileEntry(profileType, str(rows.code.iloc[0]), values['frequencyPerYear'],
+                           values['fractionOfSubjects'],
+                           count=values['count'] if 'count' in values and not np.isnan(values['count']) else None,
+                           name=None if name is None or name != name else name,
+                           scalarDistribution=scalarDistribution, correlations=correlations, topN=topN)
+
+
+def cubeProfile(cube_dir, profileType, cohort='All', sex='All', race='All', age_low='All', age_high=None):
+    """Reproduce the ClinicalProfile JSON of one stratum from the cube
+
+    The header is rebuilt as writeProfile writes it, so apart from its date the resource matches the original file.
+
+    Keyword arguments:
+    cube_dir -- root directory of the cube
+    profileType -- 'labs', 'medications', 'procedures', 'diagnoses' or 'phenotypes'
+    cohort, sex, race, age_low, age_high -- stratum of the profile
+
+    Returns the ClinicalProfile JSON dict
+    """
+    from writeProfile import PROFILE_SPECS, profileHeader
+
+    df = readCube(cube_dir, profileType, **cubeStratum(cohort, sex, race, age_low, age_high))
+    if df.empty:
+        raise KeyError('No cube rows for this stratum')
+
+    resource = profileHeader(profileType, cohort, sex, race, age_low, age_high)
+    resource[PROFILE_SPECS[profileType]['attribute']] = list(cubeEntries(profileType, df))
+    return resource
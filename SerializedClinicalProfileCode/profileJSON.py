@@ -0,0 +1,175 @@
+def finiteJSON(value):
+    """Return a JSON value with NaN and infinite floats replaced by None
+
+    orjson writes non-finite floats as null while the standard library writes NaN / Infinity, which is not valid JSON;
+    normalizing first makes every encoder, and the content hash, agree.
+    """
+    import math
+
+    if isinstance(value, float):
+        return value if math.isfinite(value) else None
+    if isinstance(value, dict):
+        return {key: finiteJSON(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [finiteJSON(item) for item in value]
+    return value
+
+
+def jsonEncoder(compact=False):
+    """Return a function encoding one JSON value to a string
+
+    Compact output uses orjson when it is installed and falls back to the standard library encoder otherwise;
+    indented output always uses the standard library so files stay identical to json.dump(..., indent=4). Non-finite
+    floats are written as null on every path.
+
+    Keyword arguments:
+    compact -- encode without whitespace (default False, meaning indent=4)
+    """
+    import json
+
+    if not compact:
+        return lambda value: json.dumps(finiteJSON(value), indent=4)
+    try:
+        import orjson
+        return lambda value: orjson.dumps(finiteJSON(value), option=orjson.OPT_SERIALIZE_NUMPY).decode('utf-8')
+    except ImportError:
+        return lambda value: json.dumps(finiteJSON(value), separators=(',', ':'))
+
+
+def canonicalJSON(resource):
+    """Return a resource as canonical JSON (sorted keys, no whitespace), for comparing output of different writers"""
+    import json
+
+    return json.dumps(finiteJSON(resource), sort_keys=True, separators=(',', ':'))
+
+
+def validateProfile(resource, attribute=None, entry=None):
+    """Validate a ClinicalProfile header, and one of its entries, against the fhirclient model
+
+    Every entry of a profile is built by the same code, so checking one is enough to catch a malformed element
+    without building the whole object tree. Raises fhirclient's FHIRValidationError on an invalid resource.
+
+    Keyword arguments:
+    resource -- ClinicalProfile JSON without its entries
+    attribute -- name of the entry list, e.g. 'lab' (default None)
+    entry -- entry JSON to validate along with the header (default None)
+    """
+    from fhirclient.models import clinicalprofile
+
+    resource = dict(resource)
+    if attribute is not None and entry is not None:
+        resource[attribute] = [entry]
+    clinicalprofile.ClinicalProfile(resource)
+
+
+def dumpProfile(resource, attribute, entries, outfile, compact=False):
+    """Stream a ClinicalProfile to an open text file, one entry at a time
+
+    Only the header and a single encoded entry are held in memory. Indented output is byte-for-byte what
+    json.dump(resource, outfile, indent=4) writes for the same resource with its entries in place.
+
+    Keyword arguments:
+    resource -- ClinicalProfile JSON without its entries
+    attribute -- name of the entry list, e.g. 'lab'
+    entries -- iterable of entry JSON dicts
+    outfile -- text file object to write to
+    compact -- write without whitespace (default False, meaning indent=4)
+    """
+    import json
+
+    encode = jsonEncoder(compact)
+    header = encode(resource)
+    # The header is written open, so the entry list can follow its last member
+    outfile.write(header[:-1].rstrip())
+
+    if compact:
+        outfile.write(',' + json.dumps(attribute) + ':[')
+        for n, entry in enumerate(entries):
+            outfile.write((',' if n else '') + encode(entry))
+        outfile.write(']}')
+        return
+
+    outfile.write(',\n    ' + json.dumps(attribute) + ': [')
+    written = False
+    for entry in entries:
+        outfile.write((',\n' if written else '\n') + '        ' + encode(entry).replace('\n', '\n        '))
+        written = True
+    outfile.write('\n    ]\n}' if written else ']\n}')
+
+
+def openProfile(filename, compress=False):
+    """Open a profile file for buffered text writing, gzip-compressed if asked
+
+    Keyword arguments:
+    filename -- path to write to
+    compress -- gzip the output (default False)
+    """
+    import gzip
+
+    if compress:
+        return gzip.open(filename, 'wt', encoding='utf-8')
+    return open(filename, 'w', buffering=1 << 20)
+
+
+# Fields that change on every run without the profile content changing
+VOLATILE_FIELDS = ('date', 'meta')
+
+
+def profileDigest(resource, attribute):
+    """Start a content hash of a profile from its header, leaving out volatile fields
+
+    Keyword arguments:
+    resource -- ClinicalProfile JSON without its entries
+    attribute -- name of the entry list, e.g. 'lab'
+
+    Returns a hashlib sha256 object; feed the entries to it with hashEntries
+    """
+    import json
+    import hashlib
+
+    header = {key: value for key, value in resource.items() if key not in VOLATILE_FIELDS and key != attribute}
+    return hashlib.sha256((canonicalJSON(header) + json.dumps(attribute)).encode('utf-8'))
+
+
+def hashEntries(entries, digest):
+    """Pass entries through unchanged while adding each to a content hash from profileDigest"""
+    for entry in entries:
+        digest.update(('\n' + canonicalJSON(entry)).encode('utf-8'))
+        yield entry
+
+
+def contentHash(resource, attribute=None):
+    """Return the canonical content hash of a complete ClinicalProfile, as recorded in the manifest by writeProfile
+
+    Keyword arguments:
+    resource -- ClinicalProfile JSON including its entries, e.g. as read back from a written file
+    attribute -- name of the entry list (default None, meaning the one present among the profile types)
+    """
+    if attribute is None:
+        attribute = next((key for key in ('lab', 'medication', 'procedure', 'diagnosis', 'hpo') if key in resource),
+                         None)
+    digest = profileDigest(resource, attribute)
+    for _ in hashEntries(resource.get(attribute, list()), digest):
+        pass
+    return digest.hexdigest()
+
+
+def loadManifest(manifest_file):
+    """Read a manifest of profile id -> content hash, empty if the file does not exist yet"""
+    import os
+    import json
+
+    if not os.path.exists(manifest_file):
+        return dict()
+    with open(manifest_file) as infile:
+        return json.load(infile)
+
+
+def saveManifest(manifest_file, manifest):
+    """Atomically save a manifest of profile id -> content hash"""
+    import os
+    import json
+
+    with open(manifest_file + '.tmp', 'w') as outfile:
+        json.dump(dict(sorted(manifest.items())), outfile, indent=1)
+    os.replace(manifest_file + '.tmp', manifest_file)
@@ -0,0 +1,154 @@
+def snapshotDirectory(cache_dir, schema, cohort, table):
+    """Return the directory holding the local snapshot of one extracted table
+
+    Keyword arguments:
+    cache_dir -- root directory of the extraction cache
+    schema, cohort -- schema and table / view the extraction was run against
+    table -- short name of the extracted table (e.g. 'labs', 'meds', 'procedures', 'diagnoses', 'loinc')
+    """
+    import os
+
+    return os.path.join(cache_dir, schema, cohort, table)
+
+
+def readSnapshot(cache_dir, schema, cohort, table):
+    """Read a local columnar snapshot and the date watermark it was taken up to
+
+    Keyword arguments:
+    cache_dir -- root directory of the extraction cache
+    schema, cohort -- schema and table / view the extraction was run against
+    table -- short name of the extracted table
+
+    Returns (dataframe, watermark), or (None, None) if there is no snapshot yet. The watermark is the maximum
+    value of the snapshot's date column as an ISO string, or None for tables without a date column. Only the parts
+    recorded in the metadata are read, so a part left behind by an interrupted append is ignored
+    """
+    import os
+    import json
+    import pandas as pd
+
+    directory = snapshotDirectory(cache_dir, schema, cohort, table)
+    metadataFile = os.path.join(directory, 'snapshot.json')
+    if not os.path.exists(metadataFile):
+        return None, None
+
+    with open(metadataFile) as infile:
+        metadata = json.load(infile)
+    if 'parts' not in metadata:
+        # Snapshots that do not list their parts are extracted again
+        return None, None
+
+    df = pd.concat([pd.read_parquet(os.path.join(directory, part)) for part in metadata['parts']], ignore_index=True)
+    return df, metadata['watermark']
+
+
+def unseenRows(df_snapshot, df_new, date_column, watermark):
+    """Drop the rows of an incremental extraction that the snapshot already holds
+
+    Incremental extractions fetch rows on or after the watermark date, and rows without a date, again, because rows
+    can still be loaded for the watermark date after the snapshot was taken. Those re-fetched rows are matched to
+    the snapshot's rows of the same dates one for one, so rows that are genuinely repeated in the source are kept.
+
+    Keyword arguments:
+    df_snapshot -- dataframe from readSnapshot
+    df_new -- rows fetched since the watermark
+    date_column -- column the watermark is taken from
+    watermark -- watermark from readSnapshot
+
+    Returns the rows of df_new not yet in the snapshot
+    """
+    import pandas as pd
+
+    if df_snapshot is None or watermark is None or not len(df_new):
+        return df_new
+
+    dates = pd.to_datetime(df_snapshot[date_column])
+    boundary = df_snapshot[dates.isna() | (dates >= pd.Timestamp(watermark))]
+    if not len(boundary):
+        return df_new
+
+    # Number repeated rows on both sides, so each stored copy only cancels one fetched copy
+    columns = list(df_new.columns)
+    new = df_new.assign(_copy=df_new.groupby(columns, dropna=False).cumcount())
+    boundary = boundary[columns].astype(df_new.dtypes.to_dict())
+    boundary = boundary.assign(_copy=boundary.groupby(columns, dropna=False).cumcount())
+    seen = new.merge(boundary, on=columns + ['_copy'], how='left', indicator=True)['_merge'].values == 'both'
+    return df_new[~seen]
+
+
+def appendSnapshot(cache_dir, schema, cohort, table, df, date_column=None):
+    """Append newly extracted rows to a local snapshot and move its watermark forward
+
+    Each append is written as its own parquet part so earlier parts are never rewritten. The part only becomes part
+    of the snapshot when the metadata listing it is replaced, so an interrupted append leaves the snapshot as it was.
+
+    Keyword arguments:
+    cache_dir -- root directory of the extraction cache
+    schema, cohort -- schema and table / view the extraction was run against
+    table -- short name of the extracted table
+    df -- rows to add to the snapshot
+    date_column -- column the watermark is taken from (default None, meaning the table is only ever fully refreshed)
+
+    Returns the new watermark
+    """
+    import os
+    import json
+    import pandas as pd
+
+    directory = snapshotDirectory(cache_dir, schema, cohort, table)
+    os.makedirs(directory, exist_ok=True)
+    metadataFile = os.path.join(directory, 'snapshot.json')
+
+    watermark = None
+    rows = 0
+    parts = list()
+    if os.path.exists(metadataFile):
+        with open(metadataFile) as infile:
+            metadata = json.load(infile)
+        if 'parts' in metadata:
+            watermark = metadata['watermark']
+            rows = metadata['rows']
+            parts = metadata['parts']
+
+    if len(df) or not parts:
+        # A part left by an interrupted append is not listed, and is simply overwritten here
+        part = 'part-{:05d}.parquet'.format(len(parts))
+        df.to_parquet(os.path.join(directory, '.' + part + '.tmp'), index=False)
+        os.replace(os.path.join(directory, '.' + part + '.tmp'), os.path.join(directory, part))
+        parts.append(part)
+
+    if date_column is not None and len(df):
+        newest = pd.to_datetime(df[date_column]).max()
+        if not pd.isnull(newest) and (watermark is None or newest > pd.Timestamp(watermark)):
+            watermark = newest.isoformat()
+
+    # The metadata is replaced last and in one step, so the listed parts and the watermark always move together
+    with open(metadataFile + '.tmp', 'w') as outfile:
+        json.dump({'table': table, 'date_column': date_column, 'watermark': watermark, 'rows': rows + len(df),
+                   'parts': parts}, outfile)
+    os.replace(metadataFile + '.tmp', metadataFile)
+
+    return watermark
+
+
+def evictSnapshots(cache_dir, schema=None, cohort=None, table=None):
+    """Delete local snapshots so the next extraction does a full refresh
+
+    Keyword arguments:
+    cache_dir -- root directory of the extraction cache
+    schema -- only evict snapshots for this schema (default None, meaning every schema)
+    cohort -- only evict snapshots for this cohort (default None, meaning every cohort)
+    table -- only evict snapshots of this table (default None, meaning every table)
+
+    Returns list of snapshot directories removed
+    """
+    import os
+    import glob
+    import shutil
+
+    pattern = os.path.join(cache_dir, schema or '*', cohort or '*', table or '*')
+    removed = [directory for directory in glob.glob(pattern)
+               if os.path.exists(os.path.join(directory, 'snapshot.json'))]
+    for directory in removed:
+        shutil.rmtree(directory)
+    return removed
@@ -0,0 +1,22 @@
+import pandas as pd
+
+from coOccurrence import coOccurrence
+
+
+def pairs(df):
+    return {(code, year, target): round(relative, 6)
+            for (code, year), target, relative in zip(df.index, df.iloc[:, 0], df.Relative_Counts)}
+
+
+def test_window_ignores_events_without_a_date():
+    meds = pd.DataFrame({'PATID': [1, 2, 2], 'JH_INGREDIENT_RXNORM_CODE': ['a', 'a', 'b'],
+                         'RX_START_DATE': pd.to_datetime(['2020-01-05', '2020-03-01', None]),
+                         'startYear': [2020, 2020, 2020]})
+    diagnoses = pd.DataFrame({'PATID': [1, 2, 2], 'DX': ['x', 'y', 'x'],
+                              'ADMIT_DATE': pd.to_datetime(['2020-01-10', '2020-03-05', '2020-06-01']),
+                              'admitYear': [2020, 2020, 2020]})
+
+    assert pairs(coOccurrence('medications', meds, 'diagnoses', diagnoses, window=30)) == {
+        ('a', 2020, 'x'): 0.5, ('a', 2020, 'y'): 0.5}
+    assert pairs(coOccurrence('diagnoses', diagnoses, 'medications', meds, window=30)) == {
+        ('x', 2020, 'a'): 1.0, ('y', 2020, 'a'): 1.0}
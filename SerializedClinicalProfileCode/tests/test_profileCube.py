@@ -0,0 +1,22 @@
+from profileCube import profileCubeRows, writeCubeRows, readCube, cubeProfile
+from writeProfile import profileEntry
+
+
+def diagnosisEntries(n):
+    return [profileEntry('diagnoses', 'D{:04d}'.format(code), 0.5, 0.25, count=code + 1,
+                         correlations={'labs': [('L{}'.format(code), 0.5, None)]}) for code in range(n)]
+
+
+def test_read_domain_with_mixed_cardinalities(tmp_path):
+    # Fewer than 128 distinct codes in the first file and more in the second give pandas int8 and int16 dictionary
+    # indices; the dataset schema is taken from the first file
+    small, large = diagnosisEntries(3), diagnosisEntries(300)
+    for sex, entries in (('Female', small), ('Male', large)):
+        writeCubeRows(str(tmp_path), 'diagnoses', sex, profileCubeRows('diagnoses', entries, sex=sex))
+
+    df = readCube(str(tmp_path), 'diagnoses')
+    assert set(df.code.astype(str)) == {''} | {entry['code'][0]['coding'][0]['code'] for entry in large}
+    assert len(readCube(str(tmp_path), 'diagnoses', sex='Male', statistic='count')) == 300
+
+    assert cubeProfile(str(tmp_path), 'diagnoses', sex='Female')['diagnosis'] == small
+    assert cubeProfile(str(tmp_path), 'diagnoses', sex='Male')['diagnosis'] == large
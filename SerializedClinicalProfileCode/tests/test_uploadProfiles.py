@@ -0,0 +1,69 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from uploadProfiles import uploadProfiles
+
+
+class MockFHIRServer(BaseHTTPRequestHandler):
+    """Accepts batch Bundles, failing the first request with a 503 and rejecting ids ending in 'bad'"""
+    store = dict()
+    requests = list()
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        self.requests.append(self.path)
+        if len(self.requests) == 1:
+            self.send_response(503)
+            self.end_headers()
+            return
+        entries = list()
+        for entry in body['entry']:
+            resource = entry['resource']
+            if resource['id'].endswith('bad'):
+                entries.append({'response': {'status': '400 Bad Request', 'outcome': {'issue': []}}})
+            else:
+                self.store[resource['id']] = resource
+                entries.append({'response': {'status': '200 OK'}})
+        data = json.dumps({'resourceType': 'Bundle', 'type': 'batch-response', 'entry': entries}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/fhir+json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+@pytest.fixture
+def server():
+    MockFHIRServer.store = dict()
+    MockFHIRServer.requests = list()
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), MockFHIRServer)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield 'http://127.0.0.1:{}'.format(httpd.server_address[1])
+    httpd.shutdown()
+
+
+def test_upload_path_source_with_manifest(server, tmp_path):
+    resources = [dict(resourceType='ClinicalProfile', id='p{:02d}'.format(n), lab=[{'count': n}]) for n in range(25)]
+    resources.append(dict(resourceType='ClinicalProfile', id='pbad'))
+    source = tmp_path / 'profiles.ndjson'
+    source.write_text(''.join(json.dumps(resource) + '\n' for resource in resources))
+    manifest = str(tmp_path / 'manifest.json')
+
+    report = uploadProfiles(source, base_url=server, bundle_size=10, n_connections=2, backoff=0.01,
+                            manifest_file=manifest)
+    assert report.status.value_counts().to_dict() == {'success': 25, 'failure': 1}
+    assert all(request == '/baseR4' for request in MockFHIRServer.requests)
+    assert sorted(MockFHIRServer.store) == ['p{:02d}'.format(n) for n in range(25)]
+
+    # Only the changed and the failed resources are sent again
+    resources[3]['lab'][0]['count'] = 100
+    report = uploadProfiles(resources, base_url=server, bundle_size=10, manifest_file=manifest)
+    assert report.set_index('id').status.to_dict() == dict({'p{:02d}'.format(n): 'unchanged' for n in range(25)},
+                                                           p03='success', pbad='failure')
+    assert MockFHIRServer.store['p03']['lab'] == [{'count': 100}]
@@ -0,0 +1,197 @@
+# Code system of the meta tag carrying a profile's content hash on the server
+HASH_TAG_SYSTEM = 'urn:clinicalprofiles:content-hash'
+
+
+def readProfiles(source):
+    """Yield ClinicalProfile resources from written output
+
+    Keyword arguments:
+    source -- a directory of profile files, a single .json / .json.gz file, or an .ndjson file from
+    BulkProfileWriter; directories are searched for .json, .json.gz and .ndjson files, in name order.
+    Transaction Bundles written by BulkProfileWriter are unpacked into their resources. Paths may be strings or
+    os.PathLike objects.
+    """
+    import os
+    import glob
+    import gzip
+    import json
+
+    source = os.fspath(source)
+    if os.path.isdir(source):
+        files = sorted(glob.glob(os.path.join(source, '*.json')) + glob.glob(os.path.join(source, '*.json.gz')) +
+                       glob.glob(os.path.join(source, '*.ndjson')))
+        # The BulkProfileWriter index is not a resource
+        files = [filename for filename in files if not filename.endswith('.index.json')]
+    else:
+        files = [source]
+
+    for filename in files:
+        opener = gzip.open if filename.endswith('.gz') else open
+        with opener(filename, 'rt', encoding='utf-8') as infile:
+            if filename.endswith('.ndjson'):
+                for line in infile:
+                    if line.strip():
+                        yield json.loads(line)
+                continue
+            resource = json.load(infile)
+        if resource.get('resourceType') == 'Bundle':
+            for entry in resource.get('entry', list()):
+                yield entry['resource']
+        else:
+            yield resource
+
+
+def profileBundle(resources, bundle_type='batch'):
+    """Wrap ClinicalProfile resources in a batch or transaction Bundle that PUTs each one under its id
+
+    Keyword arguments:
+    resources -- list of ClinicalProfile JSON dicts
+    bundle_type -- 'batch' (each resource succeeds or fails on its own) or 'transaction' (all or nothing)
+    (default 'batch')
+    """
+    return {'resourceType': 'Bundle',
+            'type': bundle_type,
+            'entry': [{'fullUrl': 'ClinicalProfile/' + resource['id'],
+                       'resource': resource,
+                       'request': {'method': 'PUT', 'url': 'ClinicalProfile/' + resource['id']}}
+                      for resource in resources]}
+
+
+def uploadSession(n_connections=4, retries=5, backoff=0.5, headers=None):
+    """Return a requests session with a bounded connection pool that retries with exponential backoff
+
+    Keyword arguments:
+    n_connections -- connections kept open to the server (default 4)
+    retries -- retries on connection errors and 429 / 5xx responses (default 5)
+    backoff -- backoff factor in seconds, doubling with each retry (default 0.5)
+    headers -- extra headers, e.g. {'Authorization': 'Bearer ...'} (default None)
+    """
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    # Bundles only PUT resources under fixed ids, so resending one after a failure is safe
+    retry = Retry(total=retries, backoff_factor=backoff, status_forcelist=[429, 500, 502, 503, 504],
+                  allowed_methods=None, raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=n_connections, pool_maxsize=n_connections, max_retries=retry,
+                          pool_block=True)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers.update({'Content-Type': 'application/fhir+json', 'Accept': 'application/fhir+json'})
+    if headers:
+        session.headers.update(headers)
+    return session
+
+
+def _postBundle(session, url, resources, bundle_type, timeout):
+    """Send one Bundle and return a report row per resource"""
+    import json
+    import time
+
+    start = time.perf_counter()
+    ids = [resource['id'] for resource in resources]
+    try:
+        response = session.post(url, data=json.dumps(profileBundle(resources, bundle_type)), timeout=timeout)
+    except Exception as e:
+        return [dict(id=resourceId, status='failure', http_status=None, error=repr(e),
+                     seconds=time.perf_counter() - start) for resourceId in ids]
+    seconds = time.perf_counter() - start
+
+    if not response.ok:
+        return [dict(id=resourceId, status='failure', http_status=response.status_code, error=response.text[:500],
+                     seconds=seconds) for resourceId in ids]
+
+    # Bundle responses list one entry per request, in request order
+    entries = response.json().get('entry', list())
+    rows = list()
+    for n, resourceId in enumerate(ids):
+        status = entries[n].get('response', dict()).get('status', '') if n < len(entries) else ''
+        ok = status[:1] == '2'
+        rows.append(dict(id=resourceId, status='success' if ok else 'failure', http_status=status.split(' ')[0],
+                         error=None if ok else json.dumps(entries[n].get('response', dict()).get('outcome'))
+                         if n < len(entries) else 'missing from bundle response', seconds=seconds))
+    return rows
+
+
+def uploadProfiles(source, base_url='https://hapi.clinicalprofiles.org', bundle_size=50, bundle_type='batch',
+                   n_connections=4, retries=5, backoff=0.5, timeout=120, manifest_file=None, headers=None):
+    """Upload ClinicalProfile resources to a FHIR server as batch or transaction Bundles over a connection pool
+
+    Resources are grouped into Bundles of bundle_size, and up to n_connections Bundles are in flight at once.
+    With a manifest, each resource's content hash is compared with the hash last published for its id, and only
+    changed resources are sent; the hash is also recorded as a meta tag on the uploaded resource.
+
+    Keyword arguments:
+    source -- directory, .json or .ndjson output of the writers (a string or os.PathLike), or an iterable of resource
+    dicts
+    base_url -- server to upload to, e.g. 'http://localhost:8080' for a local HAPI server; '/baseR4' is
+    appended (default 'https://hapi.clinicalprofiles.org')
+    bundle_size -- resources per Bundle (default 50)
+    bundle_type -- 'batch' or 'transaction' (default 'batch')
+    n_connections -- Bundles sent concurrently (default 4)
+    retries, backoff -- retries with exponential backoff on connection errors and 429 / 5xx responses
+    (default 5 and 0.5s)
+    timeout -- seconds to wait for each Bundle response (default 120)
+    manifest_file -- JSON manifest of id -> content hash published so far; updated with the resources that
+    were uploaded successfully (default None, meaning upload everything)
+    headers -- extra request headers, e.g. for authorization (default None)
+
+    Returns dataframe with one row per resource: id, status ('success', 'failure' or 'unchanged'), http_status,
+    error and seconds
+    """
+    import os
+    import itertools
+    import pandas as pd
+    from concurrent.futures import ThreadPoolExecutor
+    from profileJSON import contentHash, loadManifest, saveManifest
+
+    resources = readProfiles(source) if isinstance(source, (str, os.PathLike)) else iter(source)
+    manifest = loadManifest(manifest_file) if manifest_file is not None else None
+    hashes = dict()
+    rows = list()
+
+    def changed(resources):
+        for resource in resources:
+            if manifest is not None:
+                digest = contentHash(resource)
+                if manifest.get(resource['id']) == digest:
+                    rows.append(dict(id=resource['id'], status='unchanged', http_status=None, error=None, seconds=0.0))
+                    continue
+                hashes[resource['id']] = digest
+                meta = dict(resource.get('meta', dict()))
+                meta['tag'] = [tag for tag in meta.get('tag', list()) if tag.get('system') != HASH_TAG_SYSTEM]
+                meta['tag'].append({'system': HASH_TAG_SYSTEM, 'code': digest})
+                resource = dict(resource, meta=meta)
+            yield resource
+
+    def bundles(resources):
+        while True:
+            batch = list(itertools.islice(resources, bundle_size))
+            if not batch:
+                return
+            yield batch
+
+    url = base_url.rstrip('/') + '/baseR4'
+    session = uploadSession(n_connections, retries, backoff, headers)
+
+    with ThreadPoolExecutor(max_workers=n_connections) as executor:
+        # Only a few Bundles are read ahead of the uploads, so large NDJSON streams are never held in memory
+        pending = list()
+        for batch in bundles(changed(resources)):
+            pending.append(executor.submit(_postBundle, session, url, batch, bundle_type, timeout))
+            if len(pending) >= 2 * n_connections:
+                rows.extend(pending.pop(0).result())
+        for future in pending:
+            rows.extend(future.result())
+    session.close()
+
+    report = pd.DataFrame(rows, columns=['id', 'status', 'http_status', 'error', 'seconds'])
+    if manifest is not None:
+        manifest.update({resourceId: hashes[resourceId] for resourceId in report.id[report.status == 'success']})
+        saveManifest(manifest_file, manifest)
+
+    print('Uploaded {} resources to {}: {} failed, {} unchanged'.format(
+        (report.status == 'success').sum(), url, (report.status == 'failure').sum(),
+        (report.status == 'unchanged').sum()))
+    return report
@@ -0,0 +1,385 @@
+# How codes of each domain are written, both for a profile's own entries and for correlated codes in other profiles.
+# 'column' is the code column in calculateAnyProfile's correlation tables, 'correlated' the element holding them.
+DOMAINS = {
+    'labs': dict(column='LAB_LOINC', system='http://loinc.org', correlated='correlatedLabs',
+                 correlatedClass='ClinicalProfileLabScalarDistributionCorrelatedLabs'),
+    'medications': dict(column='JH_INGREDIENT_RXNORM_CODE', system='http://www.nlm.nih.gov/research/umls/rxnorm/',
+                        correlated='correlatedMedications',
+                        correlatedClass='ClinicalProfileLabScalarDistributionCorrelatedMedications'),
+    'procedures': dict(column='RAW_PX', system='http://www.ama-assn.org/practice-management/cpt',
+                       correlated='correlatedProcedures',
+                       correlatedClass='ClinicalProfileLabScalarDistributionCorrelatedProcedures'),
+    'diagnoses': dict(column='DX', system='http://www.icd10data.com/', correlated='correlatedDiagnoses',
+                      correlatedClass='ClinicalProfileLabScalarDistributionCorrelatedDiagnoses'),
+    'phenotypes': dict(column='HPO', system='http://hpo.jax.org/app/', correlated='correlatedPhenotypes',
+                       correlatedClass='ClinicalProfileLabScalarDistributionCorrelatedPhenotypes'),
+}
+
+# Per profile type: id prefix, ClinicalProfile attribute and element class of its entries, and whether entries
+# carry a count
+PROFILE_SPECS = {
+    'labs': dict(prefix='jh-labs', attribute='lab', element='ClinicalProfileLab', count=True),
+    'medications': dict(prefix='jh-medications', attribute='medication', element='ClinicalProfileMedication',
+                        count=False),
+    'procedures': dict(prefix='jh-procedures', attribute='procedure', element='ClinicalProfileProcedure', count=False),
+    'diagnoses': dict(prefix='jh-diagnoses', attribute='diagnosis', element='ClinicalProfileDiagnosis', count=True),
+    'phenotypes': dict(prefix='jh-hpo', attribute='hpo', element='ClinicalProfileHpo', count=False),
+}
+
+
+def profileId(profileType, cohort='All', sex='All', race='All', age_low='All', age_high=None):
+    """Return the resource id of a profile, e.g. 'jh-labs-copd-Female-All-40-50'
+
+    Keyword arguments:
+    profileType -- 'labs', 'medications', 'procedures', 'diagnoses' or 'phenotypes'
+    cohort, sex, race, age_low, age_high -- stratum, as for the write profile functions
+    """
+    if sex == 'M':
+        sex = 'Male'
+    elif sex =='F':
+        sex = 'Female'
+
+    if (age_low != 'All'):
+        return PROFILE_SPECS[profileType]['prefix']+'-'+cohort+'-'+sex+'-'+race+'-'+str(int(age_low))+'-'+str(int(age_high))
+    return PROFILE_SPECS[profileType]['prefix']+'-'+cohort+'-'+sex+'-'+race+'-'+str(age_low)
+
+
+def profileHeader(profileType, cohort='All', sex='All', race='All', age_low='All', age_high=None):
+    """Return the header of a ClinicalProfile resource as a JSON dict, without any domain entries
+
+    Keyword arguments:
+    profileType -- 'labs', 'medications', 'procedures', 'diagnoses' or 'phenotypes'
+    cohort, sex, race, age_low, age_high -- stratum, as for the write profile functions
+    """
+    from datetime import datetime
+
+    thisId = profileId(profileType, cohort, sex, race, age_low, age_high)
+    return {'resourceType': 'ClinicalProfile',
+            'id': thisId,
+            'identifier': [{'value': thisId}],
+            'status': 'draft',
+            'population': {'reference': 'Group/'+PROFILE_SPECS[profileType]['prefix']+'-'+cohort},
+            'cohort': {'reference': 'Group/'+thisId},
+            'date': str(datetime.now()).replace(' ', 'T'),
+            'reporter': {'reference': 'Organization/JHM',
+                         'type': 'Organization',
+                         'display': 'Johns Hopkins School of Medicine'}}
+
+
+def codeEntry(domain, code, text=None):
+    """Return the CodeableConcept JSON for one code of a domain"""
+    concept = dict(coding=[dict(system=DOMAINS[domain]['system'], code=str(code))])
+    if text is not None:
+        concept['text'] = text
+    return concept
+
+
+def correlatedEntry(domain, code, coefficient, text=None):
+    """Return one correlated-code entry, in the layout each domain has always been written with"""
+    concept = codeEntry(domain, code, text)
+    if domain == 'labs':
+        return dict(labcode=[concept], coefficient=coefficient)
+    if domain == 'medications':
+        return dict(meds=[dict(medicationCodeableConcept=concept)], coefficient=coefficient)
+    if domain == 'procedures':
+        return dict(code=[concept], coefficient=coefficient)
+    return dict(code=concept, coefficient=coefficient)
+
+
+def topCorrelations(means, topN=10, correlationCutoff=0.3):
+    """Rank related codes for all codes at once
+
+    Keyword arguments:
+    means -- series indexed by (code, related code) with the coefficient averaged over years
+    topN -- maximum number of related codes kept per code (default 10)
+    correlationCutoff -- coefficients at or below this value are dropped after rounding (default 0.3)
+
+    Returns dict of code -> list of (related code, coefficient), highest first
+    """
+    import pandas as pd
+
+    means = means.dropna()
+    if means.empty:
+        return dict()
+
+    # A stable sort keeps ties in related-code order, as Series.nlargest does
+    ranked = (means.rename('coefficient').reset_index()
+              .sort_values([means.index.names[0], 'coefficient'], ascending=[True, False], kind='mergesort'))
+    ranked.columns = ['code', 'related', 'coefficient']
+    ranked = ranked.groupby('code', sort=False).head(topN)
+    ranked['coefficient'] = ranked.coefficient.round(3)
+    ranked = ranked[ranked.coefficient > correlationCutoff]
+
+    correlations = dict()
+    for code, related, coefficient in zip(ranked.code.values, ranked.related.values, ranked.coefficient.values):
+        correlations.setdefault(code, list()).append((related, float(coefficient)))
+    return correlations
+
+
+def crossDomainCorrelations(coefficients, domain, topN=10, correlationCutoff=0.3):
+    """Average a calculateAnyProfile correlation table over years and rank it for every code in one pass
+
+    Keyword arguments:
+    coefficients -- dataframe indexed by (code, year) with the related code column of the domain and Relative_Counts
+    domain -- domain of the related codes
+    topN, correlationCutoff -- as for topCorrelations
+
+    Returns dict of code -> list of (related code, coefficient)
+    """
+    import pandas as pd
+
+    if coefficients is None or len(coefficients) == 0:
+        return dict()
+
+    column = DOMAINS[domain]['column']
+    means = (coefficients.groupby([coefficients.index.get_level_values(0).rename('code'), coefficients[column]])
+             .Relative_Counts.mean())
+    return topCorrelations(means, topN, correlationCutoff)
+
+
+def labCorrelations(labs_correlatedLabsCoefficients, topN=10, correlationCutoff=0.3):
+    """Correlate lab results across patients, matching years, and rank the related labs of every lab in one pass
+
+    Keyword arguments:
+    labs_correlatedLabsCoefficients -- mean result per (lab, year, patient) from calculateAnyProfile
+    topN, correlationCutoff -- as for topCorrelations
+
+    Returns dict of lab -> list of (related lab, coefficient)
+    """
+    import numpy as np
+    import pandas as pd
+
+    corrmat = (pd.DataFrame(labs_correlatedLabsCoefficients).unstack(level=[0,1]).corr(min_periods=50)
+                        .droplevel(level=0).droplevel(level=0,axis=1))
+
+    labs = corrmat.index.get_level_values(0).values
+    years = corrmat.index.get_level_values(1).values.astype('float')
+    otherLabs = corrmat.columns.get_level_values(0).values
+    otherYears = corrmat.columns.get_level_values(1).values.astype('float')
+
+    # Only same-year pairs are compared, then averaged over the years both labs share
+    rows, cols = np.nonzero(years[:, None] == otherYears[None, :])
+    pairs = pd.Series(corrmat.values[rows, cols],
+                      index=pd.MultiIndex.from_arrays([labs[rows], otherLabs[cols]], names=['code', 'related']))
+    pairs = pairs[pairs.index.get_level_values(0) != pairs.index.get_level_values(1)]
+    return topCorrelations(pairs.groupby(level=[0, 1]).mean(), topN, correlationCutoff)
+
+
+def profileEntry(profileType, code, frequencyPerYear, fractionOfSubjects, count=None, name=None,
+                 scalarDistribution=None, correlations=None, topN=10):
+    """Build the JSON of one profile entry from its already aggregated values
+
+    Keyword arguments:
+    profileType -- 'labs', 'medications', 'procedures', 'diagnoses' or 'phenotypes'
+    code -- code of the entry
+    frequencyPerYear, fractionOfSubjects -- values averaged over years
+    count -- number of events, for profile types whose entries carry one (default None)
+    name -- lab name written as the code text (default None)
+    scalarDistribution -- for labs, dict of units, min, max, mean, median, stdDev, decile (list of (nth, value)),
+    fractionAboveNormal and fractionBelowNormal (default None)
+    correlations -- dict of related domain -> list of (related code, coefficient, text or None) (default None)
+    topN -- maximum number of correlations, written with each correlated list (default 10)
+    """
+    if profileType == 'medications':
+        entry = dict(medicationCodeableConcept=codeEntry('medications', code))
+    else:
+        entry = dict(code=[codeEntry(profileType, code, name)])
+    if count is not None:
+        entry['count'] = int(count)
+
+    entry['frequencyPerYear'] = round(float(frequencyPerYear),3)
+    entry['fractionOfSubjects'] = round(float(fractionOfSubjects),3)
+
+    # Correlations sit under the scalar distribution for labs and on the entry itself otherwise
+    target = entry
+    if scalarDistribution is not None:
+        target = entry['scalarDistribution'] = dict(
+            units=dict(unit=str(scalarDistribution['units'])),
+            min=round(float(scalarDistribution['min']),3),
+            max=round(float(scalarDistribution['max']),3),
+            mean=round(float(scalarDistribution['mean']),3),
+            median=round(float(scalarDistribution['median']),3),
+            stdDev=round(float(scalarDistribution['stdDev']),3),
+            decile=[dict(nth=int(nth), value=round(float(value),3)) for nth, value in scalarDistribution['decile']],
+            fractionAboveNormal=round(float(scalarDistribution['fractionAboveNormal']),3),
+            fractionBelowNormal=round(float(scalarDistribution['fractionBelowNormal']),3))
+
+    for domain in DOMAINS:
+        if not (correlations or dict()).get(domain):
+            continue
+        entries = [correlatedEntry(domain, other, coefficient, None if text is None else str(text))
+                   for other, coefficient, text in correlations[domain]]
+        target[DOMAINS[domain]['correlated']] = dict(topn=topN, entry=entries)
+
+    return entry
+
+
+def profileEntries(profileType, codes, frequencyPerYear, fractionOfSubjects, correlated, counts=None,
+                   labs_units=None, labs_names=None, labs_stats=None, labs_aboveBelowNorm=None,
+                   labs_correlatedLabsCoefficients=None, topN=10, correlationCutoff=0.3):
+    """Yield the JSON entries of one profile, one per code, from calculateAnyProfile's result tables
+
+    All per-code statistics and correlations are grouped for every code up front, so each entry is a few dict
+    lookups rather than repeated MultiIndex selections.
+
+    Keyword arguments:
+    profileType -- 'labs', 'medications', 'procedures', 'diagnoses' or 'phenotypes'
+    codes -- codes to write entries for, in order
+    frequencyPerYear -- frequency per (code, year)
+    fractionOfSubjects -- fraction of subjects per code
+    correlated -- dict of related domain -> correlation table indexed by (code, year); for lab profiles the lab
+    domain comes from labs_correlatedLabsCoefficients instead
+    counts -- number of events per code, for profile types whose entries carry a count (default None)
+    labs_units, labs_names, labs_stats, labs_aboveBelowNorm, labs_correlatedLabsCoefficients -- lab-only tables from
+    calculateAnyProfile(profileType='labs') (default None)
+    topN, correlationCutoff -- as for the write profile functions
+    """
+    import numpy as np
+    import pandas as pd
+
+    spec = PROFILE_SPECS[profileType]
+
+    frequencies = frequencyPerYear.groupby(level=0).mean().to_dict()
+    fractions = fractionOfSubjects.groupby(level=0).mean().to_dict()
+    eventCounts = counts.to_dict() if counts is not None else dict()
+
+    correlations = {domain: crossDomainCorrelations(table, domain, topN, correlationCutoff)
+                    for domain, table in correlated.items()}
+
+    if profileType == 'labs':
+        names = {lab: name[0] for lab, name in labs_names.items()}
+        units = {lab: unit[0] for lab, unit in labs_units.items()}
+        grouped = labs_stats.groupby(level=0)
+        stats = pd.DataFrame({'min': grouped['min'].min(), 'max': grouped['max'].max(),
+                              'mean': grouped['mean'].mean(), 'median': grouped['median'].median(),
+                              'std': grouped['std'].median()})
+        deciles = [(int(dec), grouped[dec].mean().to_dict()) for dec in labs_stats.columns[5:]]
+        aboveBelowNorm = labs_aboveBelowNorm.groupby(level=0).mean()
+        correlations['labs'] = labCorrelations(labs_correlatedLabsCoefficients, topN, correlationCutoff)
+        stats = stats.to_dict('index')
+        aboveNorm = aboveBelowNorm.aboveNorm.to_dict()
+        belowNorm = aboveBelowNorm.belowNorm.to_dict()
+        # Labs are written in name order, for those that were also counted
+        codes = [lab for lab in labs_names.index if lab in eventCounts]
+
+    for code in codes:
+        if pd.isnull(code) or str(code) == 'nan' or code not in frequencies or code not in fractions:
+            continue
+
+        scalarDistribution = None
+        if profileType == 'labs':
+            labStats = stats[code]
+            # Labs without a spread of results are left out
+            if np.isnan(float(labStats['std'])):
+                continue
+            scalarDistribution = dict(units=units[code], min=labStats['min'], max=labStats['max'],
+                                      mean=labStats['mean'], median=labStats['median'], stdDev=labStats['std'],
+                                      decile=[(nth, values[code]) for nth, values in deciles],
+                                      fractionAboveNormal=aboveNorm[code], fractionBelowNormal=belowNorm[code])
+
+        related = dict()
+        for domain in DOMAINS:
+            if correlations.get(domain, dict()).get(code):
+                related[domain] = [(other, coefficient,
+                                    names.get(other) if profileType == 'labs' and domain == 'labs' else None)
+                                   for other, coefficient in correlations[domain][code]]
+
+        yield profileEntry(profileType, code, frequencies[code], fractions[code],
+                           count=eventCounts[code] if spec['count'] else None,
+                           name=names[code] if profileType == 'labs' else None,
+                           scalarDistribution=scalarDistribution, correlations=related, topN=topN)
+
+
+def writeProfile(profileType, codes, frequencyPerYear, fractionOfSubjects, correlated, counts=None,
+                 labs_units=None, labs_names=None, labs_stats=None, labs_aboveBelowNorm=None,
+                 labs_correlatedLabsCoefficients=None, cohort='All', sex='All', race='All', age_low='All',
+                 age_high=None, topN=10, correlationCutoff=0.3, compact=False, compress=False, validate=True, sink=None,
+                 cube_dir=None, manifest=None, dry_run=False, hashes=None):
+    """Write out any Clinical Profile to JSON File and save locally
+
+    Entries are streamed to the file as they are built rather than assembled into a fhirclient object tree first.
+
+    Keywords:
+    profileType -- 'labs', 'medications', 'procedures', 'diagnoses' or 'phenotypes'
+    codes, frequencyPerYear, fractionOfSubjects, correlated, counts, labs_* -- result tables, as for profileEntries
+    cohort -- short name for cohort, special characters besides hyphens are prohibited (default 'All')
+    sex -- specification of whether this is a 'All', 'Male', or 'Female' sex profile (default 'All')
+    race -- specification of whether this is 'All', 'White or Caucasian', 'Black or African American', 'Other'
+    race profile (default 'All')
+    age_low -- low age range for this profile (default 'All')
+    age_high -- high age range for this profile (default None)
+    topN -- integer representing the maximum number of correlations to report in the profile, ranked descending (default 10)
+    correlationCutoff -- minimum correlation coefficient value to report for whole profile (default 0.3)
+    compact -- write JSON without indentation (default False)
+    compress -- gzip the file, adding '.gz' to its name (default False)
+    validate -- check the header and first entry against the fhirclient model before writing (default True)
+    sink -- BulkProfileWriter to append the profile to instead of writing its own file (default None)
+    cube_dir -- also save the profile as long rows in the columnar cube under this directory (default None)
+    manifest -- dict of profile id -> content hash from earlier runs; the profile is only written when its hash
+    differs, and the dict is updated with the new hash once the profile is written (default None, meaning always write)
+    dry_run -- with a manifest, only compute the hash, writing nothing and leaving the manifest as it was
+    (default False)
+    hashes -- dict the new content hash is recorded in under the profile id, also in a dry run (default None)
+
+    Returns the name of the file written, or None when the profile was unchanged or this was a dry run
+    """
+    import os
+    import itertools
+    from profileJSON import validateProfile, dumpProfile, openProfile, profileDigest, hashEntries
+    from profileCube import collectCubeRows, profileCubeRows, writeCubeRows
+
+    resource = profileHeader(profileType, cohort, sex, race, age_low, age_high)
+    attribute = PROFILE_SPECS[profileType]['attribute']
+    entries = profileEntries(
+        profileType, codes, frequencyPerYear, fractionOfSubjects, correlated, counts=counts,
+        labs_units=labs_units, labs_names=labs_names, labs_stats=labs_stats, labs_aboveBelowNorm=labs_aboveBelowNorm,
+        labs_correlatedLabsCoefficients=labs_correlatedLabsCoefficients, topN=topN,
+        correlationCutoff=correlationCutoff)
+
+    first = next(entries, None)
+    if validate:
+        validateProfile(resource, attribute, first)
+    if first is not None:
+        entries = itertools.chain([first], entries)
+
+    cubeRows = list()
+    if cube_dir is not None:
+        entries = collectCubeRows(profileType, entries, cubeRows)
+
+    filename = cohort+'_resources/'+resource['id']+'.json'+('.gz' if compress else '')
+    if manifest is not None:
+        previous = manifest.get(resource['id'])
+        digest = profileDigest(resource, attribute)
+        entries = hashEntries(entries, digest)
+        if dry_run or sink is not None:
+            # The hash has to be known before anything is appended to a shared sink
+            entries = list(entries)
+            if hashes is not None:
+                hashes[resource['id']] = digest.hexdigest()
+            if dry_run or (digest.hexdigest() == previous and previous is not None):
+                return None
+
+    if sink is not None:
+        filename = sink.writeProfile(resource, attribute, entries)
+    else:
+        # Written under a temporary name so an unchanged profile, or an interrupted write, leaves the old file alone
+        temporary = os.path.join(os.path.dirname(filename), '.'+os.path.basename(filename)+'.tmp')
+        with openProfile(temporary, compress) as outfile:
+            dumpProfile(resource, attribute, entries, outfile, compact)
+        if manifest is not None:
+            if hashes is not None:
+                hashes[resource['id']] = digest.hexdigest()
+            if digest.hexdigest() == previous and os.path.exists(filename):
+                os.remove(temporary)
+                return None
+        os.replace(temporary, filename)
+
+    # Only a profile that was written is recorded as published
+    if manifest is not None:
+        manifest[resource['id']] = digest.hexdigest()
+
+    if cube_dir is not None:
+        writeCubeRows(cube_dir, profileType, resource['id'],
+                      profileCubeRows(profileType, cubeRows, topN, cohort, sex, race, age_low, age_high))
+
+    return filename
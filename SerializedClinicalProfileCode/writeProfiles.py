@@ -0,0 +1,138 @@
+STRATUM_KEYS = ['cohort', 'sex', 'race', 'age_low', 'age_high']
+
+
+def profileWriterArguments(profileType, results):
+    """Map the tuple returned by calculateAnyProfile onto the arguments of writeProfile
+
+    Keyword arguments:
+    profileType -- 'labs', 'medications', 'procedures', 'diagnoses' or 'phenotypes'
+    results -- tuple returned by calculateAnyProfile(profileType, ...)
+
+    Returns dict of writeProfile keyword arguments
+    """
+    if profileType == 'labs':
+        (labs_counts, labs_frequencyPerYear, labs_fractionOfSubjects, labs_units, labs_names, labs_stats,
+         labs_aboveBelowNorm, labs_correlatedLabsCoefficients, labs_abscorrelation, labs_correlatedMedsCoefficients,
+         labs_correlatedProceduresCoefficients, labs_correlatedDiagnosisCoefficients,
+         labs_correlatedPhenotypesCoefficients) = results
+        return dict(codes=labs_names.index, frequencyPerYear=labs_frequencyPerYear,
+                    fractionOfSubjects=labs_fractionOfSubjects,
+                    correlated={'medications': labs_correlatedMedsCoefficients,
+                                'procedures': labs_correlatedProceduresCoefficients,
+                                'diagnoses': labs_correlatedDiagnosisCoefficients,
+                                'phenotypes': labs_correlatedPhenotypesCoefficients},
+                    counts=labs_counts, labs_units=labs_units, labs_names=labs_names, labs_stats=labs_stats,
+                    labs_aboveBelowNorm=labs_aboveBelowNorm,
+                    labs_correlatedLabsCoefficients=labs_correlatedLabsCoefficients)
+
+    if profileType == 'medications':
+        (codes, dosageInfo, frequencyPerYear, fractionOfSubjects, correlatedLabs, correlatedDiags, correlatedMeds,
+         correlatedProcedures, correlatedPhenotypes) = results
+        counts = None
+    else:
+        (codes, counts, frequencyPerYear, fractionOfSubjects, correlatedLabs, correlatedDiags, correlatedMeds,
+         correlatedProcedures, correlatedPhenotypes) = results
+
+    return dict(codes=codes, frequencyPerYear=frequencyPerYear, fractionOfSubjects=fractionOfSubjects,
+                correlated={'labs': correlatedLabs, 'medications': correlatedMeds,
+                            'procedures': correlatedProcedures, 'diagnoses': correlatedDiags,
+                            'phenotypes': correlatedPhenotypes},
+                counts=counts)
+
+
+def _writeJob(job, writer_kwargs, manifest=None):
+    """Write one profile in a worker process and report how it went"""
+    import time
+    import traceback
+    from writeProfile import writeProfile
+
+    start = time.perf_counter()
+    hashes = dict()
+    try:
+        filename = writeProfile(job['profileType'], **profileWriterArguments(job['profileType'], job['results']),
+                                **{key: job[key] for key in STRATUM_KEYS if key in job}, manifest=manifest,
+                                hashes=hashes, **writer_kwargs)
+        return dict(status='success', filename=filename, error=None, seconds=time.perf_counter() - start,
+                    hash=next(iter(hashes.values()), None) if manifest is not None else None)
+    except Exception:
+        return dict(status='failure', filename=None, error=traceback.format_exc(limit=3),
+                    seconds=time.perf_counter() - start, hash=None)
+
+
+def writeProfiles(jobs, n_workers=None, report_file=None, manifest_file=None, dry_run=False, **writer_kwargs):
+    """Write many calculated profiles across a process pool and summarize the run
+
+    Every job is written independently, so one failing profile does not stop the others. File names come from the
+    profile ids, so reruns of the same jobs overwrite the same files; jobs that would produce the same id are
+    reported as failures instead of silently overwriting each other.
+
+    Keyword arguments:
+    jobs -- iterable of dicts with 'profileType', 'results' (the tuple returned by calculateAnyProfile) and the
+    stratum keys 'cohort', 'sex', 'race', 'age_low', 'age_high' (missing keys take writeProfile's defaults)
+    n_workers -- number of worker processes (default None, meaning one per CPU)
+    report_file -- optional CSV file to save the summary report to (default None)
+    manifest_file -- JSON manifest of profile id -> content hash; only profiles whose hash changed are written and
+    the manifest is updated afterwards (default None, meaning every profile is written)
+    dry_run -- with a manifest, write nothing and only report which profiles changed (default False)
+    writer_kwargs -- passed on to writeProfile, e.g. topN, correlationCutoff, compact or compress
+
+    Returns dataframe with one row per job: profileType, id, stratum, status, filename, error, seconds, and with a
+    manifest the content hash and whether it changed
+    """
+    import time
+    import pandas as pd
+    from concurrent.futures import ProcessPoolExecutor
+    from writeProfile import profileId
+    from profileJSON import loadManifest, saveManifest
+
+    jobs = list(jobs)
+    rows = list()
+    for job in jobs:
+        stratum = {key: job[key] for key in STRATUM_KEYS if key in job}
+        rows.append(dict(profileType=job['profileType'], id=profileId(job['profileType'], **stratum), **stratum))
+    report = pd.DataFrame(rows, columns=['profileType', 'id'] + STRATUM_KEYS)
+
+    duplicated = report.id.duplicated(keep='first').values
+    outcomes = [dict(status='failure', filename=None, error='duplicate profile id', seconds=0.0, hash=None)
+                if duplicated[n] else None for n in range(len(jobs))]
+
+    manifest = loadManifest(manifest_file) if manifest_file is not None else None
+    if manifest is not None:
+        writer_kwargs = dict(writer_kwargs, dry_run=dry_run)
+
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        # Each worker only gets the manifest entry of its own profile and sends the new hash back
+        futures = {n: executor.submit(_writeJob, job, writer_kwargs,
+                                      None if manifest is None else {report.id[n]: manifest.get(report.id[n])})
+                   for n, job in enumerate(jobs) if not duplicated[n]}
+        for n, future in futures.items():
+            try:
+                outcomes[n] = future.result()
+            except Exception as e:
+                # The worker itself died, e.g. when the results could not be pickled
+                outcomes[n] = dict(status='failure', filename=None, error=repr(e), seconds=float('nan'), hash=None)
+
+    report = pd.concat([report, pd.DataFrame(outcomes, columns=['status', 'filename', 'error', 'seconds', 'hash'])],
+                       axis=1)
+    if manifest is None:
+        report = report.drop(columns='hash')
+        print('Wrote {} of {} profiles in {:.1f}s, {} failed'.format((report.status == 'success').sum(), len(report),
+                                                                    time.perf_counter() - start,
+                                                                    (report.status == 'failure').sum()))
+    else:
+        report['changed'] = (report.status == 'success') & (report.hash.values != report.id.map(manifest).values)
+        print('{} of {} profiles changed{} in {:.1f}s, {} failed'.format(
+            report.changed.sum(), len(report), ' (dry run, nothing written)' if dry_run else '',
+            time.perf_counter() - start, (report.status == 'failure').sum()))
+        if dry_run:
+            for profile in report.id[report.changed]:
+                print('  changed: ' + profile)
+        else:
+            changed = report[report.changed]
+            manifest.update(zip(changed.id, changed.hash))
+            saveManifest(manifest_file, manifest)
+
+    if report_file is not None:
+        report.to_csv(report_file, index=False)
+    return report
@@ -1,6 +1,35 @@
+import os
+import re
+import gzip
+import json
+import io
+import mmap
+import contextlib
+import fnmatch
+import threading
+import urllib.parse
+import zipfile
+import tarfile
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import cached_property
+
 import requests
+import requests.adapters
+import numpy as np
 import pandas as pd
 
+try:
+    # Incremental parsing; ijson picks its C (yajl2_c) backend when it is built
+    import ijson
+except ImportError:
+    ijson = None
+
+try:
+    from scipy import sparse
+except ImportError:
+    sparse = None
+
 
 DEFAULT_KEYS = [
     'resourceType', 'id', 'meta', 'text',
@@ -11,38 +40,920 @@ DEFAULT_KEYS = [
 
 class ClinicalProfileServer:
 
-    def __init__(self, base_url):
+    def __init__(self, base_url, page_size=100, n_connections=4, cache_size=128, cache_dir=None, offline=False,
+                 prefetch=True):
+        """Connect to a FHIR server and start downloading its ClinicalProfile resources
+
+        The first page is fetched before returning; the remaining pages are fetched concurrently in the
+        background, so profiles can be used as soon as their page has arrived.
+
+        base_url -- server root, e.g. "https://hapi.clinicalprofiles.org"
+        page_size -- profiles requested per page
+        n_connections -- pages fetched at the same time
+        cache_size -- most recently used ClinicalProfile objects kept built
+        cache_dir -- directory of a persistent cache; cached profiles are available immediately and only
+        profiles updated on the server since the last run are downloaded
+        offline -- serve only from cache_dir, without contacting the server
+        prefetch -- download the whole library up front; without it profiles are fetched one at a time on
+        lookup and search() can be used to fetch just what is needed
+        """
         self.base_url = base_url
+        self.page_size = page_size
+        self.n_connections = n_connections
+
+        self._session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=n_connections, pool_maxsize=n_connections)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+        # Compact JSON, gzip-compressed on the wire
+        self._session.headers.update({'Accept': 'application/fhir+json', 'Accept-Encoding': 'gzip, deflate'})
 
-        self._data = None
-        self._populate_data()
+        # Entries in arrival order; a profile deleted from the server leaves None in its place, so the positions
+        # iterators have reached stay valid
+        self._data = {'entry': []}
+        # id -> position in self._data['entry'], and an LRU of built profiles
+        self._index = {}
+        self._profiles = OrderedDict()
+        self._cache_size = cache_size
+        self._loaded = threading.Condition()
+        self._complete = False
+        self._error = None
+
+        self._cache = ProfileCache(cache_dir, base_url) if cache_dir is not None else None
+        if offline and self._cache is None:
+            raise ValueError("offline mode needs a cache_dir")
+        self.offline = offline
+        self.prefetch = prefetch
+        if prefetch or offline:
+            self._populate_data()
+        else:
+            self._complete = True
+
+    def _stream(self, url, params=None):
+        res = self._session.get(url, params=params, stream=True)
+        if not res.ok:
+            raise ValueError(f"Failed to fetch from {res.url}")
+        res.raw.decode_content = True
+        return res
+
+    def _get_page(self, url, params=None):
+        # Parsed straight off the socket, without holding the response text next to the parsed page
+        with self._stream(url, params) as res:
+            return _load(res.raw)
+
+    def _add_page(self, page, store=True):
+        entries = page.get('entry', [])
+        if store and self._cache is not None:
+            self._cache.store(entries)
+        with self._loaded:
+            for entry in entries:
+                key = entry['resource']['id']
+                if key in self._index:
+                    # A newer version of a cached profile replaces it in place
+                    self._data['entry'][self._index[key]] = entry
+                    self._profiles.pop(key, None)
+                else:
+                    self._index[key] = len(self._data['entry'])
+                    self._data['entry'].append(entry)
+            self._loaded.notify_all()
 
     def _populate_data(self):
-        res = requests.get(f"{self.base_url}/baseR4/ClinicalProfile?_pretty=true")
-        if res.ok:
-            self._data = res.json()
+        params = {'_count': self.page_size, '_total': 'accurate'}
+        if self._cache is not None:
+            self._add_page({'entry': self._cache.entries()}, store=False)
+            if self._cache.last_updated is not None:
+                # Only profiles created or updated since the last complete download
+                params['_lastUpdated'] = 'ge' + self._cache.last_updated
+        if self.offline:
+            self._complete = True
+            return
+
+        first = self._get_page(f"{self.base_url}/baseR4/ClinicalProfile", params=params)
+        self._add_page(first)
+
+        next_url = _next_link(first)
+        if next_url is None:
+            self._finish()
+            return
+        threading.Thread(target=self._fetch_remaining, args=(next_url, first.get('total'), len(first.get('entry', []))),
+                         daemon=True).start()
+
+    def _finish(self):
+        if self._cache is not None and self._error is None:
+            self._cache.prune(self._server_ids())
+            self._drop([key for key in list(self._index) if key not in self._cache.ids])
+            self._cache.commit()
+        with self._loaded:
+            self._complete = True
+            self._loaded.notify_all()
+
+    def _drop(self, keys):
+        with self._loaded:
+            for key in keys:
+                self._data['entry'][self._index.pop(key)] = None
+                self._profiles.pop(key, None)
+
+    def _server_ids(self):
+        # Ids only, so finding profiles deleted from the server costs a few kilobytes
+        ids = set()
+        page = self._get_page(f"{self.base_url}/baseR4/ClinicalProfile", params={'_elements': 'id', '_count': 1000})
+        while page is not None:
+            ids.update(entry['resource']['id'] for entry in page.get('entry', []))
+            next_url = _next_link(page)
+            page = self._get_page(next_url) if next_url is not None else None
+        return ids
+
+    def revalidate(self, key):
+        """Re-read one profile from the server, downloading it only if its version changed"""
+        headers = {}
+        if key in self._index:
+            version = self._data['entry'][self._index[key]]['resource'].get('meta', {}).get('versionId')
+            if version is not None:
+                headers['If-None-Match'] = f'W/"{version}"'
+        res = self._session.get(f"{self.base_url}/baseR4/ClinicalProfile/{key}", headers=headers, stream=True)
+        with res:
+            if res.status_code == 304:
+                return self[key]
+            if not res.ok:
+                raise ValueError(f"Failed to fetch from {res.url}")
+            res.raw.decode_content = True
+            self._add_page({'entry': [{'fullUrl': res.url, 'resource': _load(res.raw)}]})
+        if self._cache is not None:
+            # Pages may still be downloading, so the watermark is left for _finish to move
+            self._cache.save()
+        return self[key]
+
+    def _fetch_remaining(self, next_url, total, offset):
+        try:
+            pages = _page_urls(next_url, total, offset)
+            if pages is None:
+                # The server's paging links cannot be predicted, so they are followed one at a time
+                while next_url is not None:
+                    page = self._get_page(next_url)
+                    self._add_page(page)
+                    next_url = _next_link(page)
+            else:
+                with ThreadPoolExecutor(max_workers=self.n_connections) as executor:
+                    # Pages are fetched concurrently and added in order
+                    for page in executor.map(self._get_page, pages):
+                        self._add_page(page)
+        except Exception as e:
+            self._error = e
+        finally:
+            try:
+                self._finish()
+            except Exception as e:
+                self._error = e
+                with self._loaded:
+                    self._complete = True
+                    self._loaded.notify_all()
+
+    def wait(self):
+        """Block until every page has been downloaded"""
+        with self._loaded:
+            self._loaded.wait_for(lambda: self._complete)
+        if self._error is not None:
+            raise self._error
+
+    def __iter__(self):
+        """Yield each ClinicalProfile as soon as its page has arrived"""
+        n = 0
+        while True:
+            with self._loaded:
+                self._loaded.wait_for(lambda: self._complete or len(self._data['entry']) > n)
+                entries = self._data['entry'][n:]
+                complete = self._complete
+            for entry in entries:
+                if entry is not None and entry['resource']['id'] in self._index:
+                    yield self._profile(entry['resource']['id'])
+            n += len(entries)
+            if complete and not entries:
+                break
+        if self._error is not None:
+            raise self._error
+
+    def keys(self):
+        self.wait()
+        return list(self._index)
+
+    def profiles(self):
+        return self.keys()
+
+    def _profile(self, key):
+        profile = self._profiles.get(key)
+        if profile is not None:
+            self._profiles.move_to_end(key)
+            return profile
+        profile = ClinicalProfile.from_dict(self._data['entry'][self._index[key]])
+        self._profiles[key] = profile
+        if len(self._profiles) > self._cache_size:
+            self._profiles.popitem(last=False)
+        return profile
+
+    def __contains__(self, key):
+        return self[key] is not None
+
+    def __len__(self):
+        self.wait()
+        return len(self._index)
+
+    def __getitem__(self, key):
+        # Pages still downloading are waited for only until the id shows up
+        with self._loaded:
+            self._loaded.wait_for(lambda: self._complete or key in self._index)
+        if key in self._index:
+            return self._profile(key)
+        if self._error is not None:
+            raise self._error
+        if not self.prefetch and not self.offline:
+            res = self._session.get(f"{self.base_url}/baseR4/ClinicalProfile/{key}", stream=True)
+            with res:
+                if res.ok:
+                    res.raw.decode_content = True
+                    self._add_page({'entry': [{'fullUrl': res.url, 'resource': _load(res.raw)}]})
+                    return self._profile(key)
+        return None
+
+    def _search_pages(self, params):
+        page = self._get_page(f"{self.base_url}/baseR4/ClinicalProfile", params=params)
+        while page is not None:
+            yield page
+            next_url = _next_link(page)
+            page = self._get_page(next_url) if next_url is not None else None
+
+    def ids(self, pattern=None, last_updated=None):
+        """List profile ids on the server, downloading nothing but the ids
+
+        pattern -- shell-style id pattern, e.g. "jh-labs-copd-*"
+        last_updated -- only profiles updated in this range, as a FHIR date search such as "ge2021-01-01"
+        """
+        params = {'_elements': 'id', '_count': 1000}
+        if last_updated is not None:
+            params['_lastUpdated'] = last_updated
+        ids = [entry['resource']['id'] for page in self._search_pages(params) for entry in page.get('entry', [])]
+        if pattern is not None:
+            ids = fnmatch.filter(ids, pattern)
+        return ids
+
+    def to_frame(self):
+        """One DataFrame per domain plus correlated-code edges across every profile, see to_frame()"""
+        return to_frame(self)
+
+    def stream_domain(self, domain, id=None, last_updated=None):
+        """Yield (profile id, entry) for each entry of one domain straight from the server, as it is parsed
+
+        Only the requested domain is downloaded, and neither whole pages nor whole profiles are kept in memory,
+        so this suits scans over large libraries; nothing is added to the library or its cache.
+
+        domain -- "phenotypes", "labs", "medications", "diagnoses" or "procedures"
+        id -- profile id or list of ids (default all profiles)
+        last_updated -- only profiles updated in this range, as a FHIR date search such as "ge2021-01-01"
+        """
+        key = DOMAINS.get(domain, domain)
+        params = {'_count': self.page_size, '_elements': key}
+        if id is not None:
+            params['_id'] = id if isinstance(id, str) else ','.join(id)
+        if last_updated is not None:
+            params['_lastUpdated'] = last_updated
+
+        next_url = f"{self.base_url}/baseR4/ClinicalProfile"
+        while next_url is not None:
+            links = []
+            with self._stream(next_url, params) as res:
+                for prefix, value in _stream_items(res.raw, _domain_prefixes(key, bundle=True)):
+                    if prefix == 'link':
+                        links = value
+                    elif prefix == 'entry.item.resource.id':
+                        profile = value
+                    else:
+                        yield profile, value
+            next_url = _next_link({'link': links})
+            params = None
+
+    def search(self, id=None, elements=None, summary=None, count=None, last_updated=None, batch_size=50):
+        """Fetch only the profiles and parts of profiles needed, using FHIR search parameters
+
+        id -- profile id, list of ids, or shell-style pattern such as "jh-labs-copd-*"; patterns are matched
+        against the id list from ids() and the matches fetched by _id
+        elements -- element names to return, e.g. ["id", "date"] for headers or ["lab"] for one domain (_elements)
+        summary -- FHIR _summary mode, e.g. "true" for headers only or "count" for just the number of matches
+        count -- page size (_count)
+        last_updated -- FHIR date search on meta.lastUpdated, e.g. "ge2021-01-01" (_lastUpdated)
+        batch_size -- ids per request when fetching by _id
+
+        Returns a list of ClinicalProfile objects, or the number of matches when summary is "count". Partial
+        profiles are not added to the server's index or cache.
+        """
+        params = {}
+        if elements is not None:
+            params['_elements'] = elements if isinstance(elements, str) else ','.join(elements)
+        if summary is not None:
+            params['_summary'] = summary
+        if count is not None:
+            params['_count'] = count
+        if last_updated is not None:
+            params['_lastUpdated'] = last_updated
+
+        if id is None:
+            if summary == 'count':
+                return next(self._search_pages(params)).get('total', 0)
+            pages = [self._search_pages(params)]
         else:
-            raise ValueError(
-                f"Failed to fetch from {self.base_url}/baseR4/ClinicalProfile?_pretty=true"
-            )
+            if isinstance(id, str) and any(c in id for c in '*?['):
+                ids = self.ids(id, last_updated)
+                if summary == 'count':
+                    return len(ids)
+            else:
+                ids = [id] if isinstance(id, str) else list(id)
+            batches = [ids[i:i + batch_size] for i in range(0, len(ids), batch_size)]
+            if summary == 'count':
+                return sum(next(self._search_pages(dict(params, _id=','.join(batch)))).get('total', 0)
+                           for batch in batches)
+            # Batches of ids are fetched concurrently
+            with ThreadPoolExecutor(max_workers=self.n_connections) as executor:
+                pages = list(executor.map(lambda batch: list(self._search_pages(dict(params, _id=','.join(batch)))),
+                                          batches))
+
+        return [ClinicalProfile.from_dict(entry) for batch in pages for page in batch for entry in page.get('entry', [])]
+
+
+class ProfileCache:
+    """On-disk store of ClinicalProfile Bundle entries by id, with the newest meta.lastUpdated seen so far"""
+
+    def __init__(self, cache_dir, base_url):
+        self.directory = os.path.join(cache_dir, urllib.parse.quote(base_url, safe=''))
+        os.makedirs(self.directory, exist_ok=True)
+        self._state_file = os.path.join(self.directory, 'cache.json')
+        self._lock = threading.Lock()
+
+        state = {'lastUpdated': None, 'versions': {}}
+        if os.path.exists(self._state_file):
+            with open(self._state_file) as f:
+                state = json.load(f)
+        self.last_updated = state['lastUpdated']
+        self.versions = state['versions']
+        self._newest = self.last_updated
+
+    @property
+    def ids(self):
+        return set(self.versions)
+
+    def _path(self, key):
+        return os.path.join(self.directory, urllib.parse.quote(key, safe='') + '.json')
+
+    def entries(self):
+        entries = []
+        for key in sorted(self.versions):
+            if os.path.exists(self._path(key)):
+                with open(self._path(key), 'rb') as f:
+                    entries.append(_load(f))
+        return entries
+
+    def store(self, entries):
+        for entry in entries:
+            key = entry['resource']['id']
+            meta = entry['resource'].get('meta', {})
+            with open(self._path(key) + '.tmp', 'w') as f:
+                json.dump(entry, f)
+            os.replace(self._path(key) + '.tmp', self._path(key))
+            with self._lock:
+                self.versions[key] = meta.get('versionId')
+                updated = meta.get('lastUpdated')
+                if updated is not None and (self._newest is None or
+                                            pd.Timestamp(updated) > pd.Timestamp(self._newest)):
+                    self._newest = updated
+
+    def prune(self, server_ids):
+        for key in self.ids - set(server_ids):
+            if os.path.exists(self._path(key)):
+                os.remove(self._path(key))
+            del self.versions[key]
+
+    def save(self):
+        # Records the stored versions without moving the watermark
+        with self._lock:
+            with open(self._state_file + '.tmp', 'w') as f:
+                json.dump({'lastUpdated': self.last_updated, 'versions': self.versions}, f)
+            os.replace(self._state_file + '.tmp', self._state_file)
+
+    def commit(self):
+        # The watermark only moves forward once every page of a download is stored
+        with self._lock:
+            self.last_updated = self._newest
+        self.save()
+
+
+class ClinicalProfileLibrary:
+    """Local library of written profiles with the same API as ClinicalProfileServer
+
+    Opens the output of the write*Profile functions without a server: a {cohort}_resources/ directory of .json or
+    .json.gz files, NDJSON or Bundle files from BulkProfileWriter, or a .zip / .tar archive of any of these. An index
+    of id -> byte range is built on first use and saved next to the source, large bulk files are memory-mapped, and a
+    profile is only parsed when it is looked up.
+    """
+
+    # Documents at least this large are memory-mapped or, when compressed, kept decompressed between reads
+    MAP_SIZE = 1 << 20
+    # Version of the saved index layout; older index files are rebuilt
+    INDEX_VERSION = 2
+
+    def __init__(self, source, cache_size=128, max_buffers=16):
+        """Open a local library
+
+        source -- directory, .json / .json.gz / .ndjson file, BulkProfileWriter '<prefix>.index.json', or .zip /
+        .tar / .tar.gz archive
+        cache_size -- most recently used ClinicalProfile objects kept built
+        max_buffers -- most recently used large documents kept mapped or decompressed; each map holds a file
+        descriptor, so this also bounds the files held open
+        """
+        self.source = source
+        self._root = source if os.path.isdir(source) else os.path.dirname(source)
+        self._profiles = OrderedDict()
+        self._cache_size = cache_size
+        self._lock = threading.RLock()
+        self._buffers = OrderedDict()
+        self._max_buffers = max_buffers
+        self._archive = None
+        if zipfile.is_zipfile(source):
+            self._archive = zipfile.ZipFile(source)
+        elif os.path.isfile(source) and tarfile.is_tarfile(source):
+            self._archive = tarfile.open(source)
+        self._index = self._load_index()
+
+    # Index
+
+    def _documents(self):
+        # (file, archive member) of every profile document, skipping index and temporary files
+        def wanted(name):
+            base = os.path.basename(name)
+            return (not base.startswith('.') and not base.endswith('.index.json') and
+                    base.endswith(('.json', '.json.gz', '.ndjson')))
+
+        if self._archive is not None:
+            names = self._archive.namelist() if isinstance(self._archive, zipfile.ZipFile) else \
+                [member.name for member in self._archive.getmembers() if member.isfile()]
+            return [(os.path.basename(self.source), name) for name in sorted(names) if wanted(name)]
+        if os.path.isdir(self.source):
+            return [(name, None) for name in sorted(os.listdir(self.source)) if wanted(name)]
+        return [(os.path.basename(self.source), None)]
+
+    def _index_file(self):
+        if os.path.isdir(self.source):
+            return os.path.join(self.source, '.clinicalprofiles.index.json')
+        if self.source.endswith('.index.json'):
+            return None
+        # Dot-prefixed, so a directory scan neither reads it as a profile nor as a BulkProfileWriter index
+        return os.path.join(self._root, '.' + os.path.basename(self.source) + '.clinicalprofiles.index.json')
+
+    def _stamp(self, documents):
+        files = {name for name, _ in documents}
+        return {name: [os.path.getsize(os.path.join(self._root, name)),
+                       os.path.getmtime(os.path.join(self._root, name))] for name in files}
+
+    def _load_index(self):
+        if self.source.endswith('.index.json'):
+            # BulkProfileWriter already recorded where every profile is
+            with open(self.source) as f:
+                bulk = json.load(f)
+            return {key: [name, None, offset, length, None, None]
+                    for key, (name, offset, length) in bulk['resources'].items()}
+
+        documents = self._documents()
+        stamp = self._stamp(documents)
+        index_file = self._index_file()
+        if os.path.exists(index_file):
+            with open(index_file) as f:
+                saved = json.load(f)
+            if saved.get('version') == self.INDEX_VERSION and saved['files'] == stamp:
+                return saved['resources']
+
+        index = {}
+        known = set()
+        if self._archive is None:
+            # Files covered by a BulkProfileWriter index are not scanned again
+            for name in os.listdir(self._root) if os.path.isdir(self.source) else []:
+                if name.endswith('.index.json') and not name.startswith('.'):
+                    with open(os.path.join(self._root, name)) as f:
+                        bulk = json.load(f)
+                    if not {'format', 'files', 'resources'} <= set(bulk):
+                        # Not written by BulkProfileWriter, e.g. a sidecar index of an older version of this library
+                        continue
+                    known.update(bulk['files'])
+                    index.update({key: [file, None, offset, length, None, None]
+                                  for key, (file, offset, length) in bulk['resources'].items()})
+        for name, member in documents:
+            if member is None and name in known:
+                continue
+            index.update(self._scan(name, member))
+
+        try:
+            with open(index_file + '.tmp', 'w') as f:
+                json.dump({'version': self.INDEX_VERSION, 'files': stamp, 'resources': index}, f)
+            os.replace(index_file + '.tmp', index_file)
+        except OSError:
+            # A read-only source is simply indexed again next time
+            pass
+        return index
+
+    def _scan(self, name, member):
+        """Locate the profiles of one document: [file, member, offset, length, position in Bundle, lastUpdated]"""
+        buffer = self._buffer(name, member)
+        if (member or name).endswith('.ndjson'):
+            index = {}
+            start = 0
+            while start < len(buffer):
+                end = buffer.find(b'\n', start)
+                end = len(buffer) if end == -1 else end
+                if buffer[start:end].strip():
+                    key, updated = _header(io.BytesIO(buffer[start:end]))
+                    index[key] = [name, member, start, end - start, None, updated]
+                start = end + 1
+            return index
+
+        resources = _bundle_index(buffer)
+        if resources is None:
+            key, updated = _header(io.BytesIO(buffer))
+            return {key: [name, member, None, None, None, updated]}
+        return {key: [name, member, start, end - start, position, updated]
+                for position, (start, end, key, updated) in enumerate(resources)}
+
+    # Reading
+
+    def _buffer(self, name, member):
+        """Bytes of one document
+
+        Large plain files are memory-mapped and large compressed documents decompressed once, and both are kept in a
+        bounded LRU that closes the maps it evicts. Small documents, such as one profile per file, are read whole
+        and not kept, so a directory of many profiles holds no files open. Callers slice the buffer under the lock,
+        as an evicted map is closed.
+        """
+        with self._lock:
+            key = (name, member)
+            data = self._buffers.get(key)
+            if data is not None:
+                self._buffers.move_to_end(key)
+                return data
+            if member is not None:
+                if isinstance(self._archive, zipfile.ZipFile):
+                    data = self._archive.read(member)
+                else:
+                    data = self._archive.extractfile(member).read()
+                if member.endswith('.gz'):
+                    data = gzip.decompress(data)
+            elif name.endswith('.gz'):
+                with gzip.open(os.path.join(self._root, name), 'rb') as f:
+                    data = f.read()
+            else:
+                with open(os.path.join(self._root, name), 'rb') as f:
+                    if os.fstat(f.fileno()).st_size < self.MAP_SIZE:
+                        return f.read()
+                    data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            if len(data) >= self.MAP_SIZE:
+                self._buffers[key] = data
+                if len(self._buffers) > self._max_buffers:
+                    _, evicted = self._buffers.popitem(last=False)
+                    if isinstance(evicted, mmap.mmap):
+                        evicted.close()
+            return data
+
+    def _open(self, key):
+        # Binary stream over a copy of one resource's bytes
+        name, member, offset, length, _, _ = self._index[key]
+        with self._lock:
+            buffer = self._buffer(name, member)
+            return io.BytesIO(buffer[:] if offset is None else buffer[offset:offset + length])
+
+    def _read(self, key):
+        with self._open(key) as stream:
+            return _load(stream)
+
+    def _resources(self):
+        for key in self._index:
+            yield self._read(key)
+
+    def _profile(self, key):
+        profile = self._profiles.get(key)
+        if profile is not None:
+            self._profiles.move_to_end(key)
+            return profile
+        profile = ClinicalProfile.from_dict({'fullUrl': f"ClinicalProfile/{key}", 'resource': self._read(key)})
+        self._profiles[key] = profile
+        if len(self._profiles) > self._cache_size:
+            self._profiles.popitem(last=False)
+        return profile
+
+    def _updated(self, key):
+        updated = self._index[key][5]
+        if updated is None:
+            resource = self._read(key)
+            updated = self._index[key][5] = resource.get('meta', {}).get('lastUpdated', resource.get('date'))
+        return updated
+
+    # Same API as ClinicalProfileServer
+
+    def wait(self):
+        """Nothing to wait for; the index is complete once the library is open"""
+
+    def revalidate(self, key):
+        """Re-read one profile from disk"""
+        self._profiles.pop(key, None)
+        return self[key]
+
+    def __iter__(self):
+        for key in self._index:
+            yield self._profile(key)
 
     def keys(self):
-        return [
-            self._data['entry'][i]['resource']['id']
-            for i in range(len(self._data['entry']))
-        ]
+        return list(self._index)
 
     def profiles(self):
         return self.keys()
 
+    def __contains__(self, key):
+        return key in self._index
+
+    def __len__(self):
+        return len(self._index)
+
     def __getitem__(self, key):
-        for entry in self._data['entry']:
-            if entry['resource']['id'] == key:
-                return ClinicalProfile.from_dict(entry)
+        if key in self._index:
+            return self._profile(key)
+        return None
+
+    def ids(self, pattern=None, last_updated=None):
+        """List profile ids
+
+        pattern -- shell-style id pattern, e.g. "jh-labs-copd-*"
+        last_updated -- only profiles updated in this range, as a FHIR date search such as "ge2021-01-01"; profiles
+        without meta.lastUpdated are matched on their date
+        """
+        ids = list(self._index)
+        if pattern is not None:
+            ids = fnmatch.filter(ids, pattern)
+        if last_updated is not None:
+            ids = [key for key in ids if _date_matches(self._updated(key), last_updated)]
+        return ids
+
+    def to_frame(self):
+        """One DataFrame per domain plus correlated-code edges across every profile, see to_frame()"""
+        return to_frame(self)
+
+    def stream_domain(self, domain, id=None, last_updated=None):
+        """Yield (profile id, entry) for each entry of one domain, parsing nothing but that domain
+
+        domain -- "phenotypes", "labs", "medications", "diagnoses" or "procedures"
+        id -- profile id or list of ids (default all profiles)
+        last_updated -- only profiles updated in this range, as a FHIR date search such as "ge2021-01-01"
+        """
+        ids = self.ids(last_updated=last_updated) if id is None else [id] if isinstance(id, str) else list(id)
+        for key in ids:
+            if key in self._index:
+                yield from stream_domain(self._open(key), domain)
+
+    def search(self, id=None, elements=None, summary=None, count=None, last_updated=None, batch_size=None):
+        """Select profiles and parts of profiles with the same parameters as ClinicalProfileServer.search
+
+        id -- profile id, list of ids, or shell-style pattern such as "jh-labs-copd-*"
+        elements -- element names to return, e.g. ["id", "date"] for headers or ["lab"] for one domain
+        summary -- "true" for headers only or "count" for just the number of matches
+        count, batch_size -- accepted for compatibility; a local library is not paged
+        last_updated -- FHIR date search on meta.lastUpdated (or date), e.g. "ge2021-01-01"
+
+        Returns a list of ClinicalProfile objects, or the number of matches when summary is "count". Partial
+        profiles are not added to the library's cache.
+        """
+        if id is None or (isinstance(id, str) and any(c in id for c in '*?[')):
+            ids = self.ids(id, last_updated)
+        else:
+            ids = [key for key in ([id] if isinstance(id, str) else id) if key in self._index]
+            if last_updated is not None:
+                ids = [key for key in ids if _date_matches(self._updated(key), last_updated)]
+        if summary == 'count':
+            return len(ids)
+
+        keep = None
+        if summary == 'true':
+            keep = set(DEFAULT_KEYS)
+        elif elements is not None:
+            # Mandatory elements are always returned, as a FHIR server does
+            keep = set(elements.split(',') if isinstance(elements, str) else elements) | {'resourceType', 'id', 'meta'}
+        if keep is None:
+            return [self._profile(key) for key in ids]
+        return [ClinicalProfile.from_dict({'fullUrl': f"ClinicalProfile/{key}",
+                                           'resource': {k: v for k, v in self._read(key).items() if k in keep}})
+                for key in ids]
+
+    def close(self):
+        with self._lock:
+            for data in self._buffers.values():
+                if isinstance(data, mmap.mmap):
+                    data.close()
+            self._buffers = OrderedDict()
+        if self._archive is not None:
+            self._archive.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _header(stream):
+    # Id and last update of a single resource
+    header = dict(_stream_items(stream, {'id', 'meta.lastUpdated', 'date'}))
+    return header['id'], header.get('meta.lastUpdated', header.get('date'))
+
+
+# JSON strings, with the colon after object keys, and brackets, in UTF-8 bytes
+_JSON_TOKEN = re.compile(rb'("[^"\\]*(?:\\.[^"\\]*)*")(\s*:)?|[{}\[\]]')
+# Keys each container of a Bundle's entry.resource was opened under, None for the document and array items
+_RESOURCE_PATH = [None, b'"entry"', None, b'"resource"']
+_META_PATH = _RESOURCE_PATH + [b'"meta"']
+
+
+def _bundle_index(buffer):
+    """(start, end, id, lastUpdated) of each entry.resource of a Bundle, with byte offsets, or None if the document
+    is not a Bundle
+
+    The bytes are scanned in place for strings and brackets, so a memory-mapped file is neither copied nor decoded;
+    only the resources' id, date and meta.lastUpdated values are decoded.
+    """
+    resources = []
+    path = []
+    key = None
+    resource_type = None
+    fields = None
+    start = None
+    for token in _JSON_TOKEN.finditer(buffer):
+        string = token.group(1)
+        if string is not None:
+            if token.group(2) is not None:
+                key = string
+            elif len(path) == 1:
+                if key == b'"resourceType"':
+                    resource_type = json.loads(string)
+            elif len(path) == 4:
+                if key in (b'"id"', b'"date"') and path == _RESOURCE_PATH:
+                    fields[key] = json.loads(string)
+            elif len(path) == 5 and key == b'"lastUpdated"' and path == _META_PATH:
+                fields[key] = json.loads(string)
+            continue
+
+        bracket = token.group()
+        if bracket in b'{[':
+            path.append(key)
+            key = None
+            if len(path) == 4 and bracket == b'{' and path == _RESOURCE_PATH:
+                start, fields = token.start(), {}
+        else:
+            if len(path) == 4 and bracket == b'}' and path == _RESOURCE_PATH:
+                resources.append((start, token.end(), fields.get(b'"id"'),
+                                  fields.get(b'"lastUpdated"', fields.get(b'"date"'))))
+            path.pop()
+            key = None
+    return resources if resource_type == 'Bundle' else None
+
+
+def _date_matches(value, search):
+    """Whether a FHIR date/dateTime matches a date search such as "ge2021-01-01" """
+    if value is None:
+        return False
+    prefix = search[:2] if search[:2] in ('eq', 'ne', 'gt', 'lt', 'ge', 'le') else 'eq'
+    bound = search[2:] if search[:2] == prefix else search
+
+    def timestamp(text):
+        stamp = pd.Timestamp(text)
+        return stamp.tz_localize('UTC') if stamp.tzinfo is None else stamp
+
+    value, bound = timestamp(value), timestamp(bound)
+    return {'eq': value == bound, 'ne': value != bound, 'gt': value > bound, 'lt': value < bound,
+            'ge': value >= bound, 'le': value <= bound}[prefix]
+
+
+def _next_link(bundle):
+    for link in bundle.get('link', []):
+        if link.get('relation') == 'next':
+            return link['url']
+    return None
+
+
+def _page_urls(next_url, total, offset):
+    """Predict the URLs of all remaining pages from HAPI's offset-based paging links, or None if they do not
+    follow that pattern"""
+    url = urllib.parse.urlsplit(next_url)
+    params = urllib.parse.parse_qs(url.query)
+    if total is None or '_getpagesoffset' not in params or '_count' not in params:
+        return None
+
+    count = int(params['_count'][0])
+    start = int(params['_getpagesoffset'][0])
+    if start != offset or count <= 0:
+        return None
 
+    urls = []
+    for page_offset in range(start, total, count):
+        params['_getpagesoffset'] = [str(page_offset)]
+        urls.append(urllib.parse.urlunsplit(url._replace(query=urllib.parse.urlencode(params, doseq=True))))
+    return urls
+
+
+def _display(coding):
+    # Codings written without a display name are shown by their code
+    return coding.get('display', coding.get('code'))
+
+
+def _walk(value, prefixes, prefix=''):
+    # Document-order walk of a parsed value, naming positions the way ijson does
+    if prefix in prefixes:
+        yield prefix, value
+    elif isinstance(value, dict):
+        for key, item in value.items():
+            yield from _walk(item, prefixes, f"{prefix}.{key}" if prefix else key)
+    elif isinstance(value, list):
+        for item in value:
+            yield from _walk(item, prefixes, f"{prefix}.item" if prefix else 'item')
+
+
+def _stream_items(stream, prefixes):
+    """Yield (prefix, value) for each JSON value at one of the prefixes of a binary stream, as soon as it is parsed
+
+    Prefixes are ijson paths, e.g. "entry.item.resource" for each resource of a Bundle. Without ijson the stream is
+    parsed whole and walked, which gives the same items without the memory savings.
+    """
+    if ijson is None:
+        yield from _walk(json.load(stream), prefixes)
+        return
+
+    builder = None
+    for prefix, event, value in ijson.parse(stream, use_float=True):
+        if builder is None:
+            if prefix not in prefixes or event in ('map_key', 'end_map', 'end_array'):
+                continue
+            if event not in ('start_map', 'start_array'):
+                yield prefix, value
+                continue
+            builder, current, depth = ijson.ObjectBuilder(), prefix, 0
+        builder.event(event, value)
+        if event in ('start_map', 'start_array'):
+            depth += 1
+        elif event in ('end_map', 'end_array'):
+            depth -= 1
+            if depth == 0:
+                yield current, builder.value
+                builder = None
+
+
+def _load(stream):
+    return next(_stream_items(stream, {''}))[1]
+
+
+def _domain_prefixes(key, bundle):
+    if bundle:
+        return {'link', 'entry.item.resource.id', f"entry.item.resource.{key}.item"}
+    return {'id', 'entry.item.resource.id', f"{key}.item", f"entry.item.resource.{key}.item"}
+
+
+def _open_source(source):
+    if not isinstance(source, str):
+        # Caller's file object, left open
+        return contextlib.nullcontext(source)
+    if source.endswith('.gz'):
+        return gzip.open(source, 'rb')
+    return open(source, 'rb')
+
+
+def stream_resources(source):
+    """Yield the resources of a Bundle file one at a time, without parsing the whole Bundle
+
+    source -- path to a .json or .json.gz Bundle, or a binary file object
+    """
+    with _open_source(source) as stream:
+        for _, resource in _stream_items(stream, {'entry.item.resource'}):
+            yield resource
+
+
+def stream_domain(source, domain):
+    """Yield (profile id, entry) for each entry of one domain of a profile or Bundle file, as it is parsed
+
+    Only one entry is held in memory at a time, so single domains of very large profiles can be scanned cheaply.
+
+    source -- path to a .json or .json.gz profile or Bundle, or a binary file object
+    domain -- "phenotypes", "labs", "medications", "diagnoses" or "procedures"
+    """
+    key = DOMAINS.get(domain, domain)
+    with _open_source(source) as stream:
+        profile = None
+        for prefix, value in _stream_items(stream, _domain_prefixes(key, bundle=False)):
+            if prefix in ('id', 'entry.item.resource.id'):
+                profile = value
+            else:
+                yield profile, value
 
 
 class Variable:
+    # Variables are views over the profile JSON; slots keep millions of them small
+    __slots__ = ('_name', '_data')
 
     def __init__(self, name, data):
         self._name = name
@@ -50,7 +961,7 @@ class Variable:
 
     @property
     def name(self):
-        return self._name['display']
+        return _display(self._name)
 
     @property
     def code(self):
@@ -76,27 +987,37 @@ class Variable:
         return Variable(data['code'][0]['coding'][0], data)
 
 class PhenotypeVariable(Variable):
+    # Derived mappings, built on first access
+    __slots__ = ('_phenotypes', '_phenotype_codes')
 
     @property
     def phenotypes(self):
-        return {
-            x['code']['coding'][0]['display']: x.get('coefficient', None)
-            for x in self._data['correlatedPhenotypes']['entry']
-        }
+        try:
+            return self._phenotypes
+        except AttributeError:
+            self._phenotypes = {
+                _display(x['code']['coding'][0]): x.get('coefficient', None)
+                for x in self._data.get('correlatedPhenotypes', {}).get('entry', [])
+            }
+            return self._phenotypes
 
     @property
     def phenotype_codes(self):
-        return {
-            x['code']['coding'][0]['name']: x['code']['coding'][0]['display']
-            for x in self._data['correlatedPhenotypes']['entry']
-        }
+        try:
+            return self._phenotype_codes
+        except AttributeError:
+            self._phenotype_codes = {
+                x['code']['coding'][0]['code']: _display(x['code']['coding'][0])
+                for x in self._data.get('correlatedPhenotypes', {}).get('entry', [])
+            }
+            return self._phenotype_codes
 
     @property
     def raw_phenotype(self):
         return self._data['correlatedPhenotypes']
 
     def __len__(self):
-        return self.phenotypes
+        return len(self.phenotypes)
 
     def __getitem__(self, key):
         return self.phenotypes[key]
@@ -110,6 +1031,8 @@ class PhenotypeVariable(Variable):
 
 
 class LabVariable(Variable):
+    __slots__ = ()
+
     # Statistics:
     @property
     def distribution(self):
@@ -142,16 +1065,27 @@ class LabVariable(Variable):
 
 
 class MedicationVariable(Variable):
+    __slots__ = ()
 
     @staticmethod
     def from_dict(data: dict) -> "MedicationVariable":
+        if 'medicationCodeableConcept' in data:
+            return MedicationVariable(data['medicationCodeableConcept']['coding'][0], data)
         return MedicationVariable(data['dosage']['route'][0]['coding'][0], data)
 
 class DiagnosisVariable(Variable):
-    pass
+    __slots__ = ()
+
+    @staticmethod
+    def from_dict(data: dict) -> "DiagnosisVariable":
+        return DiagnosisVariable(data['code'][0]['coding'][0], data)
 
 class ProcedureVariable(Variable):
-    pass
+    __slots__ = ()
+
+    @staticmethod
+    def from_dict(data: dict) -> "ProcedureVariable":
+        return ProcedureVariable(data['code'][0]['coding'][0], data)
 
 class ClinicalProfile:
 
@@ -161,88 +1095,102 @@ class ClinicalProfile:
 
         self._resource = self._data['resource']
 
-        self.last_updated = pd.Timestamp(self._resource['meta']['lastUpdated']).to_pydatetime()
-        self.date = pd.Timestamp(self._resource['date']).to_pydatetime()
-        self.version = self._resource['meta']['versionId']
-        self.url = self._data['fullUrl']
-        self.status = self._resource['status']
+    # Header fields and domain sections are only read from the resource when first used
+    @cached_property
+    def last_updated(self):
+        return pd.Timestamp(self._resource['meta']['lastUpdated']).to_pydatetime()
+
+    @cached_property
+    def date(self):
+        return pd.Timestamp(self._resource['date']).to_pydatetime()
+
+    @cached_property
+    def version(self):
+        return self._resource['meta']['versionId']
+
+    @cached_property
+    def url(self):
+        return self._data['fullUrl']
+
+    @cached_property
+    def status(self):
+        return self._resource['status']
 
-        self.population = self._resource['population']
-        self.cohort = self._resource['cohort']
-        self.source = self._resource['source']
-        self.reporter = self._resource['reporter']
+    @cached_property
+    def population(self):
+        return self._resource['population']
 
-        self.phenotypes = self._resource["hpo"]
-        self.labs = self._resource["lab"]
-        self.medications = self._resource["medication"]
-        self.diagnoses = self._resource["diagnosis"]
-        self.procedures = self._resource["procedure"]
+    @cached_property
+    def cohort(self):
+        return self._resource['cohort']
+
+    @cached_property
+    def source(self):
+        return self._resource['source']
+
+    @cached_property
+    def reporter(self):
+        return self._resource['reporter']
+
+    # Profiles hold one domain each, so the other sections are empty
+    @cached_property
+    def phenotypes(self):
+        return self._resource.get("hpo", [])
+
+    @cached_property
+    def labs(self):
+        return self._resource.get("lab", [])
+
+    @cached_property
+    def medications(self):
+        return self._resource.get("medication", [])
+
+    @cached_property
+    def diagnoses(self):
+        return self._resource.get("diagnosis", [])
+
+    @cached_property
+    def procedures(self):
+        return self._resource.get("procedure", [])
 
 
     def get_phenotype_variables(self) -> "List[Variable]":
-        return {
-            PhenotypeVariable.from_dict(x).name: PhenotypeVariable.from_dict(x)
-            for x in self.phenotypes
-        }
+        return {v.name: v for v in map(PhenotypeVariable.from_dict, self.phenotypes)}
 
     def get_phenotype_codes(self) -> "List[Variable]":
-        return {
-            PhenotypeVariable.from_dict(x).code: PhenotypeVariable.from_dict(x)
-            for x in self.phenotypes
-        }
+        return {v.code: v for v in map(PhenotypeVariable.from_dict, self.phenotypes)}
 
 
     def get_lab_variables(self) -> "List[Variable]":
-        return {
-            LabVariable.from_dict(x).name: LabVariable.from_dict(x)
-            for x in self.labs
-        }
+        return {v.name: v for v in map(LabVariable.from_dict, self.labs)}
 
     def get_lab_codes(self) -> "List[Variable]":
-        return {
-            LabVariable.from_dict(x).code: LabVariable.from_dict(x)
-            for x in self.labs
-        }
+        return {v.code: v for v in map(LabVariable.from_dict, self.labs)}
 
 
     def get_medication_variables(self) -> "List[Variable]":
-        return {
-            MedicationVariable.from_dict(x).name: MedicationVariable.from_dict(x)
-            for x in self.medications
-        }
+        return {v.name: v for v in map(MedicationVariable.from_dict, self.medications)}
 
     def get_medication_codes(self) -> "List[Variable]":
-        return {
-            MedicationVariable.from_dict(x).code: MedicationVariable.from_dict(x)
-            for x in self.medications
-        }
+        return {v.code: v for v in map(MedicationVariable.from_dict, self.medications)}
 
 
     def get_diagnosis_variables(self) -> "List[Variable]":
-        return {
-            DiagnosisVariable.from_dict(x).name: DiagnosisVariable.from_dict(x)
-            for x in self.diagnoses
-        }
+        return {v.name: v for v in map(DiagnosisVariable.from_dict, self.diagnoses)}
 
     def get_diagnosis_codes(self) -> "List[Variable]":
-        return {
-            DiagnosisVariable.from_dict(x).code: DiagnosisVariable.from_dict(x)
-            for x in self.diagnoses
-        }
+        return {v.code: v for v in map(DiagnosisVariable.from_dict, self.diagnoses)}
 
 
     def get_procedure_variables(self) -> "List[Variable]":
-        return {
-            ProcedureVariable.from_dict(x).name: ProcedureVariable.from_dict(x)
-            for x in self.procedures
-        }
+        return {v.name: v for v in map(ProcedureVariable.from_dict, self.procedures)}
 
     def get_procedure_codes(self) -> "List[Variable]":
-        return {
-            ProcedureVariable.from_dict(x).code: ProcedureVariable.from_dict(x)
-            for x in self.procedures
-        }
+        return {v.code: v for v in map(ProcedureVariable.from_dict, self.procedures)}
 
+    def to_frame(self):
+        """One DataFrame per domain plus correlated-code edges, see to_frame()"""
+        return to_frame(self)
 
     def __repr__(self):
         return f"<ClinicalProfile '{self.name}'>"
@@ -250,3 +1198,401 @@ class ClinicalProfile:
     @staticmethod
     def from_dict(data: dict) -> 'ClinicalProfile':
         return ClinicalProfile(data['resource']['id'], data)
+
+
+# Domain name -> resource element holding its entries
+DOMAINS = {
+    'phenotypes': 'hpo',
+    'labs': 'lab',
+    'medications': 'medication',
+    'diagnoses': 'diagnosis',
+    'procedures': 'procedure',
+}
+
+# Correlated-code element -> domain of the related codes
+CORRELATED = {
+    'correlatedPhenotypes': 'phenotypes',
+    'correlatedLabs': 'labs',
+    'correlatedMedications': 'medications',
+    'correlatedDiagnoses': 'diagnoses',
+    'correlatedProcedures': 'procedures',
+}
+
+
+def _resources(library):
+    # Accepts a server, ClinicalProfile objects, Bundle entries or bare resources
+    if isinstance(library, ClinicalProfileLibrary):
+        yield from library._resources()
+        return
+    if isinstance(library, ClinicalProfileServer):
+        # Read the raw page entries rather than building a ClinicalProfile per resource
+        library.wait()
+        library = [entry for entry in library._data['entry'] if entry is not None]
+    for item in library:
+        if isinstance(item, ClinicalProfile):
+            yield item._resource
+        elif 'resource' in item:
+            yield item['resource']
+        else:
+            yield item
+
+
+def _concept_code(concept):
+    if isinstance(concept, list):
+        concept = concept[0]
+    coding = concept['coding'][0]
+    return coding.get('code'), coding.get('display', concept.get('text'))
+
+
+def _entry_code(entry):
+    if 'code' in entry:
+        return _concept_code(entry['code'])
+    if 'medicationCodeableConcept' in entry:
+        return _concept_code(entry['medicationCodeableConcept'])
+    if 'labcode' in entry:
+        return _concept_code(entry['labcode'])
+    if 'meds' in entry:
+        return _concept_code(entry['meds'][0]['medicationCodeableConcept'])
+    return None, None
+
+
+# Scalar distribution statistics exported as lab columns
+LAB_STATISTICS = ['min', 'max', 'mean', 'median', 'stdDev', 'fractionAboveNormal', 'fractionBelowNormal']
+
+VARIABLE_COLUMNS = ['profile', 'domain', 'code', 'name', 'count', 'frequencyPerYear', 'fractionOfSubjects']
+EDGE_COLUMNS = ['profile', 'domain', 'code', 'related_domain', 'related_code', 'related_name', 'coefficient']
+
+
+def _flatten(library):
+    """One pass over the raw JSON of a library into column lists of variables per domain and correlated-code edges"""
+    variables = {domain: {column: [] for column in VARIABLE_COLUMNS} for domain in DOMAINS}
+    for column in ['units'] + LAB_STATISTICS:
+        variables['labs'][column] = []
+    deciles = []
+    edges = {column: [] for column in EDGE_COLUMNS}
+
+    for resource in _resources(library):
+        profile = resource['id']
+        for domain, key in DOMAINS.items():
+            columns = variables[domain]
+            for entry in resource.get(key, []):
+                code, name = _entry_code(entry)
+                columns['profile'].append(profile)
+                columns['domain'].append(domain)
+                columns['code'].append(code)
+                columns['name'].append(name)
+                columns['count'].append(entry.get('count'))
+                columns['frequencyPerYear'].append(entry.get('frequencyPerYear'))
+                columns['fractionOfSubjects'].append(entry.get('fractionOfSubjects'))
+
+                distribution = entry.get('scalarDistribution', {})
+                if domain == 'labs':
+                    columns['units'].append(distribution.get('units', {}).get('unit'))
+                    for statistic in LAB_STATISTICS:
+                        columns[statistic].append(distribution.get(statistic))
+                    deciles.append({decile['nth']: decile['value'] for decile in distribution.get('decile', [])})
+
+                # Labs keep their correlations under the scalar distribution
+                for holder in (entry, distribution):
+                    for element, related_domain in CORRELATED.items():
+                        for related in holder.get(element, {}).get('entry', []):
+                            related_code, related_name = _entry_code(related)
+                            edges['profile'].append(profile)
+                            edges['domain'].append(domain)
+                            edges['code'].append(code)
+                            edges['related_domain'].append(related_domain)
+                            edges['related_code'].append(related_code)
+                            edges['related_name'].append(related_name)
+                            edges['coefficient'].append(related.get('coefficient'))
+
+    # Deciles become one float column per nth, NaN where a lab does not report it
+    deciles = pd.DataFrame.from_records(deciles, columns=sorted({nth for row in deciles for nth in row}))
+    for nth in deciles.columns:
+        variables['labs'][f"decile_{nth}"] = deciles[nth].to_numpy(dtype=float)
+
+    return variables, edges
+
+
+def _frame(columns):
+    df = pd.DataFrame(columns)
+    for column in ('profile', 'domain', 'related_domain', 'units'):
+        if column in df:
+            df[column] = df[column].astype('category')
+    for column in ('count', 'frequencyPerYear', 'fractionOfSubjects', 'coefficient') + tuple(LAB_STATISTICS):
+        if column in df:
+            df[column] = df[column].astype(float)
+    return df
+
+
+def to_frame(library):
+    """Flatten a profile or a library into one DataFrame per domain plus one of correlated-code edges
+
+    library -- a ClinicalProfile, a ClinicalProfileServer or ClinicalProfileLibrary, or an iterable of profiles, Bundle entries or resources
+
+    Returns a dict with a DataFrame for each of 'phenotypes', 'labs', 'medications', 'diagnoses' and 'procedures'
+    (labs also carry their units, distribution statistics and decile_<nth> columns) and 'correlations', with
+    one row per (profile, code, related code) edge.
+    """
+    if isinstance(library, ClinicalProfile):
+        library = [library]
+    variables, edges = _flatten(library)
+    frames = {domain: _frame(columns) for domain, columns in variables.items()}
+    frames['correlations'] = _frame(edges)
+    return frames
+
+
+def _sorted_by_code(df):
+    # Codes are searched with searchsorted, which cannot compare missing codes with strings
+    df = df[df['code'].notna()]
+    return df.sort_values('code', kind='mergesort').reset_index(drop=True)
+
+
+class CodeIndex:
+    """Inverted index from code to the profiles, statistics and correlated codes it appears with
+
+    Built in one pass over a library, e.g. CodeIndex.from_library(server), and saved with save() so it can be
+    reloaded without touching the profiles again.
+    """
+
+    def __init__(self, variables, edges):
+        self.variables = variables
+        self.edges = edges
+        self._variable_codes = variables['code'].to_numpy(dtype=object)
+        self._edge_codes = edges['code'].to_numpy(dtype=object)
+
+    @staticmethod
+    def from_library(library) -> "CodeIndex":
+        variables, edges = _flatten(library)
+        variables = pd.concat([pd.DataFrame({column: columns[column] for column in VARIABLE_COLUMNS})
+                               for columns in variables.values()], ignore_index=True)
+        return CodeIndex(_sorted_by_code(_frame(variables)), _sorted_by_code(_frame(edges)))
+
+    def save(self, path):
+        pd.to_pickle({'variables': self.variables, 'edges': self.edges}, path)
+
+    @staticmethod
+    def load(path) -> "CodeIndex":
+        data = pd.read_pickle(path)
+        return CodeIndex(data['variables'], data['edges'])
+
+    def _rows(self, df, codes, code):
+        # Rows are sorted by code, so each lookup is two binary searches
+        start = codes.searchsorted(code, side='left')
+        end = codes.searchsorted(code, side='right')
+        return df.iloc[start:end]
+
+    def query(self, code, domain=None, min_fraction=None, max_fraction=None):
+        """Profiles containing a code, with its statistics in each
+
+        code -- e.g. "HP:0001945" or "4548-4"
+        domain -- only this domain, e.g. "phenotypes"
+        min_fraction, max_fraction -- bounds on fractionOfSubjects
+        """
+        rows = self._rows(self.variables, self._variable_codes, code)
+        if domain is not None:
+            rows = rows[rows['domain'] == domain]
+        if min_fraction is not None:
+            rows = rows[rows['fractionOfSubjects'] > min_fraction]
+        if max_fraction is not None:
+            rows = rows[rows['fractionOfSubjects'] < max_fraction]
+        return rows
+
+    def profiles(self, code, **filters):
+        return list(self.query(code, **filters)['profile'].astype(str).unique())
+
+    def correlated(self, code, profiles=None, related_domain=None, min_coefficient=None):
+        """Codes correlated with a code, per profile
+
+        profiles -- only these profile ids, e.g. the result of profiles()
+        related_domain -- only related codes of this domain
+        min_coefficient -- lower bound on the coefficient
+        """
+        rows = self._rows(self.edges, self._edge_codes, code)
+        if profiles is not None:
+            rows = rows[rows['profile'].isin(profiles)]
+        if related_domain is not None:
+            rows = rows[rows['related_domain'] == related_domain]
+        if min_coefficient is not None:
+            rows = rows[rows['coefficient'] >= min_coefficient]
+        return rows
+
+    def __contains__(self, code):
+        return len(self._rows(self.variables, self._variable_codes, code)) > 0
+
+    def __repr__(self):
+        return f"<CodeIndex {len(self.variables)} variables, {len(self.edges)} correlations>"
+
+
+class SimilarityIndex:
+    """Cohort similarity between profiles, from one domain of each profile as a sparse vector
+
+    Each profile becomes a row of a sparse matrix with one column per code of the domain, e.g. the
+    fractionOfSubjects of every phenotype. Profiles are compared with cosine similarity or Jaccard similarity of
+    their code sets, in batches of sparse matrix products. New profiles can be added to the index, or queried
+    against it, without recomputing the profiles already indexed:
+
+        index = SimilarityIndex.from_library(server, domain='phenotypes')
+        index.query(other_server['jh-hpo-eds-All-All-All'], k=10)
+    """
+
+    def __init__(self, domain='phenotypes', value='fractionOfSubjects', metric='cosine', batch_size=1024):
+        """domain -- "phenotypes", "labs", "medications", "diagnoses" or "procedures"
+        value -- entry statistic used as vector weight, e.g. "fractionOfSubjects" or "frequencyPerYear"
+        metric -- "cosine" or "jaccard" (set overlap of codes, ignoring weights)
+        batch_size -- profiles compared per sparse product, bounding the dense similarity block kept in memory
+        """
+        if sparse is None:
+            raise ImportError("SimilarityIndex needs scipy")
+        if metric not in ('cosine', 'jaccard'):
+            raise ValueError("metric must be 'cosine' or 'jaccard'")
+        self.domain = domain
+        self.value = value
+        self.metric = metric
+        self.batch_size = batch_size
+
+        self.profiles = []
+        # code -> column
+        self.codes = {}
+        self._matrix = sparse.csr_matrix((0, 0))
+        self._norms = np.zeros(0)
+        self._sizes = np.zeros(0)
+
+    @staticmethod
+    def from_library(library, **kwargs) -> "SimilarityIndex":
+        index = SimilarityIndex(**kwargs)
+        index.add(library)
+        return index
+
+    def _vectors(self, library, extend):
+        """Sparse rows of the profiles of a library, with their norms and code counts over all of their codes"""
+        frame = to_frame(library)[self.domain]
+        frame = frame[frame['code'].notna()]
+        profiles, rows = np.unique(frame['profile'].astype(str).to_numpy(), return_inverse=True)
+        values = frame[self.value].fillna(0).to_numpy(dtype=float)
+
+        if extend:
+            for code in frame['code'].unique():
+                self.codes.setdefault(code, len(self.codes))
+        columns = frame['code'].map(self.codes).fillna(-1).to_numpy(dtype=np.int64)
+
+        # Norms and sizes count codes the index has never seen, so they lower similarity instead of vanishing
+        norms = np.sqrt(np.bincount(rows, weights=values ** 2, minlength=len(profiles)))
+        sizes = np.bincount(rows, weights=(values != 0).astype(float), minlength=len(profiles))
+        known = columns >= 0
+        matrix = sparse.csr_matrix((values[known], (rows[known], columns[known])),
+                                   shape=(len(profiles), len(self.codes)))
+        return list(profiles), matrix, norms, sizes
+
+    def add(self, library):
+        """Add profiles to the index, replacing profiles with the same id
+
+        library -- a ClinicalProfile, ClinicalProfileServer or ClinicalProfileLibrary, or an iterable of profiles
+        or resources; profiles without entries in the domain are left out
+        """
+        profiles, matrix, norms, sizes = self._vectors(library, extend=True)
+        keep = ~np.isin(np.array(self.profiles, dtype=object), profiles)
+        old = self._matrix[np.flatnonzero(keep)] if len(self.profiles) else self._matrix
+        old.resize((old.shape[0], len(self.codes)))
+
+        self.profiles = [key for key, kept in zip(self.profiles, keep) if kept] + profiles
+        self._matrix = sparse.vstack([old, matrix], format='csr')
+        self._norms = np.concatenate([self._norms[keep], norms])
+        self._sizes = np.concatenate([self._sizes[keep], sizes])
+
+    def _similarities(self, matrix, norms, sizes, metric):
+        """Dense block of similarities between some rows and every indexed profile"""
+        matrix = matrix.copy()
+        matrix.resize((matrix.shape[0], len(self.codes)))
+        if metric == 'cosine':
+            products = (matrix @ self._matrix.T).toarray()
+            denominator = norms[:, None] * self._norms[None, :]
+        else:
+            present = (matrix != 0).astype(float)
+            products = (present @ (self._matrix != 0).astype(float).T).toarray()
+            denominator = sizes[:, None] + self._sizes[None, :] - products
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(denominator > 0, products / denominator, 0.0)
+
+    def _batches(self, matrix, norms, sizes, metric):
+        for start in range(0, matrix.shape[0], self.batch_size):
+            end = start + self.batch_size
+            yield start, self._similarities(matrix[start:end], norms[start:end], sizes[start:end], metric)
+
+    def _nearest(self, queries, block, start, k, exclude_self):
+        if exclude_self:
+            block[np.arange(block.shape[0]), np.arange(start, start + block.shape[0])] = -np.inf
+        k = min(k, block.shape[1] - exclude_self)
+        if k <= 0:
+            return []
+        top = np.argpartition(-block, k - 1, axis=1)[:, :k]
+        order = np.argsort(-np.take_along_axis(block, top, axis=1), axis=1, kind='stable')
+        top = np.take_along_axis(top, order, axis=1)
+        rows = np.repeat(np.arange(block.shape[0]), k)
+        return [pd.DataFrame({'query': np.asarray(queries, dtype=object)[start + rows],
+                              'profile': np.asarray(self.profiles, dtype=object)[top.ravel()],
+                              'similarity': block[rows, top.ravel()],
+                              'rank': np.tile(np.arange(1, k + 1), block.shape[0])})]
+
+    def query(self, library, k=10, metric=None):
+        """The k most similar indexed profiles for each profile of a library, which is not added to the index
+
+        Returns a DataFrame of query, profile, similarity and rank
+        """
+        metric = metric or self.metric
+        queries, matrix, norms, sizes = self._vectors(library, extend=False)
+        frames = []
+        for start, block in self._batches(matrix, norms, sizes, metric):
+            frames += self._nearest(queries, block, start, k, exclude_self=False)
+        return _concat(frames, ['query', 'profile', 'similarity', 'rank'])
+
+    def neighbors(self, k=10, metric=None):
+        """The k most similar other profiles for every indexed profile
+
+        Returns a DataFrame of query, profile, similarity and rank
+        """
+        metric = metric or self.metric
+        frames = []
+        for start, block in self._batches(self._matrix, self._norms, self._sizes, metric):
+            frames += self._nearest(self.profiles, block, start, k, exclude_self=True)
+        return _concat(frames, ['query', 'profile', 'similarity', 'rank'])
+
+    def pairs(self, threshold=0.5, metric=None):
+        """Every pair of indexed profiles with a similarity of at least threshold, each pair listed once
+
+        Returns a DataFrame of profile_a, profile_b and similarity
+        """
+        metric = metric or self.metric
+        profiles = np.asarray(self.profiles, dtype=object)
+        frames = []
+        for start, block in self._batches(self._matrix, self._norms, self._sizes, metric):
+            rows, columns = np.nonzero(block >= threshold)
+            upper = columns > start + rows
+            rows, columns = rows[upper], columns[upper]
+            frames.append(pd.DataFrame({'profile_a': profiles[start + rows], 'profile_b': profiles[columns],
+                                        'similarity': block[rows, columns]}))
+        return _concat(frames, ['profile_a', 'profile_b', 'similarity'])
+
+    def save(self, path):
+        pd.to_pickle(self.__dict__, path)
+
+    @staticmethod
+    def load(path) -> "SimilarityIndex":
+        index = SimilarityIndex.__new__(SimilarityIndex)
+        index.__dict__.update(pd.read_pickle(path))
+        return index
+
+    def __contains__(self, key):
+        return key in self.profiles
+
+    def __len__(self):
+        return len(self.profiles)
+
+    def __repr__(self):
+        return f"<SimilarityIndex {self.domain} {len(self.profiles)} profiles x {len(self.codes)} codes>"
+
+
+def _concat(frames, columns):
+    frames = [frame for frame in frames if len(frame)]
+    if not frames:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(frames, ignore_index=True)
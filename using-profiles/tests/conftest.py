@@ -0,0 +1,5 @@
+import os
+import sys
+
+# clinicalprofiles is used as a single module next to the notebooks
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
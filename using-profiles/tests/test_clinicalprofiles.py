@@ -0,0 +1,71 @@
+import json
+
+from clinicalprofiles import ClinicalProfileLibrary
+
+
+def profile(key, date='2021-01-01'):
+    return {'resourceType': 'ClinicalProfile', 'id': key, 'status': 'draft', 'date': date,
+            'lab': [{'code': [{'coding': [{'code': '2345-7', 'display': 'Glucose {mg/dL} "fasting"'}]}],
+                     'count': 3}]}
+
+
+def writeBulk(directory, prefix, resources):
+    # The files and index BulkProfileWriter writes for NDJSON output
+    directory.mkdir()
+    lines = [json.dumps(resource, separators=(',', ':')).encode('utf-8') for resource in resources]
+    offsets = [sum(len(line) + 1 for line in lines[:n]) for n in range(len(lines))]
+    filename = prefix + '-00000.ndjson'
+    (directory / filename).write_bytes(b''.join(line + b'\n' for line in lines))
+    (directory / (prefix + '.index.json')).write_text(json.dumps(
+        {'format': 'ndjson', 'files': [filename],
+         'resources': {resource['id']: [filename, offset, len(line)]
+                       for resource, offset, line in zip(resources, offsets, lines)}}))
+    return directory / filename
+
+
+def test_open_file_then_its_directory(tmp_path):
+    resources = [profile('p{}'.format(n)) for n in range(5)]
+    filename = writeBulk(tmp_path / 'bulk', 'x', resources)
+
+    with ClinicalProfileLibrary(str(filename)) as library:
+        assert library.keys() == ['p0', 'p1', 'p2', 'p3', 'p4']
+
+    # The file's own index is saved next to it and must not be taken for the BulkProfileWriter index
+    with ClinicalProfileLibrary(str(tmp_path / 'bulk')) as library:
+        assert sorted(library.keys()) == ['p0', 'p1', 'p2', 'p3', 'p4']
+        assert library['p3']._resource == resources[3]
+
+
+def test_saved_index_is_reused(tmp_path, monkeypatch):
+    directory = tmp_path / 'resources'
+    directory.mkdir()
+    for n in range(3):
+        (directory / 'p{}.json'.format(n)).write_text(json.dumps(profile('p{}'.format(n)), indent=4))
+
+    ClinicalProfileLibrary(str(directory)).close()
+
+    def scan(*args):
+        raise AssertionError('unchanged files are not scanned again')
+    monkeypatch.setattr(ClinicalProfileLibrary, '_scan', scan)
+    with ClinicalProfileLibrary(str(directory)) as library:
+        assert library.keys() == ['p0', 'p1', 'p2']
+        assert library['p1']._resource == profile('p1')
+
+
+def test_bundle_index(tmp_path, monkeypatch):
+    # Braces, brackets, escaped quotes and non-ASCII text inside strings must not move the resource boundaries
+    resources = [profile('p{}'.format(n)) for n in range(20)]
+    resources[4]['lab'][0]['code'][0]['coding'][0]['display'] = 'Glukose {} [] \\" ü → ünits'
+    resources[7]['meta'] = {'lastUpdated': '2022-05-01T00:00:00Z', 'tag': [{'code': '}{'}]}
+    bundle = {'resourceType': 'Bundle', 'type': 'collection',
+              'entry': [{'fullUrl': 'ClinicalProfile/' + resource['id'], 'resource': resource}
+                        for resource in resources]}
+    filename = tmp_path / 'bundle.json'
+    filename.write_text(json.dumps(bundle, indent=2, ensure_ascii=False), encoding='utf-8')
+
+    # Memory-mapped like a large bulk file
+    monkeypatch.setattr(ClinicalProfileLibrary, 'MAP_SIZE', 0)
+    with ClinicalProfileLibrary(str(filename)) as library:
+        assert library.keys() == [resource['id'] for resource in resources]
+        assert all(library[resource['id']]._resource == resource for resource in resources)
+        assert library.ids(last_updated='ge2022-01-01') == ['p7']